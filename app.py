@@ -15,7 +15,8 @@ References and sources:
 
 # Flask
 from flask import Flask
-from flask import redirect, render_template, request
+from flask import abort, jsonify, redirect, render_template, request, url_for
+from flask import Response, stream_with_context
 from flask import session
 
 # Set up config before import extensions
@@ -28,17 +29,29 @@ except ImportError as e:
     print(e)
 
 # Database
-from flask_sqlalchemy import SQLAlchemy
 import psycopg2
-db = SQLAlchemy(app)
+import psycopg2.extras
+
+# Queries of the pages and forms, on one pooled connection per request. Its
+# db is the only SQLAlchemy instance, flask-security's models use it too
+import queries
+queries.init_app(app)
+db = queries.db
+
+# Page results, cached until a form changes what they show
+import cache
+cache.init_app(app)
+
+# Existence checks of the ids forms refer to
+import validation
+validation.init_app(app)
 
 # Forms
 import forms
-forms.db.init_app(app)
 
 # Tables
 import tables
-tables.db.init_app(app)
+tables.PAGE_TIMEOUT = app.config['PAGE_TIMEOUT']
 
 # flask-debugtoolbar
 from flask_debugtoolbar import DebugToolbarExtension
@@ -52,9 +65,14 @@ from flask_security import login_required
 # Misc
 from passlib.hash import bcrypt_sha256
 import click
+import io
+import random
 
 # Project local stuff
 import datagenerator
+import importer
+import procbench
+import snapshots
 
 
 
@@ -130,66 +148,232 @@ def get_db():
     '''Sets up a psycopg2 database connection as configured in config.py'''
     return psycopg2.connect(**app.config['PSYCOPG2_LOGIN_INFO'])
 
+def execute_file(cur, filename):
+    '''Run the statements in a .sql file'''
+    with open(filename,'r') as f:
+        cur.execute(f.read())
+
+def distribution_options(command):
+    '''Add an option for each of the generator's skewable distributions'''
+    for name in reversed(datagenerator.DISTRIBUTIONS):
+        option = click.option('--' + name.replace('_', '-'), default='uniform',
+                              help='Distribution of the {}: uniform, zipf:S or '
+                                   'hot:FRAC:PROB'.format(name.replace('_', ' ')))
+        command = option(command)
+    return command
+
 @app.cli.command('initdb')
 @click.argument('number', default=20)
-def initdb(number):
+@click.option('--workers', default=1, help='Processes used to generate data')
+@click.option('--seed', type=int, default=None, help='Seed for reproducible data')
+@click.option('--cache-hashes', is_flag=True,
+              help='Hash each distinct generated password only once')
+@click.option('--backend', type=click.Choice(['python', 'numpy']), default='python',
+              help='Generate the biggest tables with numpy instead of python loops')
+@distribution_options
+def initdb(number, workers, seed, cache_hashes, backend, **distributions):
     '''Initialize the database with the randomly generated data'''
     with get_db() as conn:  # Open db connection to execute
         with conn.cursor() as cur:
-            with open('schema.sql','r') as f:
-                cur.execute(f.read())
-            with open('stored_procedures.sql','r') as f:
-                cur.execute(f.read())
+            execute_file(cur, 'schema.sql')
+            execute_file(cur, 'stored_procedures.sql')
 
-        datagenerator.write_tables_db(number, conn, verbosity=1)
+        datagenerator.write_tables_db(number, conn, verbosity=1,
+                                      chunksize=datagenerator.CHUNK_SIZE,
+                                      seed=seed, workers=workers, backend=backend,
+                                      distributions=distributions)
+
+        # Indexes, rollups and change notifications go on once the data is in,
+        # see indexes.sql
+        with conn.cursor() as cur:
+            execute_file(cur, 'indexes.sql')
+            execute_file(cur, 'rollups.sql')
+            execute_file(cur, 'notifications.sql')
 
 
     # schema.sql is destructive, flask-security tables need to be rebuilt
     db.create_all()
+    db.session.commit()
 
-    users_table_dict = datagenerator.make_users(number, verbosity=1)
-    user_fields = users_table_dict['fields']
-    users = users_table_dict['values']
-    for user in users:
-        userdict = {k:v for k,v in zip(user_fields, user)}
-        user_datastore.create_user(
-            username=userdict['username'],
-            email=userdict['email'],
-            password=userdict['password'],
-            active=True)
+    rng = random.Random(seed) if seed is not None else random
+    users_table_dict = datagenerator.make_users(number, verbosity=1, rng=rng)
+    users = [user + ([],) for user in users_table_dict['values']]
 
     # Make a few users that we know will always exist
-    user_datastore.add_role_to_user(
-        user_datastore.create_user(
-            username='nullp0inter',
-            email='iguibas@mail.usf.edu',
-            password='_Hunter2',
-            active=True
-        ),
-        admin_role
-    )
+    users.append(('nullp0inter', 'iguibas@mail.usf.edu', '_Hunter2', ['admin']))
+    users.append(('admin', 'admin@example.com', 'password', ['admin']))
+    users.append(('user', 'user@example.com', 'password', []))
 
-    user_datastore.add_role_to_user(
-        user_datastore.create_user(
-            username='admin',
-            email='admin@example.com',
-            password='password',
-            active=True
-        ),
-        admin_role
-    )
+    bulk_create_users(users, workers=workers, cache={} if cache_hashes else None)
+    print('Database initialized')
 
-    user_datastore.create_user(
-        username='user',
-        email='user@example.com',
-        password='password',
-        active=True
-    )
 
-    db.session.commit()
-    print('Database initialized')
+def bulk_create_users(users, workers=1, cache=None, batchsize=1000):
+    '''Insert many users at once without going through user_datastore
 
+    users is a list of (username, email, password, roles) tuples where roles
+    is a list of role names that must already exist. Passwords are hashed on
+    workers processes (see datagenerator.hash_passwords for cache) and the
+    rows are inserted batchsize at a time.
+    '''
+    if app.config['SECURITY_PASSWORD_HASH'] != 'bcrypt':
+        raise RuntimeError('bulk_create_users only supports bcrypt password hashes')
 
+    hashes = datagenerator.hash_passwords(
+        (user[2] for user in users),
+        app.config['SECURITY_PASSWORD_SALT'],
+        workers=workers,
+        cache=cache)
+
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur,
+                'INSERT INTO flask_security_user (username, email, password, active) VALUES %s',
+                [(user[0], user[1], pwhash, True) for user, pwhash in zip(users, hashes)],
+                page_size=batchsize)
+
+            # One statement per role rather than one per user
+            rolenames = {role for user in users for role in user[3]}
+            for rolename in sorted(rolenames):
+                cur.execute('''INSERT INTO flask_security_roles_users (user_id, role_id)
+                               SELECT U.id, R.id
+                               FROM flask_security_user U, flask_security_role R
+                               WHERE R.name = %s AND U.username = ANY(%s);''',
+                            (rolename, [user[0] for user in users if rolename in user[3]]))
+
+
+
+@app.cli.command('growdb')
+@click.option('--stores', default=0, help='Number of stores to add')
+@click.option('--employees', default=0, help='Number of employees to add')
+@click.option('--products', default=0, help='Number of products to add')
+@click.option('--inventory', default=0, help='Number of inventory rows to add')
+@click.option('--employment', default=0,
+              help='Least number of employment rows to add, new stores and employees always get one')
+@click.option('--workers', default=1, help='Processes used to generate data')
+@click.option('--seed', type=int, default=None, help='Seed for reproducible data')
+@click.option('--backend', type=click.Choice(['python', 'numpy']), default='python',
+              help='Generate the biggest tables with numpy instead of python loops')
+@distribution_options
+def growdb(stores, employees, products, inventory, employment, workers, seed, backend, **distributions):
+    '''Add randomly generated rows to the database without rebuilding it'''
+    with get_db() as conn:
+        datagenerator.grow_tables_db(conn, stores=stores, employees=employees, products=products,
+                                     inventory=inventory, employment=employment, verbosity=1,
+                                     chunksize=datagenerator.CHUNK_SIZE, seed=seed,
+                                     workers=workers, backend=backend,
+                                     distributions=distributions)
+
+@app.cli.command('import')
+@click.argument('table', type=click.Choice(sorted(importer.TABLES)))
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=None, type=int, help='Rows checked and copied at a time')
+@click.option('--strict', is_flag=True, help='Import nothing if any row has an error')
+def import_table(table, file, chunk_size, strict):
+    '''Import a csv file of employees, products or inventory rows'''
+    # newline='' as the csv module wants, quoted fields can hold line breaks
+    with get_db() as conn, open(file, encoding='utf-8-sig', newline='') as f:
+        try:
+            report = importer.import_csv(conn, table, f, strict=strict,
+                                         chunk_size=chunk_size or app.config['IMPORT_CHUNK_SIZE'])
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    for line, message in report['errors']:
+        print('line {}: {}'.format(line, message))
+    print('Imported {} of {} {} rows in {:.2f}s ({:.0f} rows/s)'.format(
+        report['imported'], report['rows'], table, report['seconds'],
+        report['rows'] / report['seconds'] if report['seconds'] else 0))
+
+@app.cli.group('snapshot')
+def snapshot():
+    '''Save and restore generated datasets'''
+
+@snapshot.command('save')
+@click.argument('name')
+@click.option('--template', is_flag=True,
+              help='Also keep the database as a template database for instant restores')
+@click.option('--force', is_flag=True, help='Overwrite an existing snapshot')
+def snapshot_save(name, template, force):
+    '''Save the current database as snapshot NAME'''
+    # CREATE DATABASE ... TEMPLATE fails while we are connected ourselves
+    db.engine.dispose()
+    snapshots.save_snapshot(app.config['PSYCOPG2_LOGIN_INFO'], name,
+                            template=template, force=force, verbosity=1)
+
+@snapshot.command('restore')
+@click.argument('name')
+@click.option('--workers', default=4, help='Tables loaded at once')
+@click.option('--template/--no-template', default=None,
+              help='Clone the template database instead of loading files, '
+                   'by default whenever the snapshot has one')
+@click.option('--force', is_flag=True, help='Restore even if the schema changed since the snapshot')
+def snapshot_restore(name, workers, template, force):
+    '''Replace the database by snapshot NAME'''
+    def setup(conn):
+        with conn, conn.cursor() as cur:
+            execute_file(cur, 'schema.sql')
+            execute_file(cur, 'stored_procedures.sql')
+
+        # Only the tables, their rows (admin role included) come from the snapshot
+        db.create_all()
+
+    def finish(conn):
+        with conn.cursor() as cur:
+            execute_file(cur, 'indexes.sql')
+            execute_file(cur, 'rollups.sql')
+            execute_file(cur, 'notifications.sql')
+
+    db.engine.dispose()
+    snapshots.restore_snapshot(app.config['PSYCOPG2_LOGIN_INFO'], name, setup=setup,
+                               finish=finish, workers=workers, template=template,
+                               force=force, verbosity=1)
+
+@snapshot.command('list')
+def snapshot_list():
+    '''List the saved snapshots'''
+    for manifest in snapshots.list_snapshots():
+        rows = sum(table['rows'] for table in manifest['tables'])
+        print('{name:<20} scale {scale!s:<8} seed {seed!s:<12} {rows:>10} rows  {created}{marker}'.format(
+            rows=rows, marker='  (template)' if manifest['template'] else '', **manifest))
+
+@app.cli.command('benchprocs')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--samples', default=20, help='Argument values tried per procedure')
+@click.option('--repeat', default=3, help='Runs per procedure, the best one counts')
+@click.option('--seed', type=int, default=0, help='Seed for sampling the arguments')
+def benchprocs(files, samples, repeat, seed):
+    '''Time the averages and counts against the versions in FILES'''
+    procbench.benchmark_procedures(app.config['PSYCOPG2_LOGIN_INFO'], files,
+                                   samples=samples, repeat=repeat, seed=seed)
+
+@app.cli.command('benchqueries')
+@click.option('--samples', default=20, help='Argument values tried per query')
+@click.option('--repeat', default=3, help='Runs per query, the best one counts')
+@click.option('--seed', type=int, default=0, help='Seed for sampling the arguments')
+def benchqueries(samples, repeat, seed):
+    '''Time the filter page queries with literal values against prepared statements'''
+    procbench.benchmark_queries(app.config['PSYCOPG2_LOGIN_INFO'],
+                                samples=samples, repeat=repeat, seed=seed)
+
+@app.cli.command('benchinvalidation')
+@click.option('--workers', default=4, help='Worker processes with a page cache')
+@click.option('--writes', default=50, help='Writes committed, each should clear every cache')
+@click.option('--seed', type=int, default=0, help='Seed for picking the rows written')
+def benchinvalidation(workers, writes, seed):
+    '''Time how long writes take to clear the page caches of other workers'''
+    procbench.benchmark_invalidation(app.config['PSYCOPG2_LOGIN_INFO'], workers=workers,
+                                     rounds=writes, seed=seed)
+
+@app.cli.command('benchinserts')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=4, help='Concurrent writers')
+@click.option('--inserts', default=500, help='Calls per writer')
+@click.option('--seed', type=int, default=0, help='Seed for picking stores and managers')
+def benchinserts(files, workers, inserts, seed):
+    '''Time createEmp, createNewProd and addStore called by concurrent writers'''
+    procbench.benchmark_inserts(app.config['PSYCOPG2_LOGIN_INFO'], files, workers=workers,
+                                inserts=inserts, seed=seed)
 
 @app.cli.command('dbusertest')
 def dbusertest():
@@ -240,7 +424,8 @@ def users_page():
 def createNewStore():
     form = forms.StoreCreateForm(request.form)
     if request.method == 'POST' and form.validate():
-        return redirect('/stores')
+        # Show the new store
+        return redirect(url_for('stores_page', filterType='1', filterVal=form.created))
 
     return render_template(
         'createStore.html',
@@ -260,65 +445,107 @@ def deleteStore():
     )
 
 
+# Filter form choices, as (label shown, filter type of the *_page_data procedures)
+LOCATION_FILTERS = {
+    '1': ('Store ID', 'store'),
+    '2': ('Zip', 'zip'),
+    '3': ('City', 'city'),
+    '4': ('State', 'state'),
+}
+PRODUCT_FILTERS = dict(LOCATION_FILTERS, **{
+    '1': ('Store', 'store'),
+    '5': ('Color', 'color'),
+})
+
+def page_filter(form, filters):
+    '''Get (filType, filVal, filter type, filter value) from a filter form
+
+    The filter comes posted by the form or, on the next and previous page
+    links, in the URL.
+    '''
+    if 'filterType' in request.values and form.validate():
+        ftype = request.values.get('filterType')
+        fval  = request.values.get('filterVal')
+        if ftype in filters:
+            label, filter_type = filters[ftype]
+            return label, fval, filter_type, fval
+    return 'None', 'ALL', None, None
+
+def page_cursor(name, key):
+    '''The key in the after or before cursor of the URL, None if there is none
+
+    Cursors are the key values joined by '-', a garbled one counts as none,
+    as does one with a value the INT key columns can't hold.
+    '''
+    try:
+        cursor = tuple(int(value) for value in request.args.get(name, '').split('-'))
+    except ValueError:
+        return None
+    if any(not queries.INT_MIN <= value <= queries.INT_MAX for value in cursor):
+        return None
+    return cursor if len(cursor) == len(key) else None
+
+def page_args(table):
+    '''Get (after, before, page size) for a table's page from the URL'''
+    size = request.args.get('size', app.config['PAGE_SIZE'], type=int)
+    size = max(1, min(size, app.config['MAX_PAGE_SIZE']))
+    return page_cursor('after', table.page_key), page_cursor('before', table.page_key), size
+
+def filter_args():
+    '''The filter shown, as URL arguments for links to more of the table'''
+    if 'filterType' not in request.values:
+        return {}
+    return {'filterType': request.values.get('filterType'),
+            'filterVal': request.values.get('filterVal')}
+
+def page_links(pages, size, everything):
+    '''URLs of the previous and next pages and of everything (an endpoint)
+
+    The filter shown is carried along.
+    '''
+    args = filter_args()
+    links = {'all': url_for(everything, **args)}
+    if size != app.config['PAGE_SIZE']:
+        args['size'] = size
+    for name, cursor in (('previous', 'before'), ('next', 'after')):
+        key = pages[name]
+        links[name] = None if key is None else url_for(
+            request.endpoint, **dict(args, **{cursor: '-'.join(str(value) for value in key)}))
+    return links
+
+def stream_template(template_name, **context):
+    '''Render a template while the response is sent
+
+    Parts the template loops over (see tables.stream_table) go out as they
+    are produced, on the request's connection.
+    '''
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.stream(context)))
+
+def table_stream(table, form, filters, title, page):
+    '''Stream the whole of a filtered table, page is the endpoint of its pages'''
+    filType, filVal, ftype, fval = page_filter(form, filters)
+    return stream_template(
+        'fulltable.html',
+        title=title,
+        filType=filType,
+        filVal=filVal,
+        pagesUrl=url_for(page, **filter_args()),
+        table=tables.stream_table(table, ftype, fval, app.config['STREAM_BATCH_SIZE'])
+    )
+
 @app.route('/stores', methods=['GET','POST'])
 @login_required
 def stores_page():
 
-    # Generate the stores table
-    storesTable = tables.StoresTable(tables.StoresTable.getStores())
-    form = forms.StoreFilterForm(request.form)
-    avg_sal= tables.StoresTable.getAvgSalAll()
-    avg_hrly = tables.StoresTable.getAvgHrlyAll()
-    numEmps = tables.StoresTable.getNumEmps()
-
-    filType='None'
-    filVal='ALL'
-
-    # Process the form if sent
-    if request.method == 'POST' and form.validate():
-        ftype = request.form.get('filterType')
-        fval  = request.form.get('filterVal')
-
-        if ftype == '1':    # By store
-
-            filType='Store ID'
-            filVal=fval
-
-            storesTable = tables.StoresTable(tables.StoresTable.getStoresID(fval))  # Generate table with sid matching fval
-            avg_sal  = tables.StoresTable.getAvgSalStore(fval)
-            avg_hrly = tables.StoresTable.getAvgHrlyStore(fval)
-            numEmps  = tables.StoresTable.getNumEmpsStore(fval)
-
-        elif ftype == '2':  # By zip
-
-            filType='Zip'
-            filVal=fval
-
-            storesTable = tables.StoresTable(tables.StoresTable.getStoresZip(fval))
-            avg_sal  = tables.StoresTable.getAvgSalZip(fval)
-            avg_hrly = tables.StoresTable.getAvgHrlyZip(fval)
-            numEmps  = tables.StoresTable.getNumEmpsZip(fval)
-
-        elif ftype == '3':  # By city
-            
-            filType='City'
-            filVal=fval
-
-            storesTable = tables.StoresTable(tables.StoresTable.getStoresCity(fval))
-            avg_sal  = tables.StoresTable.getAvgSalCity(fval)
-            avg_hrly = tables.StoresTable.getAvgHrlyCity(fval)
-            numEmps  = tables.StoresTable.getNumEmpsCity(fval)
-
-        elif ftype == '4':  # By state
-            
-            filType='State'
-            filVal=fval
-
-            storesTable = tables.StoresTable(tables.StoresTable.getStoresState(fval))
-            avg_sal  = tables.StoresTable.getAvgSalState(fval)
-            avg_hrly = tables.StoresTable.getAvgHrlyState(fval)
-            numEmps  = tables.StoresTable.getNumEmpsState(fval)
-
+    # Process the form if sent, a page of the table and analytics come in one query
+    form = forms.StoreFilterForm(request.values)
+    filType, filVal, ftype, fval = page_filter(form, LOCATION_FILTERS)
+    after, before, size = page_args(tables.StoresTable)
+    rows, avg_sal, avg_hrly, numEmps, pages = tables.StoresTable.getPageData(
+        ftype, fval, after, before, size)
+    storesTable = tables.StoresTable(rows)
 
     return render_template(
         'stores.html',
@@ -326,17 +553,26 @@ def stores_page():
         filType=filType,
         filVal=filVal,
         storesTable=storesTable,
+        pages=page_links(pages, size, 'stores_all'),
         avg_sal=avg_sal,
         avg_hrly=avg_hrly,
         numEmps=numEmps
     )
 
+@app.route('/stores/all')
+@login_required
+def stores_all():
+    form = forms.StoreFilterForm(request.values)
+    return table_stream(tables.StoresTable, form, LOCATION_FILTERS, 'Stores', 'stores_page')
+
 @app.route('/createEmployee', methods=['GET','POST'])
 @login_required
 def createEmployee():
     cform = forms.EmpCreateForm(request.form, csrf_enabled=True)
     if request.method == 'POST' and cform.validate():
-        return redirect('/employees')
+        # The employees of their store, from the new one on
+        return redirect(url_for('employees_page', filterType='1', filterVal=cform.sid.data,
+                                after='{}-0'.format(cform.created)))
 
     # otherwise reprint the form
     return render_template(
@@ -366,61 +602,13 @@ def employees_page():
     avg_sal_str = 'Average Salary Pay:'
     avg_hourly_str = 'Average Hourly Pay:'
 
-    filType = 'None'
-    filVal = 'ALL'
-
-    # ADD LOGIC BASED ON FORM HERE
-    avg_sal= tables.EmpTable.getAvgSalAll()
-    avg_hrly = tables.EmpTable.getAvgHrlyAll()
-    
-    # Define the table itself
-    empTable = tables.EmpTable(tables.EmpTable.getEmployees())
-
-    form = forms.EmployeeFilterForm(request.form)
-
-    # Evaluate the form
-    if request.method == 'POST' and form.validate():
-
-        ftype = request.form.get('filterType')
-        fval = request.form.get('filterVal')
+    # Evaluate the form, a page of the table and averages come in one query
+    form = forms.EmployeeFilterForm(request.values)
+    filType, filVal, ftype, fval = page_filter(form, LOCATION_FILTERS)
+    after, before, size = page_args(tables.EmpTable)
+    rows, avg_sal, avg_hrly, pages = tables.EmpTable.getPageData(ftype, fval, after, before, size)
+    empTable = tables.EmpTable(rows)
 
-        if ftype == '1':  # Store
-            
-            filType = 'Store ID'
-            filVal = fval
-
-            empTable = tables.EmpTable(tables.EmpTable.getEmployeesStore(fval))
-            avg_sal = tables.EmpTable.getAvgSalStore(fval)
-            avg_hrly = tables.EmpTable.getAvgHrlyStore(fval)
-
-        elif ftype == '2':  # Zip
-
-            filType = 'Zip'
-            filVal = fval
-
-            empTable = tables.EmpTable(tables.EmpTable.getEmployeesZip(fval))
-            avg_sal = tables.EmpTable.getAvgSalZip(fval)
-            avg_hrly = tables.EmpTable.getAvgHrlyZip(fval)
-
-        elif ftype == '3':  # City
-
-            filType = 'City'
-            filVal = fval
-
-            empTable = tables.EmpTable(tables.EmpTable.getEmployeesCity(fval))
-            avg_sal = tables.EmpTable.getAvgSalCity(fval)
-            avg_hrly = tables.EmpTable.getAvgHrlyCity(fval)
-
-        elif ftype == '4': # State
-
-            filType = 'State'
-            filVal = fval
-
-            empTable = tables.EmpTable(tables.EmpTable.getEmployeesState(fval))
-            avg_sal = tables.EmpTable.getAvgSalState(fval)
-            avg_hrly = tables.EmpTable.getAvgHrlyState(fval)
-
-    
     return render_template(
         'employees.html',
         form=form,
@@ -429,16 +617,25 @@ def employees_page():
         avg_sal_str=avg_sal_str,
         avg_hourly_str=avg_hourly_str,
         empTable=empTable,
+        pages=page_links(pages, size, 'employees_all'),
         avg_sal=avg_sal,
         avg_hrly=avg_hrly
     )
 
+@app.route('/employees/all')
+@login_required
+def employees_all():
+    form = forms.EmployeeFilterForm(request.values)
+    return table_stream(tables.EmpTable, form, LOCATION_FILTERS, 'Employees', 'employees_page')
+
 @app.route('/createProduct', methods=['POST','GET'])
 @login_required
 def createProduct():
     form = forms.ProdCreateForm(request.form)
     if request.method == "POST" and form.validate():
-        return redirect('/products')
+        # The products of its store, from the new one on
+        return redirect(url_for('products_page', filterType='1', filterVal=form.sid.data,
+                                after='{}-0'.format(form.created)))
 
     return render_template(
         '/createProduct.html',
@@ -469,75 +666,31 @@ def addExistingProduct():
         form=form
     )
 
-@app.route('/products', methods=['GET','POST'])
+@app.route('/repriceProducts', methods=['GET','POST'])
 @login_required
-def products_page():
-
-    # Generate the table with ALL products
-    productsTable = tables.ProductsTable(tables.ProductsTable.getProducts())
-    avgPrice = tables.ProductsTable.getAvgPrice()
-    numProducts = tables.ProductsTable.getNumProducts()
-    numSale = tables.ProductsTable.getNumSale()
-
-    filType = 'None'
-    filVal = 'ALL'
-
-    form = forms.ProductFilterForm(request.form)
-    
-    # Evaluate the form
+def repriceProducts():
+    form = forms.RepriceForm(request.form)
+    changed = None
     if request.method == 'POST' and form.validate():
-        ftype = request.form.get('filterType')
-        fval  = request.form.get('filterVal')
-
-        if ftype == '1':  # Store
-            
-            filType = 'Store'
-            filVal = fval
-
-            productsTable = tables.ProductsTable(tables.ProductsTable.getProductsStore(fval))
-            avgPrice = tables.ProductsTable.getAvgPriceStore(fval)
-            numProducts = tables.ProductsTable.getNumProductsStore(fval)
-            numSale = tables.ProductsTable.getNumSaleStore(fval)
-
-        elif ftype == '2':  # Zip
+        changed = form.changed
 
-            filType = 'Zip'
-            filVal = fval
-
-            productsTable = tables.ProductsTable(tables.ProductsTable.getProductsZip(fval))
-            avgPrice = tables.ProductsTable.getAvgPriceZip(fval)
-            numProducts = tables.ProductsTable.getNumProductsZip(fval)
-            numSale = tables.ProductsTable.getNumSaleZip(fval)
-
-        elif ftype == '3':  # City
-
-            filType = 'City'
-            filVal = fval
-
-            productsTable = tables.ProductsTable(tables.ProductsTable.getProductsCity(fval))
-            avgPrice = tables.ProductsTable.getAvgPriceCity(fval)
-            numProducts = tables.ProductsTable.getNumProductsCity(fval)
-            numSale = tables.ProductsTable.getNumSaleCity(fval)
-
-        elif ftype == '4':  # State
-
-            filType = 'State'
-            filVal = fval
-
-            productsTable = tables.ProductsTable(tables.ProductsTable.getProductsState(fval))
-            avgPrice = tables.ProductsTable.getAvgPriceState(fval)
-            numProducts = tables.ProductsTable.getNumProductsState(fval)
-            numSale = tables.ProductsTable.getNumSaleState(fval)
-
-        elif ftype == '5':  # Color
+    return render_template(
+        'repriceProducts.html',
+        form=form,
+        changed=changed
+    )
 
-            filType = 'Color'
-            filVal = fval
+@app.route('/products', methods=['GET','POST'])
+@login_required
+def products_page():
 
-            productsTable = tables.ProductsTable(tables.ProductsTable.getProductsColor(fval))
-            avgPrice = tables.ProductsTable.getAvgPriceColor(fval)
-            numProducts = tables.ProductsTable.getNumProductsColor(fval)
-            numSale = tables.ProductsTable.getNumSaleColor(fval)
+    # Evaluate the form, a page of the table and statistics come in one query
+    form = forms.ProductFilterForm(request.values)
+    filType, filVal, ftype, fval = page_filter(form, PRODUCT_FILTERS)
+    after, before, size = page_args(tables.ProductsTable)
+    rows, avgPrice, numProducts, numSale, pages = tables.ProductsTable.getPageData(
+        ftype, fval, after, before, size)
+    productsTable = tables.ProductsTable(rows)
 
     return render_template(
         'products.html',
@@ -545,11 +698,18 @@ def products_page():
         filType=filType,
         filVal=filVal,
         productsTable=productsTable,
+        pages=page_links(pages, size, 'products_all'),
         avgPrice=avgPrice,
         numProducts=numProducts,
         numSale=numSale
     ) # Add custom vals
 
+@app.route('/products/all')
+@login_required
+def products_all():
+    form = forms.ProductFilterForm(request.values)
+    return table_stream(tables.ProductsTable, form, PRODUCT_FILTERS, 'Products', 'products_page')
+
 
 
 @app.route('/testing',methods=['GET','POST'])
@@ -570,6 +730,89 @@ def testing():
         form=form
     )
 
+@app.route('/batch', methods=['POST'])
+@login_required
+def batch():
+    '''Apply many form edits in one transaction
+
+    Takes JSON {"edits": [{"form": "createEmployee", "fields": {...}}, ...]}
+    with the forms named as their pages and their fields as the forms post
+    them. Either every edit is applied, in order, with one commit, or none
+    is: the answer is {"applied": n, "created": [new id or null per edit],
+    "changed": [rows repriced or null per edit]}, or a 400 with the errors
+    of each edit.
+    '''
+    body = request.get_json(silent=True) or {}
+    edits = body.get('edits') if isinstance(body, dict) else None
+    if not isinstance(edits, list) or not edits:
+        return jsonify(error='Expected {"edits": [...]}'), 400
+    if len(edits) > app.config['BATCH_MAX_EDITS']:
+        return jsonify(error='At most {} edits per batch'.format(app.config['BATCH_MAX_EDITS'])), 400
+    for edit in edits:
+        if (not isinstance(edit, dict) or edit.get('form') not in forms.BATCH_FORMS
+                or not isinstance(edit.get('fields', {}), dict)):
+            return jsonify(error='Every edit needs a form, one of {}, and its fields'.format(
+                ', '.join(sorted(forms.BATCH_FORMS)))), 400
+
+    batch, applied = forms.apply_batch([(edit['form'], edit.get('fields', {})) for edit in edits])
+    if not applied:
+        return jsonify(applied=0, errors=[form.errors for form in batch]), 400
+    return jsonify(applied=len(batch), created=[getattr(form, 'created', None) for form in batch],
+                   changed=[getattr(form, 'changed', None) for form in batch])
+
+@app.route('/import/<table>', methods=['POST'])
+@login_required
+def import_table_upload(table):
+    '''Import an uploaded csv file of employees, products or inventory rows
+
+    The file is posted as the "file" field, ?strict=1 imports nothing if any
+    row has an error. Answers with the report of importer.import_csv, the
+    errors as {"line", "error"} and at most IMPORT_MAX_ERRORS of them.
+    '''
+    if table not in importer.TABLES:
+        abort(404)
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify(error='Expected a csv file in the "file" field'), 400
+
+    # Staged and merged on the request's connection, in one transaction
+    conn = queries.request_connection().connection
+    try:
+        report = importer.import_csv(conn, table,
+                                     io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''),
+                                     chunk_size=app.config['IMPORT_CHUNK_SIZE'],
+                                     strict=request.args.get('strict') == '1',
+                                     max_errors=app.config['IMPORT_MAX_ERRORS'])
+        conn.commit()
+    except ValueError as e:
+        conn.rollback()
+        return jsonify(error=str(e)), 400
+    except BaseException:
+        conn.rollback()
+        raise
+
+    if report['imported']:
+        cache.invalidate(*importer.TABLES[table]['families'])
+    report['errors'] = [{'line': line, 'error': message} for line, message in report['errors']]
+    return jsonify(report), 400 if report['failed'] and not report['imported'] else 200
+
+@app.route('/poolstats')
+@login_required
+def pool_stats():
+    '''Connection pool state and counters of the worker serving this request'''
+    return jsonify(queries.pool_stats())
+
+@app.route('/cachestats')
+@login_required
+def cache_stats():
+    '''Page cache counters of the worker serving this request'''
+    return jsonify(cache.cache_stats())
+
+@app.errorhandler(queries.QueryTimeout)
+def page_timeout(error):
+    '''The query of a page ran out of time, the database is too busy'''
+    return 'The database is busy, try again shortly.', 503
+
 @app.route('/acknowledgements', methods=['GET'])
 def acknowledgements():
     return render_template('acknowledgements.html')
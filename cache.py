@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+'''
+Read-through cache of query results
+
+The filter pages ask for the same rows and aggregates over and over while
+the data only changes when a form writes. Results are kept here under their
+query and arguments, for at most CACHE_TTL seconds and CACHE_MAX_ENTRIES
+entries (the least recently used go first).
+
+Every entry lists the entity families it was read from: 'stores',
+'employees' and 'products'. A form that writes invalidates the families it
+changed, dropping the entries that read them and nothing else.
+
+The cache belongs to the process, every worker has one of its own. Writes
+made by other workers, or straight in SQL, reach it through the triggers of
+notifications.sql: a listener thread in each worker drops the families of
+the tables the notifications name. While the listener is not connected
+nothing gets cached.
+'''
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+log = logging.getLogger(__name__)
+
+# Entity families results can be read from and writes can change
+FAMILIES = ('stores', 'employees', 'products')
+
+# key -> (expiry time, families, value), least recently used first
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+
+# Bumped by invalidate, a result loaded while one of its families changed
+# isn't cached
+GENERATIONS = {family: 0 for family in FAMILIES}
+
+CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,     # entries dropped to stay under MAX_ENTRIES
+    'expirations': 0,   # entries found older than TTL
+    'invalidations': 0, # entries dropped by writes
+    'notifications': 0, # changes notified by the database
+    'notify_lag_total': 0.0,    # seconds from the changes to their notifications
+    'notify_lag_max': 0.0,
+}
+
+# Set by init_app from CACHE_TTL and CACHE_MAX_ENTRIES, nothing is cached
+# while MAX_ENTRIES is 0
+TTL = 60
+MAX_ENTRIES = 0
+
+# psycopg2.connect arguments of the listener, None when not listening (set
+# from CACHE_LISTEN by init_app)
+LISTEN_LOGIN = None
+
+def init_app(app):
+    '''Size the cache as configured for app'''
+    global TTL, MAX_ENTRIES, LISTEN_LOGIN
+    TTL = app.config.get('CACHE_TTL', TTL)
+    MAX_ENTRIES = app.config.get('CACHE_MAX_ENTRIES', MAX_ENTRIES)
+    if app.config.get('CACHE_LISTEN', False):
+        LISTEN_LOGIN = app.config['PSYCOPG2_LOGIN_INFO']
+
+def cached(key, families, load):
+    '''The value cached under key, or load() which gets cached
+
+    families are the entity families load reads. key must be hashable and
+    the value must not be changed by whoever gets it, it is shared.
+    '''
+    if LISTEN_LOGIN is not None and LISTENER['pid'] != os.getpid():
+        start_listener(LISTEN_LOGIN)
+
+    now = time.time()
+    with CACHE_LOCK:
+        entry = CACHE.get(key)
+        if entry is not None and entry[0] > now:
+            CACHE.move_to_end(key)
+            CACHE_STATS['hits'] += 1
+            return entry[2]
+
+        if entry is not None:
+            del CACHE[key]
+            CACHE_STATS['expirations'] += 1
+        CACHE_STATS['misses'] += 1
+        generations = [GENERATIONS[family] for family in families]
+
+    # Queries run without the lock, two requests may load the same key
+    value = load()
+
+    with CACHE_LOCK:
+        listening = LISTEN_LOGIN is None or LISTENER['connected']
+        if MAX_ENTRIES and listening and generations == [GENERATIONS[family] for family in families]:
+            CACHE[key] = (now + TTL, frozenset(families), value)
+            CACHE.move_to_end(key)
+            while len(CACHE) > MAX_ENTRIES:
+                CACHE.popitem(last=False)
+                CACHE_STATS['evictions'] += 1
+    return value
+
+def invalidate(*families):
+    '''Drop every cached result read from any of families'''
+    with CACHE_LOCK:
+        for family in families:
+            GENERATIONS[family] += 1
+        stale = [key for key, entry in CACHE.items() if entry[1].intersection(families)]
+        for key in stale:
+            del CACHE[key]
+        CACHE_STATS['invalidations'] += len(stale)
+
+def cache_stats():
+    '''Counters of this process and how full the cache is'''
+    with CACHE_LOCK:
+        stats = dict(CACHE_STATS)
+        stats['entries'] = len(CACHE)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    stats['notify_lag_avg'] = (stats.pop('notify_lag_total') / stats['notifications']
+                               if stats['notifications'] else 0.0)
+    stats['max_entries'] = MAX_ENTRIES
+    stats['ttl'] = TTL
+    stats['listening'] = LISTEN_LOGIN is not None and LISTENER['connected']
+    return stats
+
+#============================ Change notifications ============================#
+
+# Channel of the notifications.sql triggers, and the families changes to
+# each table belong to. Deleting a store notifies the Employment and
+# Inventory rows the cascade takes with it too.
+CHANNEL = 'silkroad_changes'
+TABLE_FAMILIES = {
+    'stores': ('stores',),
+    'employees': ('employees',),
+    'employment': ('employees',),
+    'products': ('products',),
+    'inventory': ('products',),
+}
+
+# Seconds between reconnection attempts, and between checks that the
+# connection is still there while nothing is notified
+RECONNECT_DELAY = 5
+LISTEN_TIMEOUT = 60
+
+# Process the listener runs in (a forked worker needs its own) and whether it
+# is connected
+LISTENER = {'pid': None, 'connected': False}
+
+def start_listener(login):
+    '''Start listening for changes in this process, in a daemon thread'''
+    with CACHE_LOCK:
+        if LISTENER['pid'] == os.getpid():
+            return
+        LISTENER['pid'] = os.getpid()
+        LISTENER['connected'] = False
+    thread = threading.Thread(target=listen, args=(login,), name='cache-listener')
+    thread.daemon = True
+    thread.start()
+
+def notified(payload):
+    '''Drop the families changed by the notification with payload'''
+    change = json.loads(payload)
+    invalidate(*TABLE_FAMILIES.get(change['table'], ()))
+    lag = max(time.time() - change['at'], 0.0)
+    with CACHE_LOCK:
+        CACHE_STATS['notifications'] += 1
+        CACHE_STATS['notify_lag_total'] += lag
+        CACHE_STATS['notify_lag_max'] = max(CACHE_STATS['notify_lag_max'], lag)
+
+def listen(login):
+    '''Handle the notifications on CHANNEL, reconnecting whenever they stop'''
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**login)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('LISTEN {}'.format(CHANNEL))
+
+            # Whatever changed while nobody was listening is lost
+            invalidate(*FAMILIES)
+            LISTENER['connected'] = True
+
+            while True:
+                if select.select([conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT 1')
+                conn.poll()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    try:
+                        notified(payload)
+                    except Exception:
+                        # Anyone can NOTIFY the channel, what changed is unknown
+                        log.warning('Bad change notification %r, dropping the cache', payload,
+                                    exc_info=True)
+                        invalidate(*FAMILIES)
+        except Exception:
+            # Whatever went wrong, the thread has to keep going or this worker
+            # stops caching for good
+            log.warning('Change notification listener lost its connection, reconnecting in %ss',
+                        RECONNECT_DELAY, exc_info=True)
+        finally:
+            LISTENER['connected'] = False
+            if conn is not None:
+                conn.close()
+        time.sleep(RECONNECT_DELAY)
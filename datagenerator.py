@@ -11,86 +11,195 @@ initializing a DB. This gives some example data to work with for demonstrative
 purposes.
 
 '''
+import base64
+import bisect
 import decimal
+import functools
+import hashlib
+import hmac
 import random
 import os, os.path
 import sys
 import csv
+import io
 import itertools
+import json
+import time
+import argparse
+import collections
+import multiprocessing
 from collections import OrderedDict
 
-from passlib.hash import bcrypt_sha256
+from passlib.hash import bcrypt, bcrypt_sha256
+
+# numpy is only needed for the vectorized backend
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 THIS_FILE_PATH = os.path.dirname(os.path.realpath(__file__))
 
 #================================= Generators =================================#
 
-def random_choice_gen(seq):
+# Every generator takes an optional rng, anything with the random.Random
+# interface. It defaults to the global random module; the sharded generator
+# passes a seeded random.Random per shard to make its output reproducible.
+
+def random_choice_gen(seq, rng=random):
     while True:
-        yield random.choice(seq)
+        yield rng.choice(seq)
 
-# Generate random first name
-def fname_gen():
-    # A list of sort random firstnames
-    fnames = ['Bob','Ross','Robert','Sally','Alice','Jake','Ian','Kevin',
-              'Brad','Steven','Charles','Ashley','John','James','Jacob','Mark',
-              'Michael','Edward','Donald','Zachary','Sean','Blake','Jennifer',
-              'Sarah','Yao','Brandon','Albert']
-    return random_choice_gen(fnames)
+#=============================== Distributions ================================#
+
+# Foreign keys, and the city of a store, are drawn uniformly by default. To
+# test against realistic hot spots they can instead follow a skewed
+# distribution, given as a spec string:
+#
+#   'uniform'           every value equally likely
+#   'zipf:S'            the k-th value is drawn with weight 1/k**S
+#   'hot:FRAC:PROB'     the first FRAC of the values get PROB of the draws
+#
+# Skew always favours the start of the sequence, so with ids store 1 is the
+# biggest store and product 1 the best seller.
 
+UNIFORM = 'uniform'
 
-# Generate random last name
-def lname_gen():
-    # A list of some random last names
-    lnames = ['Johnson','Smith','Williams','Brown','Jackson','Ming','Zhang',
+@functools.lru_cache()
+def parse_distribution(spec):
+    '''parse_distribution('zipf:1.2') -> ('zipf', 1.2)
+
+    Raises ValueError for a malformed spec
+    '''
+    kind, *params = spec.split(':')
+    try:
+        params = tuple(float(param) for param in params)
+    except ValueError:
+        raise ValueError('Bad parameters in distribution {!r}'.format(spec))
+
+    if kind == 'uniform' and not params:
+        return (kind,)
+    if kind == 'zipf' and len(params) == 1 and params[0] > 0:
+        return (kind,) + params
+    if kind == 'hot' and len(params) == 2 and 0 < params[0] <= 1 and 0 <= params[1] <= 1:
+        return (kind,) + params
+
+    raise ValueError('Unknown distribution {!r}, expected uniform, zipf:S '
+                     'or hot:FRAC:PROB'.format(spec))
+
+@functools.lru_cache(maxsize=16)
+def zipf_cum_weights(s, n):
+    return list(itertools.accumulate(1 / k**s for k in range(1, n+1)))
+
+def hot_size(frac, n):
+    '''Number of values in the hot set, at least one'''
+    return min(n, max(1, int(round(frac * n))))
+
+def sampler(seq, dist=UNIFORM, rng=random):
+    '''sampler(seq, dist, rng) -> function drawing one value of seq'''
+    dist = parse_distribution(dist)
+    n = len(seq)
+    if dist[0] == 'zipf':
+        cum_weights = zipf_cum_weights(dist[1], n)
+        total = cum_weights[-1]
+        return lambda: seq[min(bisect.bisect(cum_weights, rng.random() * total), n-1)]
+
+    if dist[0] == 'hot':
+        hot, prob = hot_size(dist[1], n), dist[2]
+        if hot == n:
+            return functools.partial(rng.choice, seq)
+        return lambda: seq[rng.randrange(hot) if rng.random() < prob else rng.randrange(hot, n)]
+
+    # Plain choice, so uniform data is the same as before distributions existed
+    return functools.partial(rng.choice, seq)
+
+def sample_gen(seq, dist=UNIFORM, rng=random):
+    draw = sampler(seq, dist, rng)
+    while True:
+        yield draw()
+
+# A list of sort random firstnames
+FIRST_NAMES = ['Bob','Ross','Robert','Sally','Alice','Jake','Ian','Kevin',
+               'Brad','Steven','Charles','Ashley','John','James','Jacob','Mark',
+               'Michael','Edward','Donald','Zachary','Sean','Blake','Jennifer',
+               'Sarah','Yao','Brandon','Albert']
+
+# A list of some random last names
+LAST_NAMES = ['Johnson','Smith','Williams','Brown','Jackson','Ming','Zhang',
               'Jefferson','Thomas','Taylor','Moore','Loss','Davis','Garcia',
               'Miller','Jones','Wilson','Less']
-    return random_choice_gen(lnames)
+
+# Generate random first name
+def fname_gen(rng=random):
+    return random_choice_gen(FIRST_NAMES, rng)
+
+
+# Generate random last name
+def lname_gen(rng=random):
+    return random_choice_gen(LAST_NAMES, rng)
 
 # Generate random decimal numbers
-def decimal_gen(min, max, precision):
+def decimal_gen(min, max, precision, rng=random):
     scale = 10**precision
     while True:
-        yield decimal.Decimal(random.randint(min*scale, max*scale)) / scale
+        yield decimal.Decimal(rng.randint(min*scale, max*scale)) / scale
 
 # Generates random bools
-def bool_gen():
+def bool_gen(rng=random):
     while True:
-        yield bool(random.getrandbits(1))
+        yield bool(rng.getrandbits(1))
 
 # Generate usernames
-def uname_gen():
+def uname_gen(rng=random):
     # A list of awful usernames I made up just now
     unames = ['dragonslayer','bargainhunter','salessearcher','genericcust1',
               'magnumdragon','shroud','xgod','taz','mark','milkman',
               'masterblaster','thunderous','fireknight','shovelfighter']
 
-    for name in random_choice_gen(unames):
-        yield name + str(random.randint(10,100))
+    for name in random_choice_gen(unames, rng):
+        yield name, name + str(rng.randint(10,100))
+
+# Generate usernames that are never repeated
+def unique_uname_gen(rng=random):
+    # uname_gen only has about 14*91 names to give. Once one of those has been
+    # handed out, later draws of it get the base name plus a counter for that
+    # base instead ('mark_1', 'mark_2', ...). The underscore keeps those from
+    # ever matching a drawn name, so only drawn names need remembering and the
+    # set stays small no matter how many names are generated.
+    seen = set()
+    suffixes = collections.Counter()
+    for name, uname in uname_gen(rng):
+        if uname in seen:
+            suffixes[name] += 1
+            uname = '{}_{}'.format(name, suffixes[name])
+        else:
+            seen.add(uname)
+
+        yield uname
 
 
 # Generate passwords
-def pass_gen():
+def pass_gen(rng=random):
     passwords = [ 'Hunter2','__Hunter2','Password','P@$$W0rd','Adm1n',
                   'SodiumB1c4rb0n4t3','Def4ult5']
-    for password in random_choice_gen(passwords):
+    for password in random_choice_gen(passwords, rng):
         yield password
 
 
 # Generate random telephone number
-def telno_gen():
+def telno_gen(rng=random):
     while True:
         # Area code
         # Note: random.randint bounds are inclusive
-        area = str(random.randint(100,999))   # 100 - 999
-        pre  = str(random.randint(100,999))   # 100 - 999
-        last = str(random.randint(1000,9999)) # 1000 - 9999
+        area = str(rng.randint(100,999))   # 100 - 999
+        pre  = str(rng.randint(100,999))   # 100 - 999
+        last = str(rng.randint(1000,9999)) # 1000 - 9999
         telno = area + '-' + pre + '-' + last
         yield telno
 
 
 # Generate random street addresses
-def address_gen():
+def address_gen(rng=random):
     # A list of street types for addresses
     stypes = [ 'Lane','Boulevard','Road','Parkway','Drive','Street','Avenue']
 
@@ -98,29 +207,29 @@ def address_gen():
     snames = [ 'Freedom','Fletcher','Independence','Fowler','Cherry',
                'Applebee','Clark','Kennedy','Bourbon']
     while True:
-        streetno = str(random.randint(100,10000))
-        streetname = random.choice(snames)
-        streetsuff = random.choice(stypes)
+        streetno = str(rng.randint(100,10000))
+        streetname = rng.choice(snames)
+        streetsuff = rng.choice(stypes)
         address = streetno + ' ' + streetname + ' ' + streetsuff
         yield address
 
 # Generate random city
-def city_gen():
+def city_gen(rng=random, dist=UNIFORM):
     # A list of cities
     cities = [('Jacksonville', 'Florida'), ('Tampa', 'Florida'),
               ('New York City', 'New York'), ('Chicago', 'Illinois'),
               ('China', 'Illinois'), ('Atlanta', 'Georgia'),
               ('San Diego', 'California'), ('San Francisco', 'California'),
               ('Carlsbad', 'California')]
-    return random_choice_gen(cities)
+    return sample_gen(cities, dist, rng)
 
 
-def zip_gen():
+def zip_gen(rng=random):
     while True:
-        yield str(random.randint(10000, 99999))
+        yield str(rng.randint(10000, 99999))
 
 # Generate random product name
-def pname_gen():
+def pname_gen(rng=random):
     # A list of products
     products = [ 'Xbox One','Nintendo Switch','Hammer','Wrench','Screwdriver',
                  'Kiddie Pool','Playstation 4','Praystation', 'Sony DVDMax300',
@@ -128,28 +237,67 @@ def pname_gen():
                  'Velcro strips','Rope','Chain (100 feet, 2-inch)','Chainsaw',
                  'Desert Eagle','Gerbil','Chinchilla','German Shepherd',
                  'Goat','Dynamit','Extension Cord (50 feet)']
-    return random_choice_gen(products)
+    return random_choice_gen(products, rng)
 
-def color_gen():
+def color_gen(rng=random):
     colors = ['Red','Blue','Green','White','Black','Brown','Orange','Yellow',
               'Purple','Pink','Teal','Maroon']
-    return random_choice_gen(colors)
+    return random_choice_gen(colors, rng)
 
 #============================== Object Creation ===============================#
 
 # The following functions create n rows for the corresponding relation
-# They return a list of dicts that can be easily passed to csv.DictWriter.writerow
-# Some of the functions require results from a previous function (i.e. reference
-# to another relation)
-
-role_pay_gens = {
-    'Cashier': (decimal_gen(10, 15, 2), True),
-    'Manager': (decimal_gen(20, 25, 2), True),
-    'Stocker': (decimal_gen(15, 20, 2), True),
-    'Human Resources': (decimal_gen(30000, 50000, 2), False),
-    'Information Technology': (decimal_gen(50000, 70000, 2), False)
+# They return a dict holding the field names and the rows as a list of tuples
+# under 'values'. When a chunksize is passed the rows are instead generated
+# lazily, chunksize rows at a time, under 'chunks' so that a table never has
+# to fit in memory. Foreign keys are sampled from id ranges (the generated ids
+# are always 1..n) so no referenced table has to be materialized either.
+
+# Rows per chunk when generating tables lazily
+CHUNK_SIZE = 10000
+
+# Pay range and whether the role is paid hourly
+role_pay_ranges = {
+    'Cashier': (10, 15, True),
+    'Manager': (20, 25, True),
+    'Stocker': (15, 20, True),
+    'Human Resources': (30000, 50000, False),
+    'Information Technology': (50000, 70000, False)
 }
 
+def make_role_pay_gens(rng=random):
+    return {role: (decimal_gen(low, high, 2, rng), hourly)
+            for role, (low, high, hourly) in role_pay_ranges.items()}
+
+role_pay_gens = make_role_pay_gens()
+
+def chunked(rows, size):
+    '''Group an iterable of rows into lists of at most size rows'''
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def table_rows(rows, chunksize=None):
+    '''Either materialize rows or wrap them as a lazy stream of chunks'''
+    if chunksize:
+        return {'chunks': chunked(rows, chunksize)}
+    return {'values': list(rows)}
+
+def iter_chunks(tabledict):
+    '''Iterate over the rows of a table dict one chunk at a time'''
+    if 'column_chunks' in tabledict:
+        return map(np_rows, tabledict['column_chunks'])
+    if 'chunks' in tabledict:
+        return tabledict['chunks']
+    return iter([tabledict['values']])
+
+def iter_rows(tabledict):
+    '''Iterate over the rows of a table dict regardless of how it was made'''
+    return itertools.chain.from_iterable(iter_chunks(tabledict))
+
 def make_roles(n, verbosity=False):
     fields = ('roleid', 'role')
     roles = ['Cashier', 'Manager', 'Stocker', 'Human Resources', 'Information Technology']
@@ -160,63 +308,109 @@ def make_roles(n, verbosity=False):
 
     return {'fields': fields, 'values': values, 'pkey': 'roleid', 'max': max((v[0] for v in values), default=1)}
 
-def make_employees(n, roles, verbosity=False):
-    fields = ('eid', 'firstname', 'lastname', 'roleid', 'pay', 'hourly')
-
-    fnames = fname_gen()
-    lnames = lname_gen()
-    salaries = decimal_gen(40000, 100000, 2)
+def gen_employees(n, roles, verbosity=False, rng=random, start=0, stop=None):
+    fnames = fname_gen(rng)
+    lnames = lname_gen(rng)
+    pay_gens = role_pay_gens if rng is random else make_role_pay_gens(rng)
 
-    employees = []
-    for eid in range(1, n+1):
+    for eid in range(start+1, (n if stop is None else stop)+1):
         if verbosity:
-            sys.stdout.write('\r{}/{} employees'.format(eid, n))
+            sys.stdout.write('\r{}/{} employees'.format(eid - start, n))
 
         fname, lname = map(next, (fnames, lnames))
-        roleid, role = random.choice(roles)
-        pay_gen, hourly = role_pay_gens[role]
-        employees.append((eid, fname, lname, roleid, next(pay_gen), hourly))
+        roleid, role = rng.choice(roles)
+        pay_gen, hourly = pay_gens[role]
+        yield (eid, fname, lname, roleid, next(pay_gen), hourly)
 
     if verbosity:
         print()
 
-    return {'fields': fields, 'values': employees, 'pkey': 'eid', 'max': n}
-
-def make_employment(n, employees, stores, verbosity=False):
-    fields = ('sid', 'eid')
-    employment_list = []
+def make_employees(n, roles, verbosity=False, chunksize=None, seed=None, workers=1, backend='python', offset=0):
+    '''make_employees(n, roles) -> employees table dict
 
-    # Make sure each store has at least one employee
-    for i, store in enumerate(stores):
+    The eids are offset+1..offset+n
+    '''
+    fields = ('eid', 'firstname', 'lastname', 'roleid', 'pay', 'hourly')
+    if backend == 'numpy':
+        table = make_numpy('employees', fields, n, (n, roles), seed, verbosity, chunksize, offset)
+        return dict(table, pkey='eid', max=offset+n)
+
+    if seed is None:
+        rows = gen_employees(n, roles, verbosity, start=offset, stop=offset+n)
+    else:
+        rows = gen_sharded('employees', n, (n, roles), seed, workers, verbosity, offset)
+
+    return dict(table_rows(rows, chunksize), fields=fields, pkey='eid', max=offset+n)
+
+def employment_rows(n, employee_ids, store_ids):
+    '''Number of employment rows generated, at least one per store and employee'''
+    return max(n, len(store_ids) + len(employee_ids))
+
+def gen_employment(n, employee_ids, store_ids, store_dist=UNIFORM, cover_stores=None, cover_employees=None,
+                   verbosity=False, rng=random, start=0, stop=None):
+    # Only the stores and employees in cover_* are guaranteed a row, when
+    # growing a database those are the new ones
+    cover_stores = store_ids if cover_stores is None else cover_stores
+    cover_employees = employee_ids if cover_employees is None else cover_employees
+    total = employment_rows(n, cover_employees, cover_stores)
+    nstores = len(cover_stores)
+    nemployees = len(cover_employees)
+    store = sampler(store_ids, store_dist, rng)
+
+    for k in range(start, total if stop is None else stop):
         if verbosity:
-            sys.stdout.write('\r{}/{} employments'.format(i+1, n))
-
-        eid = random.choice(employees)[0]
-        employment_list.append((store[0], eid))
+            sys.stdout.write('\r{}/{} employments'.format(k+1, total))
+
+        if k < nstores:
+            # Make sure each store has at least one employee
+            yield (cover_stores[k], rng.choice(employee_ids))
+        elif k < nstores + nemployees:
+            # Make sure each employee has at least one store
+            yield (store(), cover_employees[k-nstores])
+        else:
+            # Make the rest of the n relationships
+            yield (store(), rng.choice(employee_ids))
 
-    # Make sure each employee has at least one store
-    for j, employee in enumerate(employees):
-        if verbosity:
-            sys.stdout.write('\r{}/{} employments'.format(i+j+2, n))
+    if verbosity:
+        print()
 
-        sid = random.choice(stores)[0]
-        employment_list.append((sid, employee[0]))
+def make_employment(n, employee_ids, store_ids, verbosity=False, chunksize=None, seed=None, workers=1, backend='python',
+                    store_dist=UNIFORM, cover_stores=None, cover_employees=None):
+    '''make_employment(n, employee_ids, store_ids) -> employment table dict
 
-    # Make the rest of the n relationships
-    for k in range(i+j+2, n+1):
+    employee_ids and store_ids are sequences of valid ids, usually ranges.
+    store_dist is the distribution of stores over the employments, see
+    parse_distribution. Every store in cover_stores and employee in
+    cover_employees (all of them by default) gets at least one employment.
+    '''
+    fields = ('sid', 'eid')
+    cover_stores = store_ids if cover_stores is None else cover_stores
+    cover_employees = employee_ids if cover_employees is None else cover_employees
+    args = (n, employee_ids, store_ids, store_dist, cover_stores, cover_employees)
+    total = employment_rows(n, cover_employees, cover_stores)
+    if backend == 'numpy':
+        return make_numpy('employment', fields, total, args, seed, verbosity, chunksize)
+
+    if seed is None:
+        rows = gen_employment(*args, verbosity=verbosity)
+    else:
+        rows = gen_sharded('employment', total, args, seed, workers, verbosity)
+
+    return dict(table_rows(rows, chunksize), fields=fields)
+
+def gen_stores(n, city_dist=UNIFORM, verbosity=False, rng=random, start=0, stop=None):
+    sids = range(start+1, (n if stop is None else stop)+1)
+    for sid, addr, city_state, zipcode, telno in zip(sids, address_gen(rng), city_gen(rng, city_dist),
+                                                     zip_gen(rng), telno_gen(rng)):
         if verbosity:
-            sys.stdout.write('\r{}/{} employments'.format(k+1, n))
+            sys.stdout.write('\r{}/{} stores'.format(sid - start, n))
 
-        sid = random.choice(stores)[0]
-        eid = random.choice(employees)[0]
-        employment_list.append((sid, eid))
+        yield (sid, addr, city_state[0], city_state[1], zipcode, telno)
 
     if verbosity:
         print()
 
-    return {'fields': fields, 'values': employment_list}
-
-def make_stores(n, verbosity=False):
+def make_stores(n, verbosity=False, chunksize=None, seed=None, workers=1, city_dist=UNIFORM, offset=0):
     '''make_stores(n) -> list of store dicts
 
     The keys are:
@@ -227,23 +421,35 @@ def make_stores(n, verbosity=False):
     city = city the store is in
     state = state the store is in
     telno = telephone number of the store
+
+    city_dist is the distribution of the stores over the cities. The sids
+    are offset+1..offset+n
     '''
 
     fields = ('sid', 'address', 'city', 'state', 'zip', 'telno')
-    values = []
-    for sid, addr, city_state, zipcode, telno in zip(range(1, n+1), address_gen(), city_gen(),
-                                                     zip_gen(), telno_gen()):
-        if verbosity:
-            sys.stdout.write('\r{}/{} stores'.format(sid, n))
+    if seed is None:
+        rows = gen_stores(n, city_dist, verbosity, start=offset, stop=offset+n)
+    else:
+        rows = gen_sharded('stores', n, (n, city_dist), seed, workers, verbosity, offset)
+
+    return dict(table_rows(rows, chunksize), fields=fields, pkey='sid', max=offset+n)
 
-        values.append((sid, addr, city_state[0], city_state[1], zipcode, telno))
+def gen_products(n, verbosity=False, rng=random, start=0, stop=None):
+    pnames = pname_gen(rng)
+    colors = color_gen(rng)
+
+    for pid in range(start+1, (n if stop is None else stop)+1):
+        pname = next(pnames)
+        color = next(colors)
+        yield (pid, pname, color)
+
+        if verbosity:
+            sys.stdout.write('\r{}/{} products'.format(pid - start, n))
 
     if verbosity:
         print()
 
-    return {'fields': fields, 'values': values, 'pkey': 'sid', 'max': n}
-
-def make_products(n, verbosity=False):
+def make_products(n, verbosity=False, chunksize=None, seed=None, workers=1, offset=0):
     '''make_product(n) -> list of product dicts
 
     The keys are:
@@ -252,27 +458,40 @@ def make_products(n, verbosity=False):
     name = product name, what the item is (e.g. 'xbox', 'ps3', 'hammer', 'etc').
     color = color of the product. For our purposes we allow only a single color
             per item
+
+    The pids are offset+1..offset+n
     '''
 
     fields = ('pid', 'name', 'color')
-    pnames = pname_gen()
-    colors = color_gen()
-
-    values = []
-    for sid in range(1, n+1):
-        pname = next(pnames)
-        color = next(colors)
-        values.append((sid, pname, color))
+    if seed is None:
+        rows = gen_products(n, verbosity, start=offset, stop=offset+n)
+    else:
+        rows = gen_sharded('products', n, (n,), seed, workers, verbosity, offset)
+
+    return dict(table_rows(rows, chunksize), fields=fields, pkey='pid', max=offset+n)
+
+def gen_inventory(n, store_ids, product_ids, store_dist=UNIFORM, product_dist=UNIFORM,
+                  verbosity=False, rng=random, start=0, stop=None):
+    price_gen = decimal_gen(10, 100, 2, rng)
+    special_gen = bool_gen(rng)
+    store = sampler(store_ids, store_dist, rng)
+    product = sampler(product_ids, product_dist, rng)
+    for i in range(start, n if stop is None else stop):
+        sid = store()
+        pid = product()
+        price = next(price_gen)
+        stock = rng.randint(1, 1000)
+        special = next(special_gen)
+        yield (sid, pid, price, stock, special)
 
         if verbosity:
-            sys.stdout.write('\r{}/{} stores'.format(sid, n))
+            sys.stdout.write('\r{}/{} inventory'.format(i+1, n))
 
     if verbosity:
         print()
 
-    return {'fields': fields, 'values': values, 'pkey': 'pid', 'max': n}
-
-def make_inventory(n, stores, products, verbosity=False):
+def make_inventory(n, store_ids, product_ids, verbosity=False, chunksize=None, seed=None, workers=1, backend='python',
+                   store_dist=UNIFORM, product_dist=UNIFORM):
     '''make_inventory(n) -> list of inventory dicts
 
     These dicts contain the inventory information for any given store. It does
@@ -284,27 +503,21 @@ def make_inventory(n, stores, products, verbosity=False):
     self.qty = how many of that product a store has
     self.special = whether the item is on special in a given store
 
+    store_ids and product_ids are sequences of valid ids, usually ranges.
+    store_dist and product_dist are the distributions of stores and products
+    over the inventory, see parse_distribution
     '''
     fields = ('sid', 'pid', 'price', 'stock', 'special')
+    args = (n, store_ids, product_ids, store_dist, product_dist)
+    if backend == 'numpy':
+        return make_numpy('inventory', fields, n, args, seed, verbosity, chunksize)
 
-    price_gen = decimal_gen(10, 100, 2)
-    special_gen = bool_gen()
-    inventory = []
-    for i in range(n):
-        sid = random.choice(stores)[0]
-        pid = random.choice(products)[0]
-        price = next(price_gen)
-        stock = random.randint(1, 1000)
-        special = next(special_gen)
-        inventory.append((sid, pid, price, stock, special))
-
-        if verbosity:
-            sys.stdout.write('\r{}/{} inventory'.format(i+1, n))
-
-    if verbosity:
-        print()
+    if seed is None:
+        rows = gen_inventory(*args, verbosity=verbosity)
+    else:
+        rows = gen_sharded('inventory', n, args, seed, workers, verbosity)
 
-    return {'fields': fields, 'values': inventory}
+    return dict(table_rows(rows, chunksize), fields=fields)
 
 # Not used any more
 # def make_transactions(n, stores, products, verbosity=False):
@@ -390,10 +603,11 @@ def make_suppliers(n, verbosity=False):
 #     return {'fields': fields, 'values': orders, 'pkey': 'oid', 'max': n}
 
 # Not used in this file, still used in app.initdb
-def make_users(n, verbosity=False):
+def make_users(n, verbosity=False, rng=random):
+    '''make_users(n) -> table dict of exactly n users with unique usernames'''
     fields = ('username', 'email', 'password')
-    unames = uname_gen()
-    passwords = pass_gen()
+    unames = unique_uname_gen(rng)
+    passwords = pass_gen(rng)
 
     values = []
     for uid in range(1, n+1):
@@ -401,9 +615,6 @@ def make_users(n, verbosity=False):
         email = uname + '@example.com'
         password = next(passwords)
 
-        if uname in (user[0] for user in values):
-            continue
-
         values.append((uname, email, password))
 
         if verbosity:
@@ -415,74 +626,857 @@ def make_users(n, verbosity=False):
     return {'fields': fields, 'values': values, 'pkey': 'uid', 'max': n}
 
 
+# Hash a password the way flask-security does when SECURITY_PASSWORD_HASH is
+# 'bcrypt': the password is first signed with HMAC-SHA512 keyed by
+# SECURITY_PASSWORD_SALT, and the base64 of that is what gets bcrypt hashed.
+def hash_password(password, salt):
+    signed = hmac.new(salt.encode('utf-8'), password.encode('utf-8'), hashlib.sha512)
+    return bcrypt.hash(base64.b64encode(signed.digest()).decode('ascii'))
+
+def hash_passwords(passwords, salt, workers=1, cache=None):
+    '''hash_passwords(passwords, salt) -> list of hashes, in the same order
+
+    bcrypt is slow on purpose, so the hashing is spread over workers
+    processes. cache is an optional dict of password -> hash. Passwords found
+    in it are not hashed again and new hashes are added to it, so with the
+    handful of passwords pass_gen produces almost nothing has to be hashed.
+    Users sharing a cached hash also share its salt, so only use the cache
+    for generated test accounts.
+    '''
+    passwords = list(passwords)
+    if cache is None:
+        todo = passwords
+    else:
+        todo = sorted(set(passwords) - set(cache))
+
+    hasher = functools.partial(hash_password, salt=salt)
+    if workers > 1 and len(todo) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            hashes = pool.map(hasher, todo)
+    else:
+        hashes = list(map(hasher, todo))
+
+    if cache is None:
+        return hashes
+
+    cache.update(zip(todo, hashes))
+    return [cache[password] for password in passwords]
+
+
+#============================= Sharded Generation =============================#
+
+# Seeded tables are generated in shards of SHARD_SIZE rows. Every shard has its
+# own random.Random seeded from (seed, table, shard number), so a shard's rows
+# only depend on the seed and never on which process made them or in what
+# order. The same seed and scale therefore always give the same output no
+# matter how many workers are used.
+
+SHARD_SIZE = 10000
+
+SHARD_GENERATORS = {
+    'employees': gen_employees,
+    'employment': gen_employment,
+    'stores': gen_stores,
+    'products': gen_products,
+    'inventory': gen_inventory,
+}
+
+def shard_rng(seed, tablename, shard):
+    return random.Random('{}:{}:{}'.format(seed, tablename, shard))
+
+def gen_shard(spec):
+    '''gen_shard((tablename, shard, total, args, seed, offset)) -> list of rows
+
+    Module level so that it can be sent to a multiprocessing pool
+    '''
+    tablename, shard, total, args, seed, offset = spec
+    start = offset + shard * SHARD_SIZE
+    stop = min(start + SHARD_SIZE, offset + total)
+    rng = shard_rng(seed, tablename, shard)
+    return list(SHARD_GENERATORS[tablename](*args, rng=rng, start=start, stop=stop))
+
+def gen_sharded(tablename, total, args, seed, workers=1, verbosity=False, offset=0):
+    '''Yield the total rows of tablename, generating shards on workers processes
+
+    args are the leading arguments of the table's gen_* function. Shards are
+    yielded in order and at most 2*workers of them are in flight at once, so
+    a slow consumer does not make finished shards pile up in memory. The rows
+    start at row offset, which is where the ids of id tables start.
+    '''
+    nshards = (total + SHARD_SIZE - 1) // SHARD_SIZE
+    specs = ((tablename, shard, total, args, seed, offset) for shard in range(nshards))
+
+    def shards():
+        if workers <= 1:
+            yield from map(gen_shard, specs)
+            return
+
+        with multiprocessing.Pool(workers) as pool:
+            pending = collections.deque(
+                pool.apply_async(gen_shard, (spec,))
+                for spec in itertools.islice(specs, 2*workers))
+            while pending:
+                rows = pending.popleft().get()
+                for spec in itertools.islice(specs, 1):
+                    pending.append(pool.apply_async(gen_shard, (spec,)))
+                yield rows
+
+    for shard, rows in enumerate(shards(), 1):
+        if verbosity:
+            sys.stdout.write('\r{}/{} {} shards'.format(shard, nshards, tablename))
+
+        yield from rows
+
+    if verbosity:
+        print()
+
+#============================== NumPy Generation ==============================#
+
+# Vectorized versions of the three biggest tables. Whole columns are drawn at
+# once as numpy arrays and a chunk is simply the list of its columns, each a
+# (type, values) pair: 'int4' ids and counts, 'money' prices and pay as integer
+# cents, 'bool' flags, and 'text' as codes into a list of strings. The bulk
+# writer turns a chunk into binary COPY rows with one structured array, no
+# python object is made per value. Chunks are seeded like shards, so a given
+# seed always produces the same data, though not the same data as the python
+# backend.
+
+NUMPY_CHUNK_SIZE = 100000
+
+def numpy_rng(seed, tablename, chunk):
+    digest = hashlib.sha256('{}:{}:{}'.format(seed, tablename, chunk).encode('utf-8')).digest()
+    return np.random.RandomState(int.from_bytes(digest[:4], 'little'))
+
+def np_ids(rng, ids, size, dist=UNIFORM):
+    '''Draw size ids from the range ids following dist'''
+    dist = parse_distribution(dist)
+    n = len(ids)
+    if dist[0] == 'zipf':
+        cum_weights = np.array(zipf_cum_weights(dist[1], n))
+        index = np.searchsorted(cum_weights, rng.random_sample(size) * cum_weights[-1], side='right')
+        return ids.start + np.minimum(index, n-1)
+
+    if dist[0] == 'hot':
+        hot, prob = hot_size(dist[1], n), dist[2]
+        if hot < n:
+            cold = rng.random_sample(size) >= prob
+            return ids.start + np.where(cold, rng.randint(hot, n, size), rng.randint(0, hot, size))
+
+    return rng.randint(ids.start, ids.stop, size)
+
+def np_randint(rng, low, high):
+    '''Elementwise random integers in [low, high] for arrays of bounds'''
+    return low + (rng.random_sample(len(low)) * (high - low + 1)).astype(np.int64)
+
+def np_int(values):
+    return ('int4', np.asarray(values))
+
+def np_money(cents):
+    return ('money', np.asarray(cents))
+
+def np_bool(flags):
+    return ('bool', np.asarray(flags, dtype=bool))
+
+def np_text(seq, codes):
+    return ('text', np.asarray(codes), seq)
+
+def np_column_values(column):
+    '''Python values of a column, for the csv and INSERT writers'''
+    kind, values = column[:2]
+    if kind == 'text':
+        return np.asarray(column[2], dtype=object)[values].tolist()
+    if kind == 'money':
+        return ['{}.{:02d}'.format(*divmod(cents, 100)) for cents in values.tolist()]
+    return values.tolist()
+
+def np_rows(columns):
+    return list(zip(*map(np_column_values, columns)))
+
+# Binary COPY framing, see the COPY docs
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+COPY_BINARY_TRAILER = b'\xff\xff'
+
+@functools.lru_cache(maxsize=16)
+def np_text_pool(runs):
+    '''Binary COPY fields of every combination of adjacent text columns
+
+    runs is a tuple with the choices of each column. Returns the fields,
+    length included, as a padded byte table (one row per combination, the
+    last column varying fastest) and the length of each row. Encoded once,
+    the chunks only look their rows up.
+    '''
+    encoded = [[choice.encode('utf-8') for choice in choices] for choices in runs]
+    fields = [b''.join(len(value).to_bytes(4, 'big') + value for value in combination)
+              for combination in itertools.product(*encoded)]
+    lengths = np.array([len(field) for field in fields])
+    table = np.zeros((len(fields), lengths.max()), dtype=np.uint8)
+    for row, field in enumerate(fields):
+        table[row, :len(field)] = np.frombuffer(field, dtype=np.uint8)
+    return table, lengths
+
+# Adjacent text columns share one table of every combination while it stays small
+MAX_TEXT_TABLE = 4096
+
+# Rows encoded at a time. A chunk's records and byte mask are several MB, a
+# block of them mostly stays in the CPU cache and encodes faster.
+ENCODE_BLOCK_SIZE = 16384
+
+def np_blocks(columns, size=ENCODE_BLOCK_SIZE):
+    '''Split a chunk of columns into chunks of up to size rows'''
+    nrows = len(columns[0][1])
+    for start in range(0, nrows, size):
+        yield [(column[0], column[1][start:start+size]) + tuple(column[2:]) for column in columns]
+
+def np_scratch(scratch, name, shape, dtype):
+    '''An uninitialized array, in the buffer scratch keeps under name if given
+
+    Freshly allocated arrays of a few MB cost about as much in page faults
+    as filling them, so the encoder reuses its work arrays from one block to
+    the next.
+    '''
+    if scratch is None:
+        return np.empty(shape, dtype=dtype)
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if len(scratch.get(name, ())) < size:
+        scratch[name] = np.empty(size, dtype=np.uint8)
+    return scratch[name][:size].view(dtype).reshape(shape)
+
+@functools.lru_cache(maxsize=16)
+def np_record_format(kinds):
+    '''The record layout of chunks with columns of kinds
+
+    kinds has the kind of each column, and for text columns the tuple of
+    their choices as well. Returns the record dtype, the runs of text
+    columns, as (field name, column indices, table, bytes to keep of every
+    record by combination) each, and the records every row starts as: one
+    per combination of the first run, that run filled in, or a single one
+    when there is no text. Worked out once per kind of chunk.
+    '''
+    layout = [('nfields', '>i2')]
+    texts = []  # [name, column indices, choices of each column] per run of text columns
+    for i, kind in enumerate(kinds):
+        if kind == 'int4':
+            layout += [('len%d' % i, '>i4'), ('val%d' % i, '>i4')]
+        elif kind == 'bool':
+            layout += [('len%d' % i, '>i4'), ('val%d' % i, 'u1')]
+        elif kind == 'money':
+            layout += [('len%d' % i, '>i4'), ('val%d' % i, '>i2', (7,))]
+        else:
+            choices = kind[1]
+            if texts and texts[-1][1][-1] == i - 1 and len(np_text_pool(texts[-1][2])[0]) * len(choices) <= MAX_TEXT_TABLE:
+                name, indices, runs = texts.pop()
+                layout.pop()
+                texts.append([name, indices + (i,), runs + (choices,)])
+            else:
+                texts.append(['text%d' % i, (i,), (choices,)])
+            layout.append((texts[-1][0], 'u1', (np_text_pool(texts[-1][2])[0].shape[1],)))
+
+    # What is the same in every row is set once and copied over all of them
+    template = np.zeros(1, dtype=layout)
+    template['nfields'] = len(kinds)
+    for i, kind in enumerate(kinds):
+        if kind == 'money':
+            template['val%d' % i][:, :4] = (3, 1, 0, 2)  # ndigits, weight, sign, dscale
+        if kind in ('int4', 'bool', 'money'):
+            template['len%d' % i] = template.dtype['val%d' % i].itemsize
+
+    runs = []
+    for name, indices, choices in texts:
+        table, lengths = np_text_pool(choices)
+        offset = template.dtype.fields[name][1]
+        record_keep = np.ones((len(table), template.dtype.itemsize), dtype=bool)
+        record_keep[:, offset:offset+table.shape[1]] = np.arange(table.shape[1]) < lengths[:, None]
+        runs.append((name, indices, table, record_keep))
+    if runs:
+        template = np.repeat(template, len(runs[0][2]))
+        template[runs[0][0]] = runs[0][2]
+    return template.dtype, runs, template.view(np.uint8).reshape(len(template), -1)
+
+def np_copy_binary(columns, scratch=None):
+    '''Encode a chunk of columns as binary COPY rows
+
+    Every row is one record of a structured array: the field count, then
+    each field's length and value in network byte order. Text fields are
+    looked up in a padded table and the padding is cut out afterwards.
+    Money goes out as a NUMERIC with three base 10000 digits and a weight of
+    1 (postgres strips the leading zero digits), good up to 99999999.99.
+    Returns the bytes as a memoryview of the array, not copied again.
+    scratch is a dict to keep the work arrays in between calls (see
+    np_scratch), the array returned is never one of them.
+    '''
+    nrows = len(columns[0][1])
+    dtype, runs, templates = np_record_format(tuple(
+        (column[0], tuple(column[2])) if column[0] == 'text' else column[0] for column in columns))
+
+    # Text padding is cut out into a new array, the records are only worked on
+    records = np_scratch(scratch if runs else None, 'records', (nrows, dtype.itemsize), np.uint8)
+    rec = records.reshape(-1).view(dtype)
+
+    # With text, every row starts as the template of its combination of the
+    # first run and keeps the bytes of it that aren't padding, both looked
+    # up in one go. Further runs are filled in over it.
+    keep = None
+    for name, indices, table, record_keep in runs:
+        codes = columns[indices[0]][1]
+        for i in indices[1:]:
+            codes = codes * len(columns[i][2]) + columns[i][1]
+        if keep is None:
+            templates.take(codes, axis=0, out=records, mode='clip')
+            keep = np_scratch(scratch, 'keep', (nrows, dtype.itemsize), bool)
+            record_keep.take(codes, axis=0, out=keep, mode='clip')
+        else:
+            rec[name] = table.take(codes, axis=0)
+            keep &= record_keep.take(codes, axis=0)
+    if keep is None:
+        records[:] = templates
+
+    for i, column in enumerate(columns):
+        kind, values = column[:2]
+        if kind == 'money':
+            digits = rec['val%d' % i]
+            digits[:, 4], rest = np.divmod(values, 1000000)
+            digits[:, 5], cents = np.divmod(rest, 100)
+            digits[:, 6] = cents * 100
+        elif kind != 'text':
+            rec['val%d' % i] = values
+
+    if keep is None:
+        return records.data
+    return records[keep].data
+
+def np_employees(n, roles, rng, start, stop):
+    size = stop - start
+    roleids = np.array([roleid for roleid, role in roles])
+    low = np.array([role_pay_ranges[role][0] * 100 for roleid, role in roles])
+    high = np.array([role_pay_ranges[role][1] * 100 for roleid, role in roles])
+    hourly = np.array([role_pay_ranges[role][2] for roleid, role in roles])
+
+    role = rng.randint(0, len(roles), size)
+    return [
+        np_int(np.arange(start+1, stop+1)),
+        np_text(FIRST_NAMES, rng.randint(0, len(FIRST_NAMES), size)),
+        np_text(LAST_NAMES, rng.randint(0, len(LAST_NAMES), size)),
+        np_int(roleids[role]),
+        np_money(np_randint(rng, low[role], high[role])),
+        np_bool(hourly[role]),
+    ]
+
+def np_employment(n, employee_ids, store_ids, store_dist, cover_stores, cover_employees, rng, start, stop):
+    k = np.arange(start, stop)
+    nstores = len(cover_stores)
+    nemployees = len(cover_employees)
+
+    # Same layout as gen_employment: one row per covered store, then one per
+    # covered employee, then random pairs
+    sids = np.where(k < nstores, cover_stores.start + k, np_ids(rng, store_ids, len(k), store_dist))
+    own = (k >= nstores) & (k < nstores + nemployees)
+    eids = np.where(own, cover_employees.start + k - nstores, np_ids(rng, employee_ids, len(k)))
+    return [np_int(sids), np_int(eids)]
+
+def np_inventory(n, store_ids, product_ids, store_dist, product_dist, rng, start, stop):
+    size = stop - start
+    return [
+        np_int(np_ids(rng, store_ids, size, store_dist)),
+        np_int(np_ids(rng, product_ids, size, product_dist)),
+        np_money(rng.randint(10 * 100, 100 * 100 + 1, size)),
+        np_int(rng.randint(1, 1001, size)),
+        np_bool(rng.randint(0, 2, size)),
+    ]
+
+NUMPY_GENERATORS = {
+    'employees': np_employees,
+    'employment': np_employment,
+    'inventory': np_inventory,
+}
+
+def gen_numpy(tablename, total, args, seed, verbosity=False, offset=0):
+    '''Yield the columns of tablename NUMPY_CHUNK_SIZE rows at a time, from row offset'''
+    if np is None:
+        raise RuntimeError('The numpy backend needs numpy to be installed')
+
+    nchunks = (total + NUMPY_CHUNK_SIZE - 1) // NUMPY_CHUNK_SIZE
+    for chunk in range(nchunks):
+        if verbosity:
+            sys.stdout.write('\r{}/{} {} chunks'.format(chunk+1, nchunks, tablename))
+
+        start = offset + chunk * NUMPY_CHUNK_SIZE
+        stop = min(start + NUMPY_CHUNK_SIZE, offset + total)
+        rng = numpy_rng(seed, tablename, chunk)
+        yield NUMPY_GENERATORS[tablename](*args, rng=rng, start=start, stop=stop)
+
+    if verbosity:
+        print()
+
+def make_numpy(tablename, fields, total, args, seed, verbosity=False, chunksize=None, offset=0):
+    '''Table dict with the rows as chunks of columns under column_chunks'''
+    chunks = gen_numpy(tablename, total, args, seed, verbosity, offset)
+    if not chunksize:
+        chunks = list(chunks)
+    return {'fields': fields, 'column_chunks': chunks}
+
+
 # Generate the actual CSV files
-def create_tables(n, verbosity=0):
+# The skewable draws, for create_tables' distributions
+DISTRIBUTIONS = ('employment_stores', 'inventory_stores', 'inventory_products', 'cities')
+
+def resolve_distributions(distributions=None):
+    '''Check a distributions dict and fill in uniform for the missing names'''
+    distributions = dict(distributions or {})
+    for name, spec in distributions.items():
+        if name not in DISTRIBUTIONS:
+            raise ValueError('Unknown distribution name {!r}'.format(name))
+        parse_distribution(spec)
+    return {name: distributions.get(name, UNIFORM) for name in DISTRIBUTIONS}
+
+def resolve_seed(seed, workers=1, backend='python'):
+    '''The seed to generate with: seed, or a random one when several workers
+    or the numpy backend need the sharded generator anyway'''
+    if seed is None and (workers > 1 or backend == 'numpy'):
+        seed = random.getrandbits(32)
+    return seed
+
+def create_tables(n, verbosity=0, chunksize=None, seed=None, workers=1, backend='python', distributions=None):
+    '''Build every table for scale n
+
+    With a chunksize the tables are generated lazily and have to be consumed
+    in order, see iter_chunks. Passing a seed switches to the sharded
+    generator, which is reproducible and can use several worker processes.
+    backend='numpy' generates employees, employment and inventory with the
+    vectorized numpy generators instead.
+
+    distributions maps names in DISTRIBUTIONS to distribution specs (see
+    parse_distribution), anything missing is uniform.
+    '''
+    dists = resolve_distributions(distributions)
+    seed = resolve_seed(seed, workers, backend)
+
+    opts = dict(verbosity=verbosity, chunksize=chunksize, seed=seed, workers=workers)
+    bulk = dict(opts, backend=backend)
     tables = OrderedDict()
 
     #print('Creating roles')
     tables['roles'] = roles = make_roles(n, verbosity=verbosity)
 
     #print('Creating employees')
-    tables['employees'] = employees = make_employees(10*n, roles['values'], verbosity=verbosity)
+    tables['employees'] = employees = make_employees(10*n, roles['values'], **bulk)
+    employee_ids = range(1, employees['max']+1)
 
     #print('Creating stores')
-    tables['stores'] = stores = make_stores(n, verbosity=verbosity)
+    tables['stores'] = stores = make_stores(n, city_dist=dists['cities'], **opts)
+    store_ids = range(1, stores['max']+1)
 
     #print('Creating employment')
-    tables['employment'] = employment = make_employment(12*n, employees['values'], stores['values'], verbosity=verbosity)
+    tables['employment'] = employment = make_employment(12*n, employee_ids, store_ids,
+                                                        store_dist=dists['employment_stores'], **bulk)
 
     #print('Creating products')
-    tables['products'] = products = make_products(n, verbosity=verbosity)
+    tables['products'] = products = make_products(n, **opts)
+    product_ids = range(1, products['max']+1)
 
     #print('Creating inventory')
-    tables['inventory'] = inventory = make_inventory(10*n, stores['values'], products['values'], verbosity=verbosity)
+    tables['inventory'] = inventory = make_inventory(10*n, store_ids, product_ids,
+                                                     store_dist=dists['inventory_stores'],
+                                                     product_dist=dists['inventory_products'], **bulk)
 
     #print('Creating suppliers')
     tables['suppliers'] = suppliers = make_suppliers(n, verbosity=verbosity)
 
     return tables
 
-def write_tables_csv(n, verbosity=0):
-    tables = create_tables(n, verbosity)
+def write_tables_csv(n, verbosity=0, chunksize=None, seed=None, workers=1, outdir=None, backend='python',
+                     distributions=None):
+    tables = create_tables(n, verbosity, chunksize, seed, workers, backend, distributions)
+    outdir = outdir or os.path.join(THIS_FILE_PATH, 'data')
 
     for tablename, tabledict in tables.items():
-        path = os.path.join(THIS_FILE_PATH, 'data', tablename + '.csv')
+        path = os.path.join(outdir, tablename + '.csv')
         with open(path, 'w') as f:
             if verbosity:
-                print('Writing {} rows to {}'.format(len(tabledict['values']), path))
+                print('Writing {} to {}'.format(tablename, path))
 
             writer = csv.writer(f)
             writer.writerow(tabledict['fields'])
-            writer.writerows(tabledict['values'])
+            for chunk in iter_chunks(tabledict):
+                writer.writerows(chunk)
 
-def write_tables_db(n, conn, verbosity=0):
-    tables = create_tables(n, verbosity)
+class CopyStream:
+    '''File-like wrapper that csv encodes rows as COPY reads from it
+
+    psycopg2's copy_expert pulls data with read(size). Rows are only pulled
+    from the underlying iterable and encoded when the buffer runs low, so a
+    table never has to exist in memory (or on disk) as one big csv string.
+    '''
+    def __init__(self, rows, batchsize=1000):
+        self.rows = iter(rows)
+        self.batchsize = batchsize
+        self.count = 0
+        self.pending = ''
+        self.offset = 0
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf, lineterminator='\n')
+
+    def encode_next(self):
+        '''Encode the next batch of rows, returns '' once they run out'''
+        batch = list(itertools.islice(self.rows, self.batchsize))
+        self.writer.writerows(batch)
+        self.count += len(batch)
+        data = self.buf.getvalue()
+        self.buf.seek(0)
+        self.buf.truncate()
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            data = [self.pending[self.offset:]]
+            data.extend(iter(self.encode_next, ''))
+            self.pending, self.offset = '', 0
+            return ''.join(data)
+
+        # Hand out the current block a piece at a time rather than slicing
+        # the remainder off on every read
+        while self.offset >= len(self.pending):
+            self.pending, self.offset = self.encode_next(), 0
+            if not self.pending:
+                return ''
+
+        data = self.pending[self.offset:self.offset+size]
+        self.offset += len(data)
+        return data
+
+    readline = read
+
+class ColumnStream(CopyStream):
+    '''CopyStream giving binary COPY data for the numpy backend's chunks'''
+    def __init__(self, column_chunks):
+        super().__init__(())
+        self.column_chunks = (block for columns in column_chunks for block in np_blocks(columns))
+        self.scratch = {}
+        self.pending = COPY_BINARY_HEADER
+        self.done = False
+
+    def encode_next(self):
+        for columns in self.column_chunks:
+            if len(columns[0][1]):
+                self.count += len(columns[0][1])
+                return np_copy_binary(columns, self.scratch)
+
+        if self.done:
+            return b''
+        self.done = True
+        return COPY_BINARY_TRAILER
+
+    def read(self, size=-1):
+        if size < 0:
+            data = [self.pending[self.offset:]]
+            data.extend(iter(self.encode_next, b''))
+            self.pending, self.offset = b'', 0
+            return b''.join(data)
+        # The chunks are memoryviews, psycopg2 wants bytes
+        return bytes(super().read(size) or b'')
+
+
+def copy_table(cur, tablename, fields, rows):
+    '''copy_table(cur, tablename, fields, rows) -> number of rows copied
+
+    Streams rows into tablename with COPY ... FROM STDIN using csv encoding
+    '''
+    stream = CopyStream(rows)
+    query = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        tablename, ','.join(fields))
+    cur.copy_expert(query, stream)
+    return stream.count
+
+def copy_columns(cur, tablename, fields, column_chunks):
+    '''Like copy_table, for the column chunks made by the numpy backend'''
+    stream = ColumnStream(column_chunks)
+    query = 'COPY {} ({}) FROM STDIN WITH (FORMAT binary)'.format(
+        tablename, ','.join(fields))
+    cur.copy_expert(query, stream)
+    return stream.count
+
+def copy_tabledict(cur, tablename, tabledict):
+    '''COPY a table dict into tablename however it was generated'''
+    if 'column_chunks' in tabledict:
+        return copy_columns(cur, tablename, tabledict['fields'], tabledict['column_chunks'])
+    return copy_table(cur, tablename, tabledict['fields'], iter_rows(tabledict))
+
+def reset_sequence(cur, tablename, tabledict):
+    '''Point the SERIAL sequence of a table at its largest generated key'''
+    if 'pkey' in tabledict:
+        query = "select setval('{}_{}_seq', %s)".format(tablename, tabledict['pkey'])
+        cur.execute(query, (tabledict['max'],))
+
+def record_dataset_info(cur, **info):
+    '''Store what the data was generated with in DatasetInfo'''
+    cur.executemany('''
+        INSERT INTO DatasetInfo (key, value) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value''',
+        [(key, json.dumps(value)) for key, value in info.items()])
+
+def write_tables_db(n, conn, verbosity=0, copy=True, chunksize=None, seed=None, workers=1, backend='python',
+                    distributions=None):
+    '''Generate the tables for scale n and load them through conn
+
+    By default every table is streamed in with COPY. Passing copy=False uses
+    the old row at a time INSERT path. With a chunksize the tables are
+    generated while they are being loaded, keeping memory use flat. See
+    create_tables for seed, workers, backend and distributions.
+    '''
+    # Picked here rather than by create_tables, so the seed recorded is the
+    # one the data came from
+    seed = resolve_seed(seed, workers, backend)
+    tables = create_tables(n, verbosity, chunksize, seed, workers, backend, distributions)
 
     with conn.cursor() as cur:
         for tablename, tabledict in tables.items():
-            fieldspec = '(' + ','.join(tabledict['fields']) + ')'
-            query = 'insert into {} {} values %s'.format(tablename, fieldspec)
+            start = time.time()
+            if copy:
+                count = copy_tabledict(cur, tablename, tabledict)
+            else:
+                count = insert_table(cur, tablename, tabledict, verbosity)
+            elapsed = time.time() - start
+
+            reset_sequence(cur, tablename, tabledict)
+
             if verbosity:
-                print(query)
+                print('Loaded {} rows into {} in {:.2f}s ({:.0f} rows/sec)'.format(
+                    count, tablename, elapsed, count / max(elapsed, 1e-6)))
 
-            for row in tabledict['values']:
-                if verbosity > 1:
-                    print(row)
+        record_dataset_info(cur, scale=n, seed=seed, backend=backend,
+                            distributions=resolve_distributions(distributions))
 
-                cur.execute(query, (row,))
+#=============================== Growing a DB =================================#
 
-            if 'pkey' in tabledict:
-                query = "select setval('{}_{}_seq', %s)".format(tablename, tabledict['pkey'])
-                cur.execute(query, (tabledict['max'],))
+# growdb appends rows to a live database instead of rebuilding it. New stores,
+# products and employees get the ids after the current maxima and are copied
+# straight in. Employment and inventory draw their keys from id ranges, which
+# may have holes where rows were deleted, so they are copied into a staging
+# table and moved over with any key that no longer exists replaced by the next
+# one that does.
+
+# Foreign keys checked when moving staged rows over
+LINK_KEYS = {
+    'employment': (('sid', 'Stores'), ('eid', 'Employees')),
+    'inventory': (('sid', 'Stores'), ('pid', 'Products')),
+}
+
+def current_max(cur, tablename, pkey):
+    '''Largest id used by tablename, counting ids its sequence handed out'''
+    cur.execute('''
+        SELECT GREATEST(COALESCE(MAX({1}), 0),
+                        (SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {0}_{1}_seq))
+        FROM {0}'''.format(tablename, pkey))
+    return cur.fetchone()[0]
+
+def copy_linked(cur, tablename, tabledict):
+    '''copy_linked(cur, tablename, tabledict) -> (rows copied, rows added)
+
+    COPYs into a staging table, then inserts the rows with every foreign key
+    moved up to the nearest existing one (or the last one past the end).
+    Keys that exist are found by a single primary key lookup. Pairs that
+    are already there are skipped.
+    '''
+    staging = 'staging_' + tablename
+    cur.execute('CREATE TEMP TABLE {} (LIKE {})'.format(staging, tablename))
+    count = copy_tabledict(cur, staging, tabledict)
+
+    values = {field: 's.' + field for field in tabledict['fields']}
+    for key, table in LINK_KEYS[tablename]:
+        values[key] = ('''COALESCE((SELECT {1} FROM {0} WHERE {1} >= s.{1} ORDER BY {1} LIMIT 1),
+                                   (SELECT MAX({1}) FROM {0}))'''.format(table, key))
+    cur.execute('INSERT INTO {} ({}) SELECT {} FROM {} s ON CONFLICT DO NOTHING'.format(
+        tablename, ','.join(tabledict['fields']),
+        ','.join(values[field] for field in tabledict['fields']), staging))
+    added = cur.rowcount
+    cur.execute('DROP TABLE {}'.format(staging))
+    return count, added
+
+def grow_tables_db(conn, stores=0, employees=0, products=0, inventory=0, employment=0, verbosity=0,
+                   chunksize=None, seed=None, workers=1, backend='python', distributions=None):
+    '''Append generated rows to the database behind conn without dropping anything
+
+    employment is the least number of employment rows added, every new store
+    and employee gets at least one. The id tables are locked against writes
+    for the duration, reads carry on. A seed is mixed with the current table
+    sizes, so growing twice with one seed does not repeat the same rows. See
+    create_tables for the other arguments.
+    '''
+    dists = resolve_distributions(distributions)
+
+    with conn.cursor() as cur:
+        cur.execute('LOCK TABLE Stores, Products, Employees IN SHARE ROW EXCLUSIVE MODE')
+        maxima = {tablename: current_max(cur, tablename, pkey)
+                  for tablename, pkey in (('stores', 'sid'), ('employees', 'eid'), ('products', 'pid'))}
+        cur.execute('SELECT roleid, role FROM Roles ORDER BY roleid')
+        roles = [(roleid, role) for roleid, role in cur.fetchall() if role in role_pay_ranges]
+
+        seed = resolve_seed(seed, workers, backend)
+        if seed is not None:
+            seed = '{}:grow:{stores}:{employees}:{products}'.format(seed, **maxima)
+
+        opts = dict(verbosity=verbosity, chunksize=chunksize, seed=seed, workers=workers)
+        bulk = dict(opts, backend=backend)
+        new_store_ids = range(maxima['stores']+1, maxima['stores']+stores+1)
+        new_employee_ids = range(maxima['employees']+1, maxima['employees']+employees+1)
+        store_ids = range(1, new_store_ids.stop)
+        employee_ids = range(1, new_employee_ids.stop)
+        product_ids = range(1, maxima['products']+products+1)
+
+        if employees and not roles:
+            raise ValueError('There are no roles to give new employees')
+        # Employment needs someone to employ and somewhere to do it
+        if not (store_ids and employee_ids):
+            employment = 0
+            new_store_ids = new_employee_ids = range(0)
+        if inventory and not (store_ids and product_ids):
+            raise ValueError('Inventory needs at least one store and one product')
+
+        tables = OrderedDict()
+        if stores:
+            tables['stores'] = make_stores(stores, city_dist=dists['cities'], offset=maxima['stores'], **opts)
+        if employees:
+            tables['employees'] = make_employees(employees, roles, offset=maxima['employees'], **bulk)
+        if products:
+            tables['products'] = make_products(products, offset=maxima['products'], **opts)
+        if employment or new_store_ids or new_employee_ids:
+            tables['employment'] = make_employment(employment, employee_ids, store_ids,
+                                                   store_dist=dists['employment_stores'],
+                                                   cover_stores=new_store_ids,
+                                                   cover_employees=new_employee_ids, **bulk)
+        if inventory:
+            tables['inventory'] = make_inventory(inventory, store_ids, product_ids,
+                                                 store_dist=dists['inventory_stores'],
+                                                 product_dist=dists['inventory_products'], **bulk)
+
+        counts = {}
+        for tablename, tabledict in tables.items():
+            start = time.time()
+            if tablename in LINK_KEYS:
+                count, added = copy_linked(cur, tablename, tabledict)
+            else:
+                count = added = copy_tabledict(cur, tablename, tabledict)
+                reset_sequence(cur, tablename, tabledict)
+            elapsed = time.time() - start
+            counts[tablename] = added
+
+            if verbosity:
+                print('Added {} rows to {} in {:.2f}s ({:.0f} rows/sec)'.format(
+                    added, tablename, elapsed, count / max(elapsed, 1e-6)))
+                if added < count:
+                    print('  {} were already there'.format(count - added))
+
+        # Keep a list of every growth next to initdb's parameters
+        cur.execute('''
+            INSERT INTO DatasetInfo (key, value) VALUES ('grown', %s)
+            ON CONFLICT (key) DO UPDATE SET value = DatasetInfo.value || EXCLUDED.value''',
+            (json.dumps([counts]),))
+
+    return counts
+
+def insert_table(cur, tablename, tabledict, verbosity=0):
+    '''Insert one row per statement. Slow, kept for comparison with COPY'''
+    fieldspec = '(' + ','.join(tabledict['fields']) + ')'
+    query = 'insert into {} {} values %s'.format(tablename, fieldspec)
+    if verbosity:
+        print(query)
+
+    count = 0
+    for row in iter_rows(tabledict):
+        if verbosity > 1:
+            print(row)
+
+        cur.execute(query, (row,))
+        count += 1
+
+    return count
+
+
+# What psycopg2's copy_expert asks its file for at a time
+COPY_READ_SIZE = 8192
+
+def benchmark_backends(n=100000, seed=0, repeat=3):
+    '''Time the python and numpy backends on the three big tables at scale n
+
+    Each timing covers generating the table and encoding it for COPY, i.e.
+    everything short of sending it to the database, and is the best of
+    repeat runs. The encoded data is read the way copy_expert reads it,
+    COPY_READ_SIZE bytes at a time.
+    '''
+    roles = make_roles(n)['values']
+    employee_ids = range(1, 10*n+1)
+    store_ids = product_ids = range(1, n+1)
+    # The python backend runs unseeded, i.e. the plain row at a time loops
+    opts = {'python': {}, 'numpy': {'seed': seed, 'backend': 'numpy'}}
+    builders = OrderedDict([
+        ('employees', lambda backend: make_employees(10*n, roles, **opts[backend])),
+        ('employment', lambda backend: make_employment(12*n, employee_ids, store_ids, **opts[backend])),
+        ('inventory', lambda backend: make_inventory(10*n, store_ids, product_ids, **opts[backend])),
+    ])
+
+    totals = {'python': 0.0, 'numpy': 0.0}
+    for tablename, build in builders.items():
+        times = {}
+        for backend in ('python', 'numpy'):
+            for _ in range(repeat):
+                start = time.time()
+                tabledict = build(backend)
+                if 'column_chunks' in tabledict:
+                    stream = ColumnStream(tabledict['column_chunks'])
+                else:
+                    stream = CopyStream(iter_rows(tabledict))
+                while stream.read(COPY_READ_SIZE):
+                    pass
+                elapsed = time.time() - start
+                times[backend] = min(times.get(backend, elapsed), elapsed)
+            totals[backend] += times[backend]
+
+        print('{:<12} {:>9} rows  python {:7.2f}s  numpy {:6.2f}s  {:6.1f}x'.format(
+            tablename, stream.count, times['python'], times['numpy'],
+            times['python'] / times['numpy']))
+
+    print('{:<12} {:>15}  python {:7.2f}s  numpy {:6.2f}s  {:6.1f}x'.format(
+        'total', '', totals['python'], totals['numpy'],
+        totals['python'] / totals['numpy']))
+    return totals
 
 
 # =============== [ Main ] ============== #
-if __name__ == '__main__':
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate example data as csv files')
+    parser.add_argument('--scale', type=int, default=100,
+                        help='number of stores and products to generate')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for reproducible output')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes generating shards')
+    parser.add_argument('--outdir', default=os.path.join(THIS_FILE_PATH, 'data'),
+                        help='directory the csv files are written to')
+    parser.add_argument('--backend', choices=('python', 'numpy'), default='python',
+                        help='generator used for employees, employment and inventory')
+    for name in DISTRIBUTIONS:
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, default=UNIFORM, metavar='DIST',
+                            help='distribution of the {}: uniform, zipf:S or hot:FRAC:PROB'.format(
+                                name.replace('_', ' ')))
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare the python and numpy backends at --scale and exit')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        benchmark_backends(args.scale, seed=args.seed or 0)
+        return
+
     # Create the data directory if it does not exist already
-    if not os.path.exists('data'):
-        os.mkdir('data')
-    elif not os.path.isdir('data'):
-        e = RuntimeError('Path %r exists but is not a directory' % 'data')
+    if not os.path.exists(args.outdir):
+        os.mkdir(args.outdir)
+    elif not os.path.isdir(args.outdir):
+        e = RuntimeError('Path %r exists but is not a directory' % args.outdir)
         raise e
 
-    write_tables_csv(100)
+    write_tables_csv(args.scale, args.verbose, chunksize=CHUNK_SIZE,
+                     seed=args.seed, workers=args.workers, outdir=args.outdir,
+                     backend=args.backend,
+                     distributions={name: getattr(args, name) for name in DISTRIBUTIONS})
+
+if __name__ == '__main__':
+    main()
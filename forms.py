@@ -1,17 +1,56 @@
+import math
+
 from wtforms import Form
 from wtforms import FloatField, IntegerField, SelectField, SubmitField
 from wtforms import BooleanField, StringField
-from wtforms.validators import Required
+from wtforms.validators import Optional, Required
+from werkzeug.datastructures import MultiDict
 
 from flask_security.forms import RegisterForm, LoginForm
 from flask_security.utils import verify_and_update_password
 from flask_security.confirmable import requires_confirmation
 
-from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
+# Every query goes through the prepared statements in queries.py, on the
+# request's connection, a form's lookups and writes in one transaction.
+# Writes drop the cached pages of what they change. The store, product and
+# manager ids forms refer to are looked up by validation.py.
+import cache
+import queries
+import validation
+
+#################
+## Write Forms ##
+#################
+
+class WriteForm(Form):
+    '''A form whose submission changes the database
+    Subclasses define apply(), which makes the form's lookups and writes and
+    returns False if the form doesn't check out. It may run more than once,
+    see queries.unit_of_work. validate() runs it as one unit of work:
+    everything commits together or nothing does, on the request's pooled
+    connection. The cached pages of the entity families the form changes are
+    dropped once it commits.
+    '''
+    # Entity families the writes change, see cache.py
+    families = ()
+
+    def validate(self):
+        '''Ensure fields are valid then apply the form'''
+        if not self.check_fields():
+            return False
+
+        if not queries.unit_of_work(self.apply):
+            return False
+        cache.invalidate(*self.families)
+        return True
+
+    def check_fields(self):
+        '''Run the validators of the fields'''
+        return super(Form, self).validate()
+
 
 # Employee Deletion
-class EmpDeleteForm(Form):
+class EmpDeleteForm(WriteForm):
     '''Creates the form to delete an employee.
     The easiest method to delete an employee is by eid,
     so for simplicity's sake that is all we will support.
@@ -19,23 +58,16 @@ class EmpDeleteForm(Form):
     eid = IntegerField('Employee ID (eid)', validators=[Required()])
     submit = SubmitField('Delete')
 
-    def validate(self):
-        '''Ensure fields are valid then run deletion'''
-        if not super(Form, self).validate():
-            return False
+    families = ('employees',)
 
-        conn = db.engine.connect()
-        conn.execution_options(autocommit=True).execute(
-            'DELETE FROM Employees E WHERE E.eid = {0}'.format(
-                self.eid.data
-            )
-        )
-        conn.close()
+    def apply(self):
+        '''Run deletion'''
+        queries.run('deleteEmployee', self.eid.data)
         return True
 
 
 # Employee Creation
-class EmpCreateForm(Form):
+class EmpCreateForm(WriteForm):
     '''Creates the input form for all information for new Employees
     This makes use of WTForms to create the form used in adding a new
     employee to the database. It allows easily forcing requirements
@@ -52,16 +84,14 @@ class EmpCreateForm(Form):
     sid       = IntegerField('Store ID', validators=[Required()])
     submit    = SubmitField('Create')
 
+    families = ('employees',)
+
     # This function gets called automatically on submission
     # I believe so it can be used to run the insertions.
-    def validate(self):
+    def apply(self):
 
         valChars = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-'")
 
-        # Ensure base fields are valid
-        if not super(Form, self).validate():
-            return False
-
         # Create sets of first and last name for valid char testing
         tmpfName = set(self.firstname.data)
         tmplName = set(self.lastname.data)
@@ -75,24 +105,25 @@ class EmpCreateForm(Form):
             self.lastname.errors.append("First name must contain letters, hyphens, and apostraphes only.")
             return False
 
+        if validation.missing(stores=[self.sid.data])['stores']:
+            self.sid.errors.append('Provided Store ID does not match an existing store')
+            return False
+
         # Create the new employee:
-        # Insert into employee table:
-        conn = db.engine.connect()
-        conn.execution_options(autocommit=True).execute('SELECT * FROM createEmp(\'{0}\',\'{1}\',{2},{3},{4},{5});'.format(
+        # Insert into employee table, created is the new eid
+        self.created = queries.run_value('createEmp',
             self.firstname.data,
             self.lastname.data,
             self.hourly.data,
             self.pay.data,
             self.roleid.data,
             self.sid.data
-            )
         )
-        conn.close()
         return True
 
 
 # Product Creation
-class ProdCreateForm(Form):
+class ProdCreateForm(WriteForm):
     '''Create new products
     requires name, color, sid (store to add to), and price
     '''
@@ -104,28 +135,27 @@ class ProdCreateForm(Form):
     sale   = BooleanField('On Sale', validators=[Required()])
     submit = SubmitField('Create Product')
 
-    def validate(self):
-        if not super(Form, self).validate():
+    families = ('products',)
+
+    def apply(self):
+        if validation.missing(stores=[self.sid.data])['stores']:
+            self.sid.errors.append('Provided Store ID does not match an existing store')
             return False
 
-        # Run creation query
-        conn = db.engine.connect()
-        conn.execution_options(autocommit=True).execute(
-            'SELECT * FROM createNewProd(\'{0}\',\'{1}\',{2},{3},{4},{5});'.format(
-                self.name.data,
-                self.color.data,
-                self.sid.data,
-                self.price.data,
-                self.qty.data,
-                self.sale.data
-            )
+        # Run creation query, created is the new pid
+        self.created = queries.run_value('createNewProd',
+            self.name.data,
+            self.color.data,
+            self.sid.data,
+            self.price.data,
+            self.qty.data,
+            self.sale.data
         )
-        conn.close()
         return True
 
 
 # Add product to store
-class ProdAddExistingForm(Form):
+class ProdAddExistingForm(WriteForm):
     '''Add an existing product to a new store
     Naturally, this edits only the inventory field as the product should already
     exist. Otherwise it will return an error
@@ -137,22 +167,23 @@ class ProdAddExistingForm(Form):
     sale    = BooleanField('On Sale', validators=[Required()])
     submit  = SubmitField('Add Product')
 
-    def validate(self):
-        if not super(Form,self):
-            return False
+    families = ('products',)
 
-        # Get all pids and sids that exist, this is to ensure they are valid
-        conn = db.engine.connect()
-        sids = conn.execute('SELECT DISTINCT S.sid FROM Stores S;').fetchall()
-        pids = conn.execute('SELECT DISTINCT P.pid FROM Products P;').fetchall()
+    def check_fields(self):
+        # On Sale may be left unticked, every other field is required
+        return all([field.validate(self) for field in self if field is not self.sale])
 
-        if self.sid.data not in sids:
+    def apply(self):
+        # Ensure the store and product exist, both in one lookup
+        missing = validation.missing(stores=[self.sid.data], products=[self.pid.data])
+
+        if missing['stores']:
             self.sid.errors.append(
                 'Provided Store ID does not match an existing store'
             )
             return False
 
-        if self.pid.data not in pids:
+        if missing['products']:
             self.pid.errors.append(
                 'Provided Product ID does not match an existing product'
             )
@@ -160,39 +191,104 @@ class ProdAddExistingForm(Form):
 
         # If those checked out, the other fields should be valid as well
         # Execute the command
-        conn.execution_options(autocommit=True).execute(
-            'SELECT * FROM addExistingProd({0},{1},{2},{3},{4});'.format(
-                self.pid.data,
-                self.sid.data,
-                self.price.data,
-                self.qty.data,
-                self.sale.data
-            )
+        queries.run('addExistingProd',
+            self.pid.data,
+            self.sid.data,
+            self.price.data,
+            self.qty.data,
+            self.sale.data
         )
-        conn.close()
         return True
 
 # Product Deletion
-class ProdDeleteForm(Form):
+class ProdDeleteForm(WriteForm):
     '''Deletes a product from the database'''
     pid = IntegerField('Product ID', validators=[Required()])
     submit = SubmitField('Delete Product')
 
-    def validate(self):
-        if not super(Form,self).validate():
+    families = ('products',)
+
+    def apply(self):
+        queries.run('deleteProduct', self.pid.data)
+        return True
+
+# Bulk price and special changes
+class RepriceForm(WriteForm):
+    '''Change the price and special of every inventory row matching a filter
+    The filter is the one of the products page, optionally narrowed to some
+    product ids. Prices move by a percentage or an amount (or both, the
+    percentage first), the special can be left as it is or set.
+    '''
+    filterChoices = [
+        (0,'All products'),
+        (1,'Filter by Store'),
+        (2,'Filter by Zip'),
+        (3,'Filter by City'),
+        (4,'Filter by State'),
+        (5,'Filter by Color')
+    ]
+    filterType = SelectField('Rows to change', choices=filterChoices, coerce=int, default=0)
+    filterVal  = StringField('Filter value', validators=[Optional()])
+    pids       = StringField('Product IDs (comma separated)', validators=[Optional()])
+    percent    = FloatField('Change price by %', validators=[Optional()])
+    amount     = FloatField('Change price by', validators=[Optional()])
+    special    = SelectField('On Sale', choices=[('', 'Leave as is'), ('on', 'On sale'),
+                             ('off', 'Not on sale')], default='')
+    submit     = SubmitField('Apply')
+
+    families = ('products',)
+
+    # Filter types of reprice_inventory by filterType choice
+    filterTypes = {0: None, 1: 'store', 2: 'zip', 3: 'city', 4: 'state', 5: 'color'}
+
+    def check_fields(self):
+        if not super(RepriceForm, self).check_fields():
             return False
 
-        conn = db.engine.connect()
-        conn.execution_options(autocommit=True).execute(
-            'DELETE FROM Products WHERE pid={0};'.format(
-                self.pid.data
-            )
+        if self.filterType.data and not (self.filterVal.data or '').strip():
+            self.filterVal.errors.append('A filter value is required for this filter')
+            return False
+
+        try:
+            self.pid_list = sorted(set(int(pid) for pid in (self.pids.data or '').split(',') if pid.strip()))
+        except ValueError:
+            self.pids.errors.append('Product IDs must be whole numbers separated by commas')
+            return False
+
+        if any(not queries.INT_MIN <= pid <= queries.INT_MAX for pid in self.pid_list):
+            self.pids.errors.append('Product IDs must be between {} and {}'.format(
+                queries.INT_MIN, queries.INT_MAX))
+            return False
+
+        # FloatField takes 'nan' and 'inf' too
+        for field in (self.percent, self.amount):
+            if field.data is not None and not math.isfinite(field.data):
+                field.errors.append('Must be a finite number')
+                return False
+
+        if self.percent.data is None and self.amount.data is None and not self.special.data:
+            self.percent.errors.append('Nothing to change, give a price change or a special')
+            return False
+
+        if self.percent.data is not None and self.percent.data <= -100:
+            self.percent.errors.append('A price can drop by less than 100%')
+            return False
+        return True
+
+    def apply(self):
+        # One statement for every row, changed is how many rows it changed
+        self.changed = queries.run_value('repriceInventory',
+            self.filterTypes[self.filterType.data],
+            (self.filterVal.data or '').strip() or None,
+            self.pid_list or None,
+            self.percent.data,
+            self.amount.data,
+            {'on': True, 'off': False}.get(self.special.data)
         )
-        conn.close()
         return True
 
 # Store creation
-class StoreCreateForm(Form):
+class StoreCreateForm(WriteForm):
     '''Creates a new store location'''
     address = StringField('Address', validators=[Required()])
     city    = StringField('City', validators=[Required()])
@@ -202,10 +298,10 @@ class StoreCreateForm(Form):
     manager = IntegerField('Manager ID', validators=[Required()])
     submit  = SubmitField('Create')
 
-    def validate(self):
-        if not super(Form, self).validate():
-            return False
+    # The new store's manager is employed there
+    families = ('stores', 'employees')
 
+    def apply(self):
         # Ensure zip is numeric and length 5
         if len(self.zip.data) != 5 or not self.zip.data.isnumeric():
             self.zip.errors.append('Invalid Zip Code. Must be 5 numbers')
@@ -242,52 +338,83 @@ class StoreCreateForm(Form):
         # City, State, and Address can't be verified beyond being a string
 
         # Verify manager exists
-        conn = db.engine.connect()
-        managers = conn.execute('SELECT DISTINCT eid FROM Employees WHERE roleid=2;').fetchall()
-        managers = [x[0] for x in managers] # Convert list of tuples to list of ids
-        if self.manager.data not in managers:
+        if validation.missing(managers=[self.manager.data])['managers']:
             self.manager.errors.append('Manager does not exist, please verify ID;')
             return False
 
-        conn.execution_options(autocommit=True).execute(
-            'SELECT * FROM addStore(\'{0}\',\'{1}\',\'{2}\',\'{3}\',\'{4}\',{5});'.format(
-                self.address.data,
-                self.city.data,
-                self.state.data,
-                self.zip.data,
-                self.telno.data,
-                self.manager.data
-            )
+        # created is the new sid
+        self.created = queries.run_value('addStore',
+            self.address.data,
+            self.city.data,
+            self.state.data,
+            self.zip.data,
+            self.telno.data,
+            self.manager.data
         )
-        conn.close()
         return True
 
 # Store deletion
-class StoreDeleteForm(Form):
+class StoreDeleteForm(WriteForm):
     '''Form to delete a store based on sid'''
     sid     = IntegerField('Store ID', validators=[Required()])
     submit  = SubmitField('Delete')
 
-    def validate(self):
-        if not super(Form,self).validate():
-            return False
+    # Its employment and inventory go with it
+    families = ('stores', 'employees', 'products')
 
+    def apply(self):
         # ensure store exists
-        conn = db.engine.connect()
-        sids = conn.execute('SELECT DISTINCT sid FROM Stores;').fetchall()
-        if self.sid.data not in sids:
+        if validation.missing(stores=[self.sid.data])['stores']:
             self.sid.errors.append('Invalid Store ID')
             return False
 
-        # Delete the store
-        conn.execution_options(autocommit=True).execute(
-            'DELETE FROM Stores WHERE sid={0}'.format(
-                self.sid.data
-            )
-        )
-        conn.close()
+        # Delete the store. The check above may have come from the validation
+        # cache, a store deleted since then leaves nothing to delete
+        if not queries.run('deleteStore', self.sid.data):
+            self.sid.errors.append('Invalid Store ID')
+            return False
         return True
 
+# Forms a batch of edits can be made of, by the name of their page
+BATCH_FORMS = {
+    'createEmployee': EmpCreateForm,
+    'deleteEmployee': EmpDeleteForm,
+    'createProduct': ProdCreateForm,
+    'addExistingProduct': ProdAddExistingForm,
+    'deleteProduct': ProdDeleteForm,
+    'repriceProducts': RepriceForm,
+    'createStore': StoreCreateForm,
+    'deleteStore': StoreDeleteForm,
+}
+
+def form_value(value):
+    '''A JSON field value as the string a browser would post for it
+    false and null post as an unticked box or empty field would, true as a
+    ticked box.
+    '''
+    if value is None or value is False:
+        return ''
+    if value is True:
+        return 'y'
+    return str(value)
+
+def apply_batch(edits):
+    '''Apply many form submissions in one unit of work
+    edits is a list of (form name in BATCH_FORMS, {field: value}). Returns
+    the forms and whether they were applied: either every one checks out
+    and they all commit together, in order, or none is written and the
+    errors of the forms say why.
+    '''
+    batch = [BATCH_FORMS[name](MultiDict({field: form_value(value) for field, value in fields.items()}))
+             for name, fields in edits]
+    if not all([form.check_fields() for form in batch]):
+        return batch, False
+
+    if not queries.unit_of_work(lambda: all(form.apply() for form in batch)):
+        return batch, False
+    cache.invalidate(*set(family for form in batch for family in form.families))
+    return batch, True
+
 # Form to filter results based on criteria
 class StoreFilterForm(Form):
     searchChoices = [
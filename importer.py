@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+'''
+Bulk import of employees, products and inventory from csv files
+
+The forms add one row per request, a new region means thousands of them.
+import_csv reads a whole csv file instead, a chunk of rows at a time: each
+row is checked on its own (fields present, numbers, the characters of
+names), the good ones are COPYed into a temporary staging table and the bad
+ones reported by line. Once the file is in, the checks against the database
+(stores, products and roles that must exist) run over the whole staging
+table at once, and the rows left are merged into the tables with a few
+INSERT ... SELECT statements, whatever their number.
+
+The columns of each table are the fields of the form that adds one row:
+
+    employees  firstname, lastname, hourly, pay, roleid, sid
+    products   name, color, sid, price, qty, sale
+    inventory  pid, sid, price, qty, sale
+
+New employees and products get their ids from their sequences, as the forms
+do. An inventory row for a product the store already has replaces it, the
+last one in the file wins.
+
+Nothing is committed here, the import is part of the caller's transaction.
+'''
+import csv
+import io
+import math
+import re
+import time
+
+import queries
+
+# Rows read, checked and COPYed at a time
+CHUNK_SIZE = 5000
+
+# Characters allowed in first and last names, as in EmpCreateForm
+NAME_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-'")
+
+# What COPY takes for INT and NUMERIC columns: ASCII digits only (python's
+# int() and float() also take '1_000' and other scripts' digits), INT in
+# range (queries.INT_MIN to INT_MAX) and exponents NUMERIC can hold
+INTEGER = re.compile(r'[+-]?[0-9]+\Z')
+NUMBER = re.compile(r'[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]{1,3})?\Z')
+
+TRUE_VALUES = ('t', 'true', 'y', 'yes', '1', 'on')
+FALSE_VALUES = ('f', 'false', 'n', 'no', '0', 'off', '')
+
+#=================================== Fields ===================================#
+
+# Each takes the csv value, stripped, and returns what goes into the staging
+# table or raises ValueError with what is wrong with it
+
+def text(value):
+    if not value:
+        raise ValueError('is required')
+    return optional_text(value)
+
+def optional_text(value):
+    if '\x00' in value:
+        raise ValueError('must not contain NUL characters')
+    return value or None
+
+def name(value):
+    if not value:
+        raise ValueError('is required')
+    if set(value) - NAME_CHARS:
+        raise ValueError('must contain letters, hyphens, and apostraphes only')
+    return value
+
+def integer(value):
+    if not INTEGER.match(value):
+        raise ValueError('must be a whole number')
+    number = int(value)
+    if not queries.INT_MIN <= number <= queries.INT_MAX:
+        raise ValueError('is out of range')
+    return number
+
+def count(value):
+    number = integer(value)
+    if number < 0:
+        raise ValueError('must not be negative')
+    return number
+
+def amount(value):
+    if not NUMBER.match(value):
+        raise ValueError('must be a number')
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError('is out of range')
+    if number < 0:
+        raise ValueError('must not be negative')
+    # Sent as written, NUMERIC keeps it exact
+    return value
+
+def boolean(value):
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError('must be true or false')
+
+#=================================== Tables ===================================#
+
+# For each table that can be imported:
+#   columns  the csv columns, their check and staging column type
+#   id       the sequence new rows take their ids from, if they get one
+#   checks   rows failing a condition (on staging row I) are dropped with the
+#            error, after the whole file is staged
+#   merge    statements moving the staging rows into the tables
+#   families the entity families the import changes, see cache.py
+TABLES = {
+    'employees': {
+        'columns': (('firstname', name, 'TEXT'),
+                    ('lastname', name, 'TEXT'),
+                    ('hourly', boolean, 'BOOL'),
+                    ('pay', amount, 'NUMERIC'),
+                    ('roleid', integer, 'INT'),
+                    ('sid', integer, 'INT')),
+        'id': ('employees', 'eid'),
+        'checks': (('roleid: Role does not exist',
+                    'NOT EXISTS (SELECT 1 FROM Roles R WHERE R.roleid = I.roleid)'),
+                   ('sid: Provided Store ID does not match an existing store',
+                    'NOT EXISTS (SELECT 1 FROM Stores S WHERE S.sid = I.sid)')),
+        'merge': ('''INSERT INTO Employees (eid, firstname, lastname, hourly, pay, roleid)
+                     SELECT I.id, I.firstname, I.lastname, I.hourly, I.pay, I.roleid
+                     FROM import_staging I''',
+                  '''INSERT INTO Employment (eid, sid)
+                     SELECT I.id, I.sid
+                     FROM import_staging I'''),
+        'families': ('employees',),
+    },
+    'products': {
+        'columns': (('name', text, 'TEXT'),
+                    ('color', optional_text, 'TEXT'),
+                    ('sid', integer, 'INT'),
+                    ('price', amount, 'NUMERIC'),
+                    ('qty', count, 'INT'),
+                    ('sale', boolean, 'BOOL')),
+        'id': ('products', 'pid'),
+        'checks': (('sid: Provided Store ID does not match an existing store',
+                    'NOT EXISTS (SELECT 1 FROM Stores S WHERE S.sid = I.sid)'),),
+        'merge': ('''INSERT INTO Products (pid, name, color)
+                     SELECT I.id, I.name, I.color
+                     FROM import_staging I''',
+                  '''INSERT INTO Inventory (pid, sid, price, stock, special)
+                     SELECT I.id, I.sid, I.price, I.qty, I.sale
+                     FROM import_staging I'''),
+        'families': ('products',),
+    },
+    'inventory': {
+        'columns': (('pid', integer, 'INT'),
+                    ('sid', integer, 'INT'),
+                    ('price', amount, 'NUMERIC'),
+                    ('qty', count, 'INT'),
+                    ('sale', boolean, 'BOOL')),
+        'id': None,
+        'checks': (('sid: Provided Store ID does not match an existing store',
+                    'NOT EXISTS (SELECT 1 FROM Stores S WHERE S.sid = I.sid)'),
+                   ('pid: Provided Product ID does not match an existing product',
+                    'NOT EXISTS (SELECT 1 FROM Products P WHERE P.pid = I.pid)')),
+        # As addExistingProd, one row per store and product can be upserted
+        'merge': ('''INSERT INTO Inventory (pid, sid, price, stock, special)
+                     SELECT DISTINCT ON (I.sid, I.pid) I.pid, I.sid, I.price, I.qty, I.sale
+                     FROM import_staging I
+                     ORDER BY I.sid, I.pid, I.line DESC
+                     ON CONFLICT ON CONSTRAINT inventory_pkey DO UPDATE
+                     SET price=EXCLUDED.price, stock=EXCLUDED.stock, special=EXCLUDED.special''',),
+        'families': ('products',),
+    },
+}
+
+#=================================== Import ===================================#
+
+def check_row(row, columns):
+    '''The staging values of csv row (a dict), or ValueError for the first
+    field that doesn't check out
+    '''
+    values = []
+    for column, check, sqltype in columns:
+        try:
+            values.append(check((row.get(column) or '').strip()))
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(column, e))
+    return values
+
+def read_chunks(reader, columns, chunk_size):
+    '''Yield (rows, errors) for every chunk_size lines of csv reader
+
+    rows are [line, values...] lists of the rows that checked out, errors
+    (line, message) pairs for the ones that didn't.
+    '''
+    rows, errors = [], []
+    for row in reader:
+        try:
+            rows.append([reader.line_num] + check_row(row, columns))
+        except ValueError as e:
+            errors.append((reader.line_num, str(e)))
+        if len(rows) + len(errors) >= chunk_size:
+            yield rows, errors
+            rows, errors = [], []
+    if rows or errors:
+        yield rows, errors
+
+def create_staging(cur, table):
+    '''Create the temporary staging table for table, dropped on commit'''
+    spec = TABLES[table]
+    columns = ['line INT'] + ['{} {}'.format(column, sqltype) for column, check, sqltype in spec['columns']]
+    if spec['id'] is not None:
+        # COPY draws the new ids from the sequence as the rows come in, in
+        # the order of the file
+        columns.append("id INT DEFAULT nextval(pg_get_serial_sequence('{}', '{}'))".format(*spec['id']))
+    cur.execute('DROP TABLE IF EXISTS import_staging')
+    cur.execute('CREATE TEMP TABLE import_staging ({}) ON COMMIT DROP'.format(', '.join(columns)))
+
+def copy_rows(cur, table, rows):
+    '''COPY rows (as given by read_chunks) into the staging table'''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    columns = ['line'] + [column for column, check, sqltype in TABLES[table]['columns']]
+    cur.copy_expert('COPY import_staging ({}) FROM STDIN WITH (FORMAT csv)'.format(', '.join(columns)),
+                    buffer)
+
+def import_csv(conn, table, f, chunk_size=CHUNK_SIZE, strict=False, max_errors=None):
+    '''Import csv file f (a text file with a header line) into table
+
+    conn is a psycopg2 connection, the import runs in its transaction and
+    isn't committed. With strict nothing is imported if any row has an
+    error. Returns a report:
+
+        {'table': 'employees', 'rows': rows read, 'imported': rows merged,
+         'failed': rows with errors, 'errors': [(line, message), ...],
+         'seconds': time taken}
+
+    Only the first max_errors errors are listed, all of them by default.
+    Raises ValueError when the file lacks some of the table's columns.
+    '''
+    start = time.time()
+    spec = TABLES[table]
+    reader = csv.DictReader(f)
+    missing = [column for column, check, sqltype in spec['columns']
+               if column not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError('Missing columns: {}'.format(', '.join(missing)))
+
+    rows = imported = 0
+    errors = []
+    with conn.cursor() as cur:
+        create_staging(cur, table)
+        for chunk, chunk_errors in read_chunks(reader, spec['columns'], chunk_size):
+            if chunk:
+                copy_rows(cur, table, chunk)
+            rows += len(chunk) + len(chunk_errors)
+            errors.extend(chunk_errors)
+
+        cur.execute('ANALYZE import_staging')
+        for message, condition in spec['checks']:
+            cur.execute('DELETE FROM import_staging I WHERE {} RETURNING I.line'.format(condition))
+            errors.extend((line, message) for line, in cur.fetchall())
+
+        if not (errors and strict):
+            # The first statement writes one row per row imported, inventory
+            # lines a later one replaces don't count
+            for number, statement in enumerate(spec['merge']):
+                cur.execute(statement)
+                if number == 0:
+                    imported = cur.rowcount
+        cur.execute('DROP TABLE import_staging')
+
+    errors.sort()
+    return {
+        'table': table,
+        'rows': rows,
+        'imported': imported,
+        'failed': len(errors),
+        'errors': errors[:max_errors],
+        'seconds': time.time() - start,
+    }
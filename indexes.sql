@@ -0,0 +1,57 @@
+-- Keys and indexes for every filter and join column used by
+-- stored_procedures.sql. This runs after the bulk load in initdb (and after a
+-- snapshot restore): building an index once over loaded data is far cheaper
+-- than updating it for every row COPY adds. Running it again on a database
+-- that has them already changes nothing.
+
+-- The generator can draw the same store/employee or store/product pair more
+-- than once, keep the first of each before the keys go on
+DELETE FROM Employment
+WHERE ctid IN (SELECT ctid
+               FROM (SELECT ctid, ROW_NUMBER() OVER (PARTITION BY sid, eid) AS n
+                     FROM Employment) AS T
+               WHERE T.n > 1);
+
+DELETE FROM Inventory
+WHERE ctid IN (SELECT ctid
+               FROM (SELECT ctid, ROW_NUMBER() OVER (PARTITION BY sid, pid) AS n
+                     FROM Inventory) AS T
+               WHERE T.n > 1);
+
+-- Link tables, the keys double as the index for joins from Stores
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid='Employment'::regclass AND contype='p') THEN
+        ALTER TABLE Employment ADD CONSTRAINT employment_pkey PRIMARY KEY (sid, eid);
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid='Inventory'::regclass AND contype='p') THEN
+        ALTER TABLE Inventory ADD CONSTRAINT inventory_pkey PRIMARY KEY (sid, pid);
+    END IF;
+END;
+$$;
+
+-- The other side of the link tables, for joins from Employees and Products
+-- and for their ON DELETE CASCADE
+CREATE INDEX IF NOT EXISTS employment_eid_idx ON Employment (eid, sid);
+CREATE INDEX IF NOT EXISTS inventory_pid_idx ON Inventory (pid, sid);
+
+-- Store filters, the procedures compare city and state case insensitively
+CREATE INDEX IF NOT EXISTS stores_zip_idx ON Stores (zip);
+CREATE INDEX IF NOT EXISTS stores_city_idx ON Stores (LOWER(city));
+CREATE INDEX IF NOT EXISTS stores_state_idx ON Stores (LOWER(state));
+
+-- Product filters
+CREATE INDEX IF NOT EXISTS products_color_idx ON Products (LOWER(color));
+
+-- Items on special are a fraction of the inventory, getNumSale* only look at those
+CREATE INDEX IF NOT EXISTS inventory_special_idx ON Inventory (sid, pid) WHERE special;
+
+-- Remaining foreign keys, so cascading deletes do not scan
+CREATE INDEX IF NOT EXISTS employees_roleid_idx ON Employees (roleid);
+CREATE INDEX IF NOT EXISTS supplies_pid_idx ON Supplies (pid);
+CREATE INDEX IF NOT EXISTS supplies_supid_idx ON Supplies (supid);
+
+ANALYZE;
@@ -0,0 +1,139 @@
+-- Triggers telling the app workers what changed, so they can drop their
+-- cached pages (see cache.py). Run after the bulk load like rollups.sql, the
+-- triggers keep their transition tables and there is no point doing that
+-- for every COPY of initdb.
+--
+-- Every statement changing Stores, Employees, Employment, Products or
+-- Inventory sends one notification on the silkroad_changes channel, when it
+-- commits, with a JSON payload:
+--
+--     {"table": "employment", "op": "INSERT", "keys": [{"sid": 7, "eid": 1043}],
+--      "at": 1508240000.123}
+--
+-- keys are the keys of the rows changed (the new ones for an UPDATE), NULL
+-- when there are more than 100 of them. at is when the statement ran, in
+-- seconds since the epoch. TRUNCATE isn't covered.
+
+
+-- TG_ARGV holds the key columns of the table
+CREATE OR REPLACE FUNCTION notify_change() RETURNS TRIGGER AS $$
+DECLARE
+    changed INT;
+    keys JSON;
+BEGIN
+    EXECUTE format('SELECT COUNT(*), json_agg(K) FROM (SELECT %s FROM %I LIMIT 101) AS K',
+                   (SELECT string_agg(quote_ident(col), ', ') FROM unnest(TG_ARGV) AS col),
+                   CASE WHEN TG_OP = 'DELETE' THEN 'old_rows' ELSE 'new_rows' END)
+    INTO changed, keys;
+
+    IF changed > 0 THEN
+        PERFORM pg_notify('silkroad_changes', json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'keys', CASE WHEN changed <= 100 THEN keys END,
+            'at', EXTRACT(EPOCH FROM clock_timestamp()))::TEXT);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Stores
+DROP TRIGGER IF EXISTS notify_stores_insert ON Stores;
+CREATE TRIGGER notify_stores_insert
+AFTER INSERT ON Stores
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid');
+
+DROP TRIGGER IF EXISTS notify_stores_update ON Stores;
+CREATE TRIGGER notify_stores_update
+AFTER UPDATE ON Stores
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid');
+
+DROP TRIGGER IF EXISTS notify_stores_delete ON Stores;
+CREATE TRIGGER notify_stores_delete
+AFTER DELETE ON Stores
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid');
+
+
+-- Employees
+DROP TRIGGER IF EXISTS notify_employees_insert ON Employees;
+CREATE TRIGGER notify_employees_insert
+AFTER INSERT ON Employees
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('eid');
+
+DROP TRIGGER IF EXISTS notify_employees_update ON Employees;
+CREATE TRIGGER notify_employees_update
+AFTER UPDATE ON Employees
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('eid');
+
+DROP TRIGGER IF EXISTS notify_employees_delete ON Employees;
+CREATE TRIGGER notify_employees_delete
+AFTER DELETE ON Employees
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('eid');
+
+
+-- Employment
+DROP TRIGGER IF EXISTS notify_employment_insert ON Employment;
+CREATE TRIGGER notify_employment_insert
+AFTER INSERT ON Employment
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid', 'eid');
+
+DROP TRIGGER IF EXISTS notify_employment_update ON Employment;
+CREATE TRIGGER notify_employment_update
+AFTER UPDATE ON Employment
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid', 'eid');
+
+DROP TRIGGER IF EXISTS notify_employment_delete ON Employment;
+CREATE TRIGGER notify_employment_delete
+AFTER DELETE ON Employment
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid', 'eid');
+
+
+-- Products
+DROP TRIGGER IF EXISTS notify_products_insert ON Products;
+CREATE TRIGGER notify_products_insert
+AFTER INSERT ON Products
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('pid');
+
+DROP TRIGGER IF EXISTS notify_products_update ON Products;
+CREATE TRIGGER notify_products_update
+AFTER UPDATE ON Products
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('pid');
+
+DROP TRIGGER IF EXISTS notify_products_delete ON Products;
+CREATE TRIGGER notify_products_delete
+AFTER DELETE ON Products
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('pid');
+
+
+-- Inventory
+DROP TRIGGER IF EXISTS notify_inventory_insert ON Inventory;
+CREATE TRIGGER notify_inventory_insert
+AFTER INSERT ON Inventory
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid', 'pid');
+
+DROP TRIGGER IF EXISTS notify_inventory_update ON Inventory;
+CREATE TRIGGER notify_inventory_update
+AFTER UPDATE ON Inventory
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid', 'pid');
+
+DROP TRIGGER IF EXISTS notify_inventory_delete ON Inventory;
+CREATE TRIGGER notify_inventory_delete
+AFTER DELETE ON Inventory
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_change('sid', 'pid');
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the stored procedures
+
+Times the averages and counts of stored_procedures.sql the way tables.py
+calls them, SELECT * FROM f(...), over argument values sampled from the
+loaded data. Other versions of the procedures, e.g. an older
+stored_procedures.sql out of git, are timed against the current ones: each
+file is loaded into a schema of its own, first on the search_path while it
+runs. Everything happens in one transaction that is rolled back, so the
+database is left as it was.
+
+Every version has to give the same results as the current one, differences
+are reported.
+
+The other benchmarks time the prepared queries of queries.py, how fast
+writes clear the page caches of other workers (cache.py), and the
+procedures creating stores, employees and products called by concurrent
+writers.
+'''
+import math
+import multiprocessing
+import os.path
+import random
+import re
+import statistics
+import time
+
+import psycopg2
+import psycopg2.errorcodes
+
+import cache
+import queries
+
+# Getters timed, with the kind of argument they take
+GETTERS = (
+    ('getAvgSalAll', None), ('getAvgHrlyAll', None), ('getNumEmps', None),
+    ('getAvgPrice', None), ('getNumProds', None), ('getNumSale', None),
+    ('avg_salary_store', 'sid'), ('avg_hourly_store', 'sid'), ('getNumEmpsStore', 'sid'),
+    ('getAvgPriceStore', 'sid'), ('getNumProdsStore', 'sid'), ('getNumSaleStore', 'sid'),
+    ('avg_salary_zip', 'zip'), ('avg_hourly_zip', 'zip'), ('getNumEmpsZip', 'zip'),
+    ('getAvgPriceZip', 'zip'), ('getNumProdsZip', 'zip'), ('getNumSaleZip', 'zip'),
+    ('avg_salary_city', 'city'), ('avg_hourly_city', 'city'), ('getNumEmpsCity', 'city'),
+    ('getAvgPriceCity', 'city'), ('getNumProdsCity', 'city'), ('getNumSaleCity', 'city'),
+    ('avg_salary_state', 'state'), ('avg_hourly_state', 'state'), ('getNumEmpsState', 'state'),
+    ('getAvgPriceState', 'state'), ('getNumProdsState', 'state'), ('getNumSaleState', 'state'),
+    ('getAvgPriceColor', 'color'), ('getNumProdsColor', 'color'), ('getNumSaleColor', 'color'),
+)
+
+# Where the sampled arguments come from
+ARGUMENT_QUERIES = {
+    'sid': 'SELECT sid FROM Stores',
+    'zip': 'SELECT DISTINCT zip FROM Stores',
+    'city': 'SELECT DISTINCT city FROM Stores',
+    'state': 'SELECT DISTINCT state FROM Stores',
+    'color': 'SELECT DISTINCT color FROM Products WHERE color IS NOT NULL',
+}
+
+# Queries of the filter pages timed by benchmark_queries, with the kind of
+# argument they take. The *_page_data ones also get the filter type.
+FILTER_QUERIES = (
+    ('getStoresID', 'sid'), ('getStoresZip', 'zip'), ('getStoresCity', 'city'), ('getStoresState', 'state'),
+    ('getEmpStore', 'sid'), ('getEmpZip', 'zip'), ('getEmpCity', 'city'), ('getEmpState', 'state'),
+    ('getProdStore', 'sid'), ('getProdZip', 'zip'), ('getProdColor', 'color'),
+    ('avg_salary_zip', 'zip'), ('getNumEmpsCity', 'city'), ('getAvgPriceState', 'state'),
+    ('stores_page_data', 'zip'), ('stores_page_data', 'city'),
+    ('employees_page_data', 'sid'), ('employees_page_data', 'zip'),
+    ('products_page_data', 'zip'), ('products_page_data', 'color'),
+)
+
+# Filter type of the *_page_data procedures for each kind of argument
+PAGE_FILTERS = {'sid': 'store', 'zip': 'zip', 'city': 'city', 'state': 'state', 'color': 'color'}
+
+# Rows the pages ask the *_page_data procedures for, the default page size
+# and one more to tell whether another page follows
+PAGE_LIMIT = 51
+
+# Arguments matching nothing, the sentinel values get timed too
+MISSING_ARGUMENTS = {'sid': -1, 'zip': 'none', 'city': 'Nowhere', 'state': 'Nowhere', 'color': 'none'}
+
+
+def sample_arguments(cur, samples, rng):
+    '''Up to samples values of each kind of argument, plus one matching nothing'''
+    arguments = {None: [()]}
+    for kind, query in ARGUMENT_QUERIES.items():
+        cur.execute(query)
+        values = sorted(value for value, in cur.fetchall())
+        values = rng.sample(values, min(samples, len(values)))
+        arguments[kind] = [(value,) for value in values + [MISSING_ARGUMENTS[kind]]]
+    return arguments
+
+def load_procedures(cur, schema, filename):
+    '''Create the procedures in filename inside schema'''
+    cur.execute('CREATE SCHEMA {}'.format(schema))
+    cur.execute('SET LOCAL search_path TO {}, public'.format(schema))
+    with open(filename) as f:
+        cur.execute(f.read())
+
+def time_getters(cur, schema, arguments, repeat):
+    '''Run every getter over its arguments, returns {function: (seconds, results)}
+
+    seconds is the best of repeat runs
+    '''
+    cur.execute('SET LOCAL search_path TO {}'.format(schema))
+    timings = {}
+    for function, kind in GETTERS:
+        placeholders = ', '.join(['%s'] * (kind is not None))
+        query = 'SELECT * FROM {}({});'.format(function, placeholders)
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            results = []
+            for args in arguments[kind]:
+                cur.execute(query, args)
+                results.append(cur.fetchone()[0])
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[function] = (best, results)
+    return timings
+
+def benchmark_procedures(login, filenames=(), samples=20, repeat=3, seed=0):
+    '''Time the current procedures against the ones in filenames
+
+    login is a dict of psycopg2.connect arguments. Returns {version:
+    {function: seconds}}, the current procedures are version 'current'.
+    '''
+    rng = random.Random(seed)
+    conn = psycopg2.connect(**login)
+    try:
+        with conn.cursor() as cur:
+            arguments = sample_arguments(cur, samples, rng)
+            versions = [('current', 'public')]
+            for n, filename in enumerate(filenames):
+                schema = 'procbench_{}'.format(n)
+                load_procedures(cur, schema, filename)
+                versions.append((os.path.basename(filename), schema + ', public'))
+
+            timings = {version: time_getters(cur, schema, arguments, repeat)
+                       for version, schema in versions}
+        conn.rollback()
+    finally:
+        conn.close()
+
+    header = '{:<20} {:>5}  {:>10}'.format('function', 'calls', 'current')
+    for version, _ in versions[1:]:
+        header += '  {:>20} {:>7}'.format(version, 'speedup')
+    print(header)
+
+    totals = {version: 0.0 for version, _ in versions}
+    for function, kind in GETTERS:
+        current, expected = timings['current'][function]
+        line = '{:<20} {:>5}  {:>8.2f}ms'.format(function, len(arguments[kind]), current * 1000)
+        totals['current'] += current
+        for version, _ in versions[1:]:
+            seconds, results = timings[version][function]
+            totals[version] += seconds
+            line += '  {:>18.2f}ms {:>6.1f}x'.format(seconds * 1000, seconds / current)
+            if results != expected:
+                line += '  DIFFERS'
+        print(line)
+
+    line = '{:<20} {:>5}  {:>8.2f}ms'.format('total', '', totals['current'] * 1000)
+    for version, _ in versions[1:]:
+        line += '  {:>18.2f}ms {:>6.1f}x'.format(totals[version] * 1000,
+                                                 totals[version] / totals['current'])
+    print(line)
+
+    return {version: {function: timing[0] for function, timing in timings[version].items()}
+            for version, _ in versions}
+
+#=============================== Prepared queries =============================#
+
+def literal_query(cur, name, params):
+    '''Query name with the values pasted in, the way tables.py used to build it'''
+    return cur.mogrify(re.sub(r'\$\d+', '%s', queries.QUERIES[name]), params)
+
+def benchmark_queries(login, samples=20, repeat=3, seed=0):
+    '''Time the filter page queries with literal values against prepared statements
+
+    Each query runs over sampled arguments, once as a fresh statement per value
+    and once through queries.execute (PREPARE once, then EXECUTE). Times are
+    per call, the best of repeat runs. Returns {(name, kind): (literal, prepared)}.
+    '''
+    rng = random.Random(seed)
+    conn = psycopg2.connect(**login)
+    try:
+        with conn.cursor() as cur:
+            arguments = sample_arguments(cur, samples, rng)
+            timings = {}
+            for name, kind in FILTER_QUERIES:
+                calls = arguments[kind]
+                if name.endswith('_page_data'):
+                    calls = [(PAGE_FILTERS[kind], str(value), None, None, PAGE_LIMIT)
+                             for value, in calls]
+
+                cur.execute('PREPARE {} AS {}'.format(name, queries.QUERIES[name]))
+                literal = prepared = None
+                for _ in range(repeat):
+                    start = time.time()
+                    for params in calls:
+                        cur.execute(literal_query(cur, name, params))
+                        cur.fetchall()
+                    elapsed = (time.time() - start) / len(calls)
+                    literal = elapsed if literal is None else min(literal, elapsed)
+
+                    start = time.time()
+                    for params in calls:
+                        cur.execute(queries.statement(name, len(params)), params)
+                        cur.fetchall()
+                    elapsed = (time.time() - start) / len(calls)
+                    prepared = elapsed if prepared is None else min(prepared, elapsed)
+                cur.execute('DEALLOCATE {}'.format(name))
+
+                timings[name, kind] = (literal, prepared)
+                print('{:<20} {:<6} {:>3} calls  literal {:8.3f}ms  prepared {:8.3f}ms  {:5.2f}x'.format(
+                    name, kind, len(calls), literal * 1000, prepared * 1000, literal / prepared))
+        conn.rollback()
+    finally:
+        conn.close()
+
+    # The slow queries dominate the totals, the median says more about a typical page
+    literal = sum(t[0] for t in timings.values())
+    prepared = sum(t[1] for t in timings.values())
+    print('{:<31} {:>6}  literal {:8.3f}ms  prepared {:8.3f}ms  {:5.2f}x'.format(
+        'total per call', '', literal * 1000, prepared * 1000, literal / prepared))
+    print('median speedup {:.2f}x'.format(statistics.median(t[0] / t[1] for t in timings.values())))
+    return timings
+
+#============================= Cache invalidation =============================#
+
+# Writes timed by benchmark_invalidation: the family they should invalidate,
+# and a statement touching one row without changing it, which fires the
+# triggers all the same. The row comes from the query.
+INVALIDATING_WRITES = (
+    ('stores', 'SELECT sid FROM Stores', 'UPDATE Stores SET telno=telno WHERE sid=%s'),
+    ('employees', 'SELECT eid FROM Employees', 'UPDATE Employees SET pay=pay WHERE eid=%s'),
+    ('employees', 'SELECT sid, eid FROM Employment',
+     'UPDATE Employment SET sid=sid WHERE sid=%s AND eid=%s'),
+    ('products', 'SELECT pid FROM Products', 'UPDATE Products SET name=name WHERE pid=%s'),
+    ('products', 'SELECT sid, pid FROM Inventory',
+     'UPDATE Inventory SET price=price WHERE sid=%s AND pid=%s'),
+)
+
+# Seconds a worker waits for an invalidation before counting it as missed
+INVALIDATION_TIMEOUT = 10
+
+def invalidation_worker(login, rounds, barrier, results):
+    '''One app worker: cache an entry per round and time until it is dropped
+
+    Reports (round, seconds since the epoch it was dropped, or None) to results.
+    '''
+    cache.MAX_ENTRIES = 1
+    cache.LISTEN_LOGIN = login
+    cache.start_listener(login)
+    while not cache.LISTENER['connected']:
+        time.sleep(0.01)
+
+    for n in range(rounds):
+        family = INVALIDATING_WRITES[n % len(INVALIDATING_WRITES)][0]
+        cache.cached(n, (family,), lambda: n)
+        barrier.wait()
+
+        deadline = time.time() + INVALIDATION_TIMEOUT
+        while n in cache.CACHE and time.time() < deadline:
+            time.sleep(0.0002)
+        results.put((n, time.time() if n not in cache.CACHE else None))
+        barrier.wait()
+
+def benchmark_invalidation(login, workers=4, rounds=50, seed=0):
+    '''Time how long a committed write takes to clear the caches of workers
+
+    Starts workers processes listening like app workers do (see cache.py),
+    then commits rounds writes from here, cycling through
+    INVALIDATING_WRITES. The latency is from just before the commit to the
+    entry being gone in a worker. Returns {table: [seconds...]}.
+    '''
+    rng = random.Random(seed)
+    barrier = multiprocessing.Barrier(workers + 1)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=invalidation_worker,
+                                         args=(login, rounds, barrier, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    latencies = {}
+    missed = 0
+    conn = psycopg2.connect(**login)
+    try:
+        with conn.cursor() as cur:
+            keys = {}
+            for _, query, _ in INVALIDATING_WRITES:
+                cur.execute(query + ' LIMIT 1000')
+                keys[query] = cur.fetchall()
+            conn.commit()
+
+            for n in range(rounds):
+                _, query, write = INVALIDATING_WRITES[n % len(INVALIDATING_WRITES)]
+                table = write.split()[1]
+                barrier.wait()
+                cur.execute(write, rng.choice(keys[query]))
+                start = time.time()
+                conn.commit()
+
+                for _ in range(workers):
+                    _, dropped = results.get()
+                    if dropped is None:
+                        missed += 1
+                    else:
+                        latencies.setdefault(table, []).append(dropped - start)
+                barrier.wait()
+    finally:
+        conn.close()
+        for process in processes:
+            process.join()
+
+    print('{:<12} {:>6}  {:>9} {:>9} {:>9}'.format('table', 'drops', 'median', 'p95', 'max'))
+    every = []
+    for table, seconds in sorted(latencies.items()):
+        every += seconds
+        print('{:<12} {:>6}  {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms'.format(
+            table, len(seconds), statistics.median(seconds) * 1000,
+            percentile(seconds, 95) * 1000, max(seconds) * 1000))
+    if every:
+        print('{:<12} {:>6}  {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms'.format(
+            'all', len(every), statistics.median(every) * 1000,
+            percentile(every, 95) * 1000, max(every) * 1000))
+    print('{} workers, {} writes, {} invalidations missed'.format(workers, rounds, missed))
+    return latencies
+
+#================================= Id allocation ==============================#
+
+# Procedures timed by benchmark_inserts and their arguments, given a store
+# and a manager. The rows they create are marked so they can be deleted.
+INSERTS = (
+    ('createEmp', lambda sid, manager: ('Bench', 'Inserts', True, 12.5, 1, sid)),
+    ('createNewProd', lambda sid, manager: ('Bench inserts', 'grey', sid, 9.99, 10, False)),
+    ('addStore', lambda sid, manager: ('1 Bench Street', 'Benchinserts', 'Nowhere', '00000',
+                                       '555-555-5555', manager)),
+)
+INSERTED_ROWS = (
+    "DELETE FROM Employees WHERE firstname = 'Bench' AND lastname = 'Inserts'",
+    "DELETE FROM Products WHERE name = 'Bench inserts'",
+    "DELETE FROM Stores WHERE city = 'Benchinserts'",
+)
+
+def insert_worker(login, search_path, inserts, offset, stores, managers, barrier, results):
+    '''One writer: call the INSERTS in turn, each in a transaction of its own
+
+    Reports ([(procedure, call number, seconds)...], collisions) to results,
+    a collision being a call that failed on a duplicate key.
+    '''
+    rng = random.Random(offset)
+    conn = psycopg2.connect(**login)
+    conn.autocommit = True
+    timings = []
+    collisions = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SET search_path TO {}'.format(search_path))
+            barrier.wait()
+            for n in range(inserts):
+                name, arguments = INSERTS[(n + offset) % len(INSERTS)]
+                params = arguments(rng.choice(stores), rng.choice(managers))
+                start = time.time()
+                try:
+                    cur.execute('SELECT * FROM {}({})'.format(name, ', '.join(['%s'] * len(params))),
+                                params)
+                except psycopg2.IntegrityError as e:
+                    if e.pgcode != psycopg2.errorcodes.UNIQUE_VIOLATION:
+                        raise
+                    collisions += 1
+                    continue
+                timings.append((name, n, time.time() - start))
+    finally:
+        conn.close()
+        results.put((timings, collisions))
+
+def benchmark_inserts(login, filenames=(), workers=4, inserts=500, seed=0):
+    '''Time the creating procedures called by workers concurrent writers
+
+    Every writer makes inserts calls, cycling through INSERTS, against the
+    current procedures and then the versions in filenames (loaded into
+    schemas of their own, as for benchmark_procedures). The rows created are
+    deleted afterwards. Reports the calls that collided on a key and the
+    median latency over the first and the last quarter of the calls, which
+    should match while the tables grow. Returns {version: (collisions,
+    [seconds...])}.
+    '''
+    rng = random.Random(seed)
+    conn = psycopg2.connect(**login)
+    schemas = []
+    results = {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT sid FROM Stores ORDER BY sid LIMIT 1000')
+            stores = [sid for sid, in cur.fetchall()]
+            cur.execute('SELECT eid FROM Employees WHERE roleid=2 ORDER BY eid LIMIT 1000')
+            managers = [eid for eid, in cur.fetchall()]
+            versions = [('current', 'public')]
+            for n, filename in enumerate(filenames):
+                schema = 'procbench_inserts_{}'.format(n)
+                load_procedures(cur, schema, filename)
+                schemas.append(schema)
+                versions.append((os.path.basename(filename), schema + ', public'))
+            conn.commit()
+
+        for version, search_path in versions:
+            barrier = multiprocessing.Barrier(workers)
+            queue = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=insert_worker, args=(
+                             login, search_path, inserts, rng.randrange(1 << 30),
+                             stores, managers, barrier, queue))
+                         for _ in range(workers)]
+            for process in processes:
+                process.start()
+            timings, collisions = [], 0
+            for _ in processes:
+                worker_timings, worker_collisions = queue.get()
+                timings += worker_timings
+                collisions += worker_collisions
+            for process in processes:
+                process.join()
+            results[version] = (collisions, timings)
+    finally:
+        with conn.cursor() as cur:
+            for delete in INSERTED_ROWS:
+                cur.execute(delete)
+            for schema in schemas:
+                cur.execute('DROP SCHEMA {} CASCADE'.format(schema))
+        conn.commit()
+        conn.close()
+
+    print('{:<24} {:>7} {:>10}  {:>12} {:>12}'.format(
+        'version', 'calls', 'collisions', 'first 25%', 'last 25%'))
+    quarter = max(inserts // 4, 1)
+    for version, _ in versions:
+        collisions, timings = results[version]
+        first = [seconds for _, n, seconds in timings if n < quarter]
+        last = [seconds for _, n, seconds in timings if n >= inserts - quarter]
+        print('{:<24} {:>7} {:>10}  {:>10.3f}ms {:>10.3f}ms'.format(
+            version, workers * inserts, collisions,
+            statistics.median(first) * 1000 if first else float('nan'),
+            statistics.median(last) * 1000 if last else float('nan')))
+        for name, _ in INSERTS:
+            seconds = [t for function, _, t in timings if function == name]
+            if seconds:
+                print('  {:<22} {:>7} {:>10}  median {:.3f}ms  p95 {:.3f}ms'.format(
+                    name, len(seconds), '', statistics.median(seconds) * 1000,
+                    percentile(seconds, 95) * 1000))
+    return {version: (collisions, [t for _, _, t in timings])
+            for version, (collisions, timings) in results.items()}
+
+def percentile(values, p):
+    '''The p-th percentile of values, nearest rank'''
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+'''
+Named queries, sent as prepared statements with bound parameters
+
+Every query the pages and forms run is listed in QUERIES, with $1, $2...
+for its parameters. The first time a connection runs one it is PREPAREd,
+later runs are EXECUTE name(...) with the values bound by psycopg2, so
+postgres reuses the parsed statement and (once it settles on a generic
+plan) the plan. Values are never pasted into the SQL, quotes in names are
+fine.
+
+Prepared statements belong to a database connection, which of them a
+connection already has is kept in its sqlalchemy info dict. That dict lives
+as long as the pooled DBAPI connection does, just like the statements.
+
+Whole tables are streamed instead, see stream: a server side cursor can't
+be declared over EXECUTE, so those queries are sent as they are (the values
+are still bound by psycopg2, never pasted in).
+
+A request checks one connection out of the pool, the first time it runs a
+query, and keeps it until the request ends. The pool is sized by the
+SQLALCHEMY_POOL_* settings of appconfig.Config, pool_stats tells how busy it
+is.
+
+A page's query can be given a time limit, see fetch_with_timeout. The
+lookups and writes of a form run in one transaction, see unit_of_work.
+'''
+import random
+import re
+import threading
+import time
+
+from flask import g
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+from psycopg2.extensions import QueryCanceledError, TRANSACTION_STATUS_IDLE
+
+# The database the pages and forms query, and the flask-security models of
+# app.py too: one engine and pool per worker. See init_app
+db = SQLAlchemy()
+
+# Values an INT parameter takes, postgres refuses the query for any other
+INT_MIN, INT_MAX = -2**31, 2**31 - 1
+
+QUERIES = {
+    # Users
+    'getUsers': 'SELECT * FROM flask_security_user',
+
+    # Stores
+    'getStores': 'SELECT * FROM Stores',
+    'getStoresZip': 'SELECT * FROM getStoresZip($1)',
+    'getStoresCity': 'SELECT * FROM getStoresCity($1)',
+    'getStoresState': 'SELECT * FROM getStoresState($1)',
+    'getStoresID': 'SELECT * FROM getStoresID($1)',
+
+    # Employees
+    'getEmployees': 'SELECT * FROM Employees NATURAL JOIN Employment ORDER BY eid',
+    'getEmpZip': 'SELECT * FROM getEmpZip($1)',
+    'getEmpCity': 'SELECT * FROM getEmpCity($1)',
+    'getEmpState': 'SELECT * FROM getEmpState($1)',
+    'getEmpStore': 'SELECT * FROM getEmpStore($1)',
+
+    # Products
+    'getProds': 'SELECT * FROM getProds()',
+    'getProdStore': 'SELECT * FROM getProdStore($1)',
+    'getProdZip': 'SELECT * FROM getProdZip($1)',
+    'getProdCity': 'SELECT * FROM getProdCity($1)',
+    'getProdState': 'SELECT * FROM getProdState($1)',
+    'getProdColor': 'SELECT * FROM getProdColor($1)',
+
+    # Pay averages
+    'getAvgSalAll': 'SELECT * FROM getAvgSalAll()',
+    'getAvgHrlyAll': 'SELECT * FROM getAvgHrlyAll()',
+    'avg_salary_store': 'SELECT * FROM avg_salary_store($1)',
+    'avg_hourly_store': 'SELECT * FROM avg_hourly_store($1)',
+    'avg_salary_zip': 'SELECT * FROM avg_salary_zip($1)',
+    'avg_hourly_zip': 'SELECT * FROM avg_hourly_zip($1)',
+    'avg_salary_city': 'SELECT * FROM avg_salary_city($1)',
+    'avg_hourly_city': 'SELECT * FROM avg_hourly_city($1)',
+    'avg_salary_state': 'SELECT * FROM avg_salary_state($1)',
+    'avg_hourly_state': 'SELECT * FROM avg_hourly_state($1)',
+
+    # Headcounts
+    'getNumEmps': 'SELECT * FROM getNumEmps()',
+    'getNumEmpsStore': 'SELECT * FROM getNumEmpsStore($1)',
+    'getNumEmpsZip': 'SELECT * FROM getNumEmpsZip($1)',
+    'getNumEmpsCity': 'SELECT * FROM getNumEmpsCity($1)',
+    'getNumEmpsState': 'SELECT * FROM getNumEmpsState($1)',
+
+    # Prices and product counts
+    'getAvgPrice': 'SELECT * FROM getAvgPrice()',
+    'getAvgPriceStore': 'SELECT * FROM getAvgPriceStore($1)',
+    'getAvgPriceZip': 'SELECT * FROM getAvgPriceZip($1)',
+    'getAvgPriceCity': 'SELECT * FROM getAvgPriceCity($1)',
+    'getAvgPriceState': 'SELECT * FROM getAvgPriceState($1)',
+    'getAvgPriceColor': 'SELECT * FROM getAvgPriceColor($1)',
+    'getNumProds': 'SELECT * FROM getNumProds()',
+    'getNumProdsStore': 'SELECT * FROM getNumProdsStore($1)',
+    'getNumProdsZip': 'SELECT * FROM getNumProdsZip($1)',
+    'getNumProdsCity': 'SELECT * FROM getNumProdsCity($1)',
+    'getNumProdsState': 'SELECT * FROM getNumProdsState($1)',
+    'getNumProdsColor': 'SELECT * FROM getNumProdsColor($1)',
+    'getNumSale': 'SELECT * FROM getNumSale()',
+    'getNumSaleStore': 'SELECT * FROM getNumSaleStore($1)',
+    'getNumSaleZip': 'SELECT * FROM getNumSaleZip($1)',
+    'getNumSaleCity': 'SELECT * FROM getNumSaleCity($1)',
+    'getNumSaleState': 'SELECT * FROM getNumSaleState($1)',
+    'getNumSaleColor': 'SELECT * FROM getNumSaleColor($1)',
+
+    # Whole pages, see the PAGE DATA procedures
+    'stores_page_data': 'SELECT * FROM stores_page_data($1, $2, $3, $4, $5)',
+    'employees_page_data': 'SELECT * FROM employees_page_data($1, $2, $3, $4, $5)',
+    'products_page_data': 'SELECT * FROM products_page_data($1, $2, $3, $4, $5)',
+
+    # Which of the given store, product and manager ids exist, see validation.py
+    'checkKeys': ('SELECT ARRAY(SELECT S.sid FROM Stores S WHERE S.sid = ANY($1::INT[])), '
+                  'ARRAY(SELECT P.pid FROM Products P WHERE P.pid = ANY($2::INT[])), '
+                  'ARRAY(SELECT E.eid FROM Employees E WHERE E.eid = ANY($3::INT[]) AND E.roleid = 2)'),
+
+    # Writes
+    'createEmp': 'SELECT * FROM createEmp($1, $2, $3, $4, $5, $6)',
+    'deleteEmployee': 'DELETE FROM Employees E WHERE E.eid=$1',
+    'createNewProd': 'SELECT * FROM createNewProd($1, $2, $3, $4, $5, $6)',
+    'addExistingProd': 'SELECT * FROM addExistingProd($1, $2, $3, $4, $5)',
+    'repriceInventory': 'SELECT * FROM reprice_inventory($1, $2, $3, $4, $5, $6)',
+    'deleteProduct': 'DELETE FROM Products P WHERE P.pid=$1',
+    'addStore': 'SELECT * FROM addStore($1, $2, $3, $4, $5, $6)',
+    'deleteStore': 'DELETE FROM Stores S WHERE S.sid=$1',
+}
+
+
+def statement(name, nparams):
+    '''The EXECUTE statement for query name, with psycopg2 placeholders'''
+    if not nparams:
+        return 'EXECUTE {}'.format(name)
+    return 'EXECUTE {}({})'.format(name, ', '.join(['%s'] * nparams))
+
+def execute(conn, name, *params):
+    '''Run query name on conn (a sqlalchemy Connection), returns the result
+
+    The query is prepared on the connection first if it hasn't been yet.
+    '''
+    prepared = conn.info.setdefault('prepared_queries', set())
+    if name not in prepared:
+        conn.execute('PREPARE {} AS {}'.format(name, QUERIES[name]))
+        prepared.add(name)
+    # One set of parameters, even when the first is a list (an array)
+    return conn.execute(statement(name, len(params)), [params])
+
+def fetch_all(name, *params):
+    '''All rows of query name, on the request's connection'''
+    return execute(request_connection(), name, *params).fetchall()
+
+def fetch_value(name, *params):
+    '''First column of the first row of query name'''
+    return execute(request_connection(), name, *params).first()[0]
+
+def run(name, *params):
+    '''Run write query name and commit, returns the number of rows it changed'''
+    conn = request_connection().execution_options(autocommit=True)
+    return execute(conn, name, *params).rowcount
+
+def run_value(name, *params):
+    '''Run write query name, commit and return the first column of its first row
+
+    For the procedures that create a row and return its new id.
+    '''
+    conn = request_connection().execution_options(autocommit=True)
+    return execute(conn, name, *params).first()[0]
+
+def stream(name, *params, batch_size=1000):
+    '''Yield the rows of query name in lists of up to batch_size rows
+
+    The rows stay on the server until they are asked for, only one batch is
+    held here at a time.
+    '''
+    conn = request_connection().execution_options(stream_results=True)
+    result = conn.execute(re.sub(r'\$\d+', '%s', QUERIES[name]), params)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+#============================= Request connections ============================#
+
+# Counters of this process, every worker has a pool of its own
+POOL_STATS = {
+    'checkouts': 0,     # connections handed out by any pool, flask-security's too
+    'connects': 0,      # new database connections opened
+    'invalidated': 0,   # connections found dead (by the pre-ping) and replaced
+    'timeouts': 0,      # requests that gave up waiting for a connection
+    'units': 0,         # units of work committed
+    'retries': 0,       # units of work run again after a serialization failure
+    'requests': 0,      # requests that checked out a connection for queries
+    'wait_total': 0.0,  # seconds those requests waited for it
+    'wait_max': 0.0,
+}
+POOL_STATS_LOCK = threading.Lock()
+
+# Set by init_app from SQLALCHEMY_POOL_PRE_PING
+PRE_PING = False
+
+def init_app(app):
+    '''Set up db for app and return request connections when requests end'''
+    global PRE_PING
+    global WRITE_ISOLATION, WRITE_RETRIES, WRITE_RETRY_DELAY
+    PRE_PING = app.config.get('SQLALCHEMY_POOL_PRE_PING', False)
+    WRITE_ISOLATION = app.config.get('WRITE_ISOLATION', WRITE_ISOLATION)
+    WRITE_RETRIES = app.config.get('WRITE_RETRIES', WRITE_RETRIES)
+    WRITE_RETRY_DELAY = app.config.get('WRITE_RETRY_DELAY', WRITE_RETRY_DELAY)
+    # Bound as SQLAlchemy(app) would, app.py's flask-security models use db
+    # outside of app contexts too
+    db.app = app
+    db.init_app(app)
+    app.teardown_appcontext(release_connection)
+
+def count(key, amount=1):
+    with POOL_STATS_LOCK:
+        POOL_STATS[key] += amount
+
+@event.listens_for(Pool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    count('connects')
+
+@event.listens_for(Pool, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    '''Count the checkout, and make sure the connection is alive when pre-pinging
+
+    SQLAlchemy 1.1 has no pool_pre_ping, this is its pessimistic disconnect
+    recipe: raising DisconnectionError makes the pool replace the connection
+    and try again.
+    '''
+    count('checkouts')
+    if PRE_PING:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+@event.listens_for(Pool, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    count('invalidated')
+
+def request_connection():
+    '''The connection of the current request, checked out on first use'''
+    conn = g.get('db_connection')
+    if conn is None:
+        start = time.time()
+        try:
+            conn = db.engine.connect()
+        except exc.TimeoutError:
+            count('timeouts')
+            raise
+        wait = time.time() - start
+        with POOL_STATS_LOCK:
+            POOL_STATS['requests'] += 1
+            POOL_STATS['wait_total'] += wait
+            POOL_STATS['wait_max'] = max(POOL_STATS['wait_max'], wait)
+        g.db_connection = conn
+    return conn
+
+def release_connection(exception=None):
+    '''Return the request's connection to the pool'''
+    conn = g.pop('db_connection', None)
+    if conn is not None:
+        conn.close()
+
+def pool_stats():
+    '''State of the pool the queries use and the counters of this process'''
+    pool = db.engine.pool
+    with POOL_STATS_LOCK:
+        stats = dict(POOL_STATS)
+    stats['wait_avg'] = stats['wait_total'] / stats['requests'] if stats['requests'] else 0.0
+    # A NullPool or StaticPool has no sizes to report
+    for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, key):
+            stats[key] = getattr(pool, key)()
+    stats['max_overflow'] = getattr(pool, '_max_overflow', None)
+    stats['timeout'] = getattr(pool, '_timeout', None)
+    stats['pre_ping'] = PRE_PING
+    return stats
+
+#================================ Page timeout ================================#
+
+class QueryTimeout(Exception):
+    '''The query of a page took longer than it was given'''
+
+def fetch_with_timeout(name, *params, timeout=None):
+    '''All rows of query name on the request's connection, like fetch_all,
+    cancelled by postgres after timeout seconds (None waits for as long as
+    it takes). Raises QueryTimeout when it was.
+    '''
+    conn = request_connection()
+    try:
+        with conn.begin():
+            if timeout:
+                # Transaction-local, the pooled connection keeps its own
+                conn.execute("SELECT set_config('statement_timeout', %s, true)",
+                             (str(max(int(timeout * 1000), 1)),))
+            return execute(conn, name, *params).fetchall()
+    except exc.OperationalError as e:
+        if not isinstance(e.orig, QueryCanceledError):
+            raise
+        raise QueryTimeout('{} took longer than {}s'.format(name, timeout))
+
+#================================ Units of work ===============================#
+
+# Isolation level of units of work, how many times one postgres gave up on is
+# run again and the delay before the first retry (seconds, doubled for every
+# further one). Set by init_app from WRITE_ISOLATION, WRITE_RETRIES and
+# WRITE_RETRY_DELAY.
+WRITE_ISOLATION = 'SERIALIZABLE'
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY = 0.02
+
+# serialization_failure and deadlock_detected: the transaction was rolled
+# back so that another could go on, running it again will do
+RETRY_CODES = ('40001', '40P01')
+
+def unit_of_work(work):
+    '''Run work() in one transaction on the request's connection
+
+    The lookups and writes work makes (fetch_all, fetch_value, run,
+    run_value) all join the transaction, which commits when work returns
+    something true and rolls back when it returns something false (nothing
+    to write, a form that didn't check out) or raises. Returns what work
+    returned.
+
+    When postgres aborts the transaction over a serialization failure or a
+    deadlock, work runs again after a randomized, doubling delay, up to
+    WRITE_RETRIES times, so it must not change anything but the database
+    before it returns. A unit of work inside another one is part of it.
+    '''
+    conn = request_connection()
+    if conn.in_transaction():
+        return work()
+
+    # Reads made earlier in the request leave a transaction open, the
+    # isolation level has to be set before the first statement
+    if conn.connection.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        conn.connection.rollback()
+
+    attempt = 0
+    while True:
+        transaction = conn.begin()
+        try:
+            conn.execute('SET TRANSACTION ISOLATION LEVEL {}'.format(WRITE_ISOLATION))
+            result = work()
+            if result:
+                transaction.commit()
+                count('units')
+            else:
+                transaction.rollback()
+            return result
+        except exc.DBAPIError as e:
+            if transaction.is_active:
+                transaction.rollback()
+            if getattr(e.orig, 'pgcode', None) not in RETRY_CODES or attempt >= WRITE_RETRIES:
+                raise
+        except BaseException:
+            if transaction.is_active:
+                transaction.rollback()
+            raise
+
+        count('retries')
+        time.sleep(WRITE_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+        attempt += 1
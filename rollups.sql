@@ -0,0 +1,251 @@
+-- Triggers keeping store_stats (see schema.sql) current, and its initial
+-- build. Nothing here relies on the keys from indexes.sql: every column is
+-- tallied from Employment rows by store_stats_tally, the headcounts count
+-- each employee once even if the same store/employee pair is in Employment
+-- twice. The file can run before or after indexes.sql, initdb runs it after
+-- so the initial build reads the deduplicated rows.
+--
+-- Changes are applied as deltas: the tally of the affected employees'
+-- Employment rows after a change, less their tally before it. Employment
+-- changes are handled once per statement from the transition tables, so a
+-- bulk insert updates each store once. Two deletes are the exception. By the
+-- time a cascade removes the Employment rows of a deleted employee the
+-- employee, and so its pay, is gone, and those of a deleted store no longer
+-- have its zip, city and state. A BEFORE DELETE trigger takes an employee's
+-- share out while it is still known, the Employment trigger only counts rows
+-- whose employee still exists. Deleting a store deletes its Employment rows
+-- first, while the store is still there.
+
+
+-- Totals of the Employment rows given as parallel arrays of sids and eids,
+-- one row per store, in the column order of store_stats
+CREATE OR REPLACE FUNCTION store_stats_tally(sids INT[], eids INT[])
+RETURNS TABLE (sid INT, salary_sum NUMERIC, salary_count INT, hourly_sum NUMERIC,
+               hourly_count INT, headcount INT, zip_headcount INT, city_headcount INT,
+               state_headcount INT) AS $$
+    SELECT T.sid,
+           COALESCE(SUM(T.pay) FILTER (WHERE NOT T.hourly), 0),
+           (COUNT(*) FILTER (WHERE NOT T.hourly))::INT,
+           COALESCE(SUM(T.pay) FILTER (WHERE T.hourly), 0),
+           (COUNT(*) FILTER (WHERE T.hourly))::INT,
+           (COUNT(*) FILTER (WHERE T.store_n=1))::INT,
+           (COUNT(*) FILTER (WHERE T.zip_n=1))::INT,
+           (COUNT(*) FILTER (WHERE T.city_n=1))::INT,
+           (COUNT(*) FILTER (WHERE T.state_n=1))::INT
+    FROM (SELECT R.sid, E.pay, E.hourly,
+                 ROW_NUMBER() OVER (PARTITION BY R.eid, R.sid) AS store_n,
+                 ROW_NUMBER() OVER (PARTITION BY R.eid, S.zip ORDER BY R.sid) AS zip_n,
+                 ROW_NUMBER() OVER (PARTITION BY R.eid, LOWER(S.city) ORDER BY R.sid) AS city_n,
+                 ROW_NUMBER() OVER (PARTITION BY R.eid, LOWER(S.state) ORDER BY R.sid) AS state_n
+          FROM unnest(sids, eids) AS R(sid, eid), Employees E, Stores S
+          WHERE R.eid=E.eid
+          AND R.sid=S.sid) AS T
+    GROUP BY T.sid;
+$$ LANGUAGE sql STABLE;
+
+
+-- Add the tally of the rows in after_sids/eids to store_stats and take out
+-- that of the rows in before_sids/eids
+CREATE OR REPLACE FUNCTION store_stats_apply(after_sids INT[], after_eids INT[],
+                                             before_sids INT[], before_eids INT[])
+RETURNS VOID AS $$
+    INSERT INTO store_stats AS R
+    SELECT D.sid, SUM(D.salary_sum), SUM(D.salary_count), SUM(D.hourly_sum),
+           SUM(D.hourly_count), SUM(D.headcount), SUM(D.zip_headcount),
+           SUM(D.city_headcount), SUM(D.state_headcount)
+    FROM (SELECT * FROM store_stats_tally(after_sids, after_eids)
+          UNION ALL
+          SELECT T.sid, -T.salary_sum, -T.salary_count, -T.hourly_sum,
+                 -T.hourly_count, -T.headcount, -T.zip_headcount, -T.city_headcount,
+                 -T.state_headcount
+          FROM store_stats_tally(before_sids, before_eids) T) AS D
+    GROUP BY D.sid
+    ON CONFLICT (sid) DO UPDATE
+    SET salary_sum = R.salary_sum + EXCLUDED.salary_sum,
+        salary_count = R.salary_count + EXCLUDED.salary_count,
+        hourly_sum = R.hourly_sum + EXCLUDED.hourly_sum,
+        hourly_count = R.hourly_count + EXCLUDED.hourly_count,
+        headcount = R.headcount + EXCLUDED.headcount,
+        zip_headcount = R.zip_headcount + EXCLUDED.zip_headcount,
+        city_headcount = R.city_headcount + EXCLUDED.city_headcount,
+        state_headcount = R.state_headcount + EXCLUDED.state_headcount;
+$$ LANGUAGE sql;
+
+
+-- Retally the employees of the rows in new_rows and old_rows. Whether a row
+-- counts towards the zip, city and state headcounts depends on the employee's
+-- other stores, so all its Employment rows are retallied, as they are now and
+-- as they were before the statement.
+CREATE OR REPLACE FUNCTION store_stats_apply_employment() RETURNS TRIGGER AS $$
+DECLARE
+    added_sids INT[] := '{}';
+    added_eids INT[] := '{}';
+    removed_sids INT[] := '{}';
+    removed_eids INT[] := '{}';
+    after_sids INT[];
+    after_eids INT[];
+    before_sids INT[];
+    before_eids INT[];
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT INTO added_sids, added_eids
+               COALESCE(array_agg(N.sid), '{}'), COALESCE(array_agg(N.eid), '{}')
+        FROM new_rows N;
+    END IF;
+
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        SELECT INTO removed_sids, removed_eids
+               COALESCE(array_agg(O.sid), '{}'), COALESCE(array_agg(O.eid), '{}')
+        FROM old_rows O;
+    END IF;
+
+    SELECT INTO after_sids, after_eids
+           COALESCE(array_agg(Emp.sid), '{}'), COALESCE(array_agg(Emp.eid), '{}')
+    FROM Employment Emp
+    WHERE Emp.eid = ANY(added_eids || removed_eids);
+
+    SELECT INTO before_sids, before_eids
+           COALESCE(array_agg(B.sid), '{}'), COALESCE(array_agg(B.eid), '{}')
+    FROM ((SELECT A.sid, A.eid FROM unnest(after_sids, after_eids) AS A(sid, eid)
+           EXCEPT ALL
+           SELECT N.sid, N.eid FROM unnest(added_sids, added_eids) AS N(sid, eid))
+          UNION ALL
+          SELECT O.sid, O.eid FROM unnest(removed_sids, removed_eids) AS O(sid, eid)) AS B;
+
+    PERFORM store_stats_apply(after_sids, after_eids, before_sids, before_eids);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS store_stats_employment_insert ON Employment;
+CREATE TRIGGER store_stats_employment_insert
+AFTER INSERT ON Employment
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE store_stats_apply_employment();
+
+DROP TRIGGER IF EXISTS store_stats_employment_update ON Employment;
+CREATE TRIGGER store_stats_employment_update
+AFTER UPDATE ON Employment
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE store_stats_apply_employment();
+
+DROP TRIGGER IF EXISTS store_stats_employment_delete ON Employment;
+CREATE TRIGGER store_stats_employment_delete
+AFTER DELETE ON Employment
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE store_stats_apply_employment();
+
+
+-- Move the pay of employees whose pay or hourly flag changed, in every store
+-- they work at
+CREATE OR REPLACE FUNCTION store_stats_apply_pay() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE store_stats R
+    SET salary_sum = R.salary_sum + D.salary_sum,
+        salary_count = R.salary_count + D.salary_count,
+        hourly_sum = R.hourly_sum + D.hourly_sum,
+        hourly_count = R.hourly_count + D.hourly_count
+    FROM (SELECT Emp.sid,
+                 COALESCE(SUM(N.pay) FILTER (WHERE NOT N.hourly), 0)
+                 - COALESCE(SUM(O.pay) FILTER (WHERE NOT O.hourly), 0) AS salary_sum,
+                 COUNT(*) FILTER (WHERE NOT N.hourly)
+                 - COUNT(*) FILTER (WHERE NOT O.hourly) AS salary_count,
+                 COALESCE(SUM(N.pay) FILTER (WHERE N.hourly), 0)
+                 - COALESCE(SUM(O.pay) FILTER (WHERE O.hourly), 0) AS hourly_sum,
+                 COUNT(*) FILTER (WHERE N.hourly)
+                 - COUNT(*) FILTER (WHERE O.hourly) AS hourly_count
+          FROM old_rows O, new_rows N, Employment Emp
+          WHERE O.eid=N.eid
+          AND Emp.eid=N.eid
+          AND (O.pay, O.hourly) IS DISTINCT FROM (N.pay, N.hourly)
+          GROUP BY Emp.sid) AS D
+    WHERE R.sid=D.sid;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS store_stats_employees_update ON Employees;
+CREATE TRIGGER store_stats_employees_update
+AFTER UPDATE ON Employees
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE store_stats_apply_pay();
+
+
+-- Take a deleted employee out of its stores while its pay is still known
+CREATE OR REPLACE FUNCTION store_stats_remove_employee() RETURNS TRIGGER AS $$
+DECLARE
+    sids INT[];
+    eids INT[];
+BEGIN
+    SELECT INTO sids, eids
+           COALESCE(array_agg(Emp.sid), '{}'), COALESCE(array_agg(Emp.eid), '{}')
+    FROM Employment Emp
+    WHERE Emp.eid=OLD.eid;
+
+    PERFORM store_stats_apply('{}', '{}', sids, eids);
+
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS store_stats_employees_delete ON Employees;
+CREATE TRIGGER store_stats_employees_delete
+BEFORE DELETE ON Employees
+FOR EACH ROW EXECUTE PROCEDURE store_stats_remove_employee();
+
+
+-- Delete a deleted store's Employment rows while its zip, city and state are
+-- still there, the Employment trigger moves its employees' headcounts to
+-- their next store
+CREATE OR REPLACE FUNCTION store_stats_remove_store() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM Employment Emp WHERE Emp.sid=OLD.sid;
+
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS store_stats_stores_delete ON Stores;
+CREATE TRIGGER store_stats_stores_delete
+BEFORE DELETE ON Stores
+FOR EACH ROW EXECUTE PROCEDURE store_stats_remove_store();
+
+
+-- Moving a store to another zip, city or state changes which of its
+-- employees' stores comes first in each. The app never does it, so the
+-- totals are simply rebuilt.
+CREATE OR REPLACE FUNCTION store_stats_rebuild() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM rebuild_store_stats();
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS store_stats_stores_update ON Stores;
+CREATE TRIGGER store_stats_stores_update
+AFTER UPDATE OF zip, city, state ON Stores
+FOR EACH STATEMENT EXECUTE PROCEDURE store_stats_rebuild();
+
+
+-- Recompute store_stats from scratch
+CREATE OR REPLACE FUNCTION rebuild_store_stats() RETURNS VOID AS $$
+DECLARE
+    sids INT[];
+    eids INT[];
+BEGIN
+    SELECT INTO sids, eids
+           COALESCE(array_agg(Emp.sid), '{}'), COALESCE(array_agg(Emp.eid), '{}')
+    FROM Employment Emp;
+
+    DELETE FROM store_stats;
+
+    INSERT INTO store_stats
+    SELECT * FROM store_stats_tally(sids, eids);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_store_stats();
+ANALYZE store_stats;
@@ -66,3 +66,27 @@ CREATE TABLE Employment (
     sid INTEGER NOT NULL REFERENCES Stores (sid) ON DELETE CASCADE,
     eid INTEGER NOT NULL REFERENCES Employees (eid) ON DELETE CASCADE
 );
+
+-- Pay and headcount totals per store, kept current by the triggers in
+-- rollups.sql. The salary_* and hourly_* sums and counts run over Employment
+-- rows, like the averages computed from the joins always have. The
+-- headcounts count every employee once: headcount at each of its stores, and
+-- zip_, city_ and state_headcount at its lowest sid store of each zip, city
+-- and state. Adding those up over a set of stores gives distinct employees.
+CREATE TABLE store_stats (
+    sid INTEGER PRIMARY KEY REFERENCES Stores (sid) ON DELETE CASCADE,
+    salary_sum NUMERIC NOT NULL DEFAULT 0,
+    salary_count INTEGER NOT NULL DEFAULT 0,
+    hourly_sum NUMERIC NOT NULL DEFAULT 0,
+    hourly_count INTEGER NOT NULL DEFAULT 0,
+    headcount INTEGER NOT NULL DEFAULT 0,
+    zip_headcount INTEGER NOT NULL DEFAULT 0,
+    city_headcount INTEGER NOT NULL DEFAULT 0,
+    state_headcount INTEGER NOT NULL DEFAULT 0
+);
+
+-- What the data was generated with (scale, seed, ...), saved with snapshots
+CREATE TABLE DatasetInfo (
+    key TEXT PRIMARY KEY,
+    value JSONB
+);
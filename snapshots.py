@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+'''
+Save and restore generated datasets
+
+Generating a big dataset takes far longer than loading one. A snapshot keeps
+every table of the public schema as a binary COPY file, plus a manifest.json
+with the scale and seed the data was made with, a hash of the schema it was
+made against, the row counts and the sequence values. Restoring rebuilds the
+schema and loads the files in parallel, a wave of tables at a time so foreign
+keys are always satisfied.
+
+A snapshot can also be kept as a template database, restoring it is then a
+file level copy by CREATE DATABASE ... TEMPLATE.
+'''
+import concurrent.futures
+import hashlib
+import json
+import os, os.path
+import re
+import time
+
+import psycopg2
+
+THIS_FILE_PATH = os.path.dirname(os.path.realpath(__file__))
+
+SNAPSHOT_DIR = os.path.join(THIS_FILE_PATH, 'snapshots')
+
+# Files the schema of a snapshot is checked against
+SCHEMA_FILES = ('schema.sql', 'stored_procedures.sql', 'indexes.sql', 'rollups.sql',
+                'notifications.sql')
+
+# Bytes sent per read while restoring a table
+COPY_BUFFER_SIZE = 1 << 20
+
+# Snapshot names, they end up in a path and in a quoted database name
+NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def schema_hash():
+    '''sha256 of the schema files, a snapshot only restores onto the same schema'''
+    digest = hashlib.sha256()
+    for filename in SCHEMA_FILES:
+        with open(os.path.join(THIS_FILE_PATH, filename), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def snapshot_path(name, directory=None):
+    if not NAME_PATTERN.fullmatch(name):
+        raise RuntimeError('Snapshot names can only have letters, digits, _ and -, not {!r}'.format(name))
+    return os.path.join(directory or SNAPSHOT_DIR, name)
+
+def read_manifest(name, directory=None):
+    path = os.path.join(snapshot_path(name, directory), 'manifest.json')
+    if not os.path.exists(path):
+        raise RuntimeError('There is no snapshot named {!r}'.format(name))
+    with open(path) as f:
+        return json.load(f)
+
+def list_snapshots(directory=None):
+    '''Manifests of every saved snapshot, by name'''
+    directory = directory or SNAPSHOT_DIR
+    if not os.path.isdir(directory):
+        return []
+    return [read_manifest(name, directory) for name in sorted(os.listdir(directory))
+            if NAME_PATTERN.fullmatch(name)
+            and os.path.exists(os.path.join(directory, name, 'manifest.json'))]
+
+def template_name(login, name):
+    return '{}_snapshot_{}'.format(login['dbname'], name)
+
+#=============================== Catalog queries ==============================#
+
+def public_tables(cur):
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public' ORDER BY tablename")
+    return [tablename for tablename, in cur.fetchall()]
+
+def load_waves(cur, tablenames):
+    '''Split tablenames in waves, every table only references earlier waves'''
+    cur.execute('''
+        SELECT conrelid::regclass::text, confrelid::regclass::text
+        FROM pg_constraint
+        WHERE contype = 'f' AND connamespace = 'public'::regnamespace''')
+    references = {tablename: set() for tablename in tablenames}
+    for tablename, referenced in cur.fetchall():
+        if tablename in references and referenced != tablename:
+            references[tablename].add(referenced)
+
+    waves = []
+    loaded = set()
+    while len(loaded) < len(references):
+        wave = sorted(tablename for tablename, referenced in references.items()
+                      if tablename not in loaded and referenced <= loaded)
+        if not wave:
+            raise RuntimeError('Foreign keys between {} form a cycle'.format(
+                ', '.join(sorted(set(references) - loaded))))
+        waves.append(wave)
+        loaded.update(wave)
+    return waves
+
+def sequence_values(cur):
+    cur.execute("SELECT sequencename, last_value FROM pg_sequences WHERE schemaname = 'public'")
+    return dict(cur.fetchall())
+
+def dataset_info(cur):
+    '''What the data was generated with, as recorded by initdb'''
+    cur.execute("SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = 'datasetinfo'")
+    if cur.fetchone() is None:
+        return {}
+    cur.execute('SELECT key, value::text FROM DatasetInfo')
+    return {key: json.loads(value) for key, value in cur.fetchall()}
+
+#=================================== Saving ===================================#
+
+def save_snapshot(login, name, directory=None, template=False, force=False, verbosity=0):
+    '''save_snapshot(login, name) -> manifest
+
+    login is a dict of psycopg2.connect arguments. The tables are read in one
+    repeatable read transaction so the files are consistent with each other.
+    With template the database is also cloned to a template database, which
+    needs every other connection to it closed.
+    '''
+    path = snapshot_path(name, directory)
+    if os.path.exists(os.path.join(path, 'manifest.json')) and not force:
+        raise RuntimeError('Snapshot {!r} already exists'.format(name))
+    os.makedirs(path, exist_ok=True)
+
+    start = time.time()
+    conn = psycopg2.connect(**login)
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cur:
+            info = dataset_info(cur)
+            tablenames = public_tables(cur)
+            manifest = {
+                'name': name,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'database': login['dbname'],
+                'scale': info.get('scale'),
+                'seed': info.get('seed'),
+                'info': info,
+                'schema_hash': schema_hash(),
+                'waves': load_waves(cur, tablenames),
+                'sequences': sequence_values(cur),
+                'tables': [],
+                'template': None,
+            }
+
+            for tablename in tablenames:
+                filename = tablename + '.copy'
+                with open(os.path.join(path, filename), 'wb') as f:
+                    cur.copy_expert('COPY {} TO STDOUT WITH (FORMAT binary)'.format(tablename), f)
+                    size = f.tell()
+                manifest['tables'].append({'name': tablename, 'file': filename,
+                                           'rows': cur.rowcount, 'bytes': size})
+                if verbosity:
+                    print('Saved {} rows of {} ({:.1f} MB)'.format(cur.rowcount, tablename, size / 2**20))
+        conn.rollback()
+    finally:
+        conn.close()
+
+    if template:
+        manifest['template'] = template_name(login, name)
+        clone_database(login, login['dbname'], manifest['template'])
+        if verbosity:
+            print('Cloned {} to template database {}'.format(login['dbname'], manifest['template']))
+
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    if verbosity:
+        print('Saved snapshot {} in {:.2f}s'.format(name, time.time() - start))
+    return manifest
+
+def clone_database(login, source, target):
+    '''Replace database target by a copy of source
+
+    Runs on the maintenance database. Connections to target are closed, and
+    CREATE DATABASE fails if anyone else is connected to source.
+    '''
+    conn = psycopg2.connect(**dict(login, dbname='postgres'))
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+                        'WHERE datname = %s AND pid <> pg_backend_pid()', (target,))
+            cur.execute('DROP DATABASE IF EXISTS "{}"'.format(target))
+            cur.execute('CREATE DATABASE "{}" TEMPLATE "{}"'.format(target, source))
+    finally:
+        conn.close()
+
+#================================== Restoring =================================#
+
+def restore_table(login, path, table):
+    '''Load one table file on its own connection, returns seconds taken
+
+    A snapshot is consistent already, so where allowed (superusers) the
+    foreign key triggers are skipped for the load
+    '''
+    start = time.time()
+    conn = psycopg2.connect(**login)
+    try:
+        with conn, conn.cursor() as cur:
+            try:
+                cur.execute('SAVEPOINT replica')
+                cur.execute('SET LOCAL session_replication_role = replica')
+            except psycopg2.Error:
+                cur.execute('ROLLBACK TO SAVEPOINT replica')
+
+            with open(os.path.join(path, table['file']), 'rb') as f:
+                cur.copy_expert('COPY {} FROM STDIN WITH (FORMAT binary)'.format(table['name']),
+                                f, size=COPY_BUFFER_SIZE)
+    finally:
+        conn.close()
+    return time.time() - start
+
+def restore_snapshot(login, name, directory=None, setup=None, finish=None, workers=4,
+                     template=None, force=False, verbosity=0):
+    '''Restore snapshot name into the database login connects to
+
+    setup(conn) has to create the empty tables and commit, finish(conn) runs
+    after the data is in (indexes, analyze). template=None uses the template
+    database when the snapshot has one. force restores a snapshot made with
+    a different schema.
+    '''
+    start = time.time()
+    manifest = read_manifest(name, directory)
+    if template is None:
+        template = bool(manifest['template'])
+
+    # Checked before anything is dropped, the template database is as old as
+    # the files
+    if manifest['schema_hash'] != schema_hash() and not force:
+        raise RuntimeError('Snapshot {!r} was saved with a different schema'.format(name))
+
+    if template:
+        if not manifest['template']:
+            raise RuntimeError('Snapshot {!r} was saved without a template database'.format(name))
+        clone_database(login, manifest['template'], login['dbname'])
+        if verbosity:
+            print('Restored {} from template database {} in {:.2f}s'.format(
+                login['dbname'], manifest['template'], time.time() - start))
+        return manifest
+
+    conn = psycopg2.connect(**login)
+    try:
+        if setup is not None:
+            setup(conn)
+
+        path = snapshot_path(name, directory)
+        tables = {table['name']: table for table in manifest['tables']}
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            for wave in manifest['waves']:
+                elapsed = pool.map(lambda tablename: restore_table(login, path, tables[tablename]), wave)
+                for tablename, seconds in zip(wave, elapsed):
+                    if verbosity:
+                        print('Restored {} rows into {} in {:.2f}s'.format(
+                            tables[tablename]['rows'], tablename, seconds))
+
+        with conn, conn.cursor() as cur:
+            for sequence, value in manifest['sequences'].items():
+                if value is not None:
+                    cur.execute('SELECT setval(%s, %s)', (sequence, value))
+            if finish is not None:
+                finish(conn)
+            cur.execute('ANALYZE')
+    finally:
+        conn.close()
+
+    if verbosity:
+        print('Restored snapshot {} in {:.2f}s'.format(name, time.time() - start))
+    return manifest
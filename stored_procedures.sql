@@ -11,275 +11,100 @@
 -- already done it.
 --CREATE LANGUAGE 'plpgsql';
 
+-- The averages and counts are plain SQL functions rather than plpgsql.
+-- Called from a FROM clause, as in SELECT * FROM avg_salary_zip('33620'),
+-- postgres inlines them into the calling query and plans them with the actual
+-- argument. That only works for set returning functions, so they are declared
+-- SETOF but always return exactly one row. The sentinels (-1.0 for the pay
+-- averages, 0 otherwise) come from COALESCE, an aggregate with no matching
+-- rows still gives one row of NULL.
+
 -- Get the average salary for all employees at all stores
-CREATE OR REPLACE FUNCTION getAvgSalAll() RETURNS FLOAT AS $$
-DECLARE
-    avg_sal float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_sal ROUND(AVG(T.pay),2)
-    FROM (SELECT DISTINCT E.eid, E.pay 
-          FROM Employees E
-          WHERE E.hourly='False') AS T;
-
-    IF avg_sal IS NOT NULL
-        THEN RETURN avg_sal;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION getAvgSalAll() RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(E.pay),2), 0.0)::FLOAT
+    FROM Employees E
+    WHERE E.hourly='False';
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 -- Get the average hourly pay for all employees at all stores
-CREATE OR REPLACE FUNCTION getAvgHrlyAll() RETURNS FLOAT AS $$
-DECLARE
-    avg_hourly float := 0.0;
-BEGIN
+CREATE OR REPLACE FUNCTION getAvgHrlyAll() RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(E.pay),2), 0.0)::FLOAT
+    FROM Employees E
+    WHERE E.hourly='True';
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
-    SELECT INTO avg_hourly ROUND(AVG(T.pay),2)
-    FROM (SELECT DISTINCT E.eid, E.pay
-          FROM Employees E
-          WHERE E.hourly='True') AS T;
-
-    IF avg_hourly IS NOT NULL
-        THEN RETURN avg_hourly;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
 
+-- The per store, zip, city and state averages below are read from the pay
+-- totals in store_stats, see rollups.sql
 
 -- Average salary by store
-CREATE OR REPLACE FUNCTION avg_salary_store(sid INT) RETURNS FLOAT AS $$
-DECLARE
-    avg_sal float := 0.0;
-BEGIN
-    
-    IF NOT EXISTS
-        (SELECT 1
-         FROM Stores
-         WHERE Stores.sid=$1)
-        THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO avg_sal ROUND(AVG(E.pay),2)
-        FROM Employees E, Employment Emp
-        WHERE  E.eid=Emp.eid
-        AND Emp.sid=$1
-        AND E.hourly='False';
-
-        IF avg_sal IS NOT NULL
-            THEN RETURN avg_sal;
-            ELSE RETURN -1.0;
-        END IF;
-
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_salary_store(sid INT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.salary_sum) / NULLIF(SUM(R.salary_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R
+    WHERE R.sid=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Average hourly by store
-CREATE OR REPLACE FUNCTION avg_hourly_store(sid INT) RETURNS FLOAT AS $$
-DECLARE
-    avg_sal float := 0.0;
-BEGIN
-    
-    IF NOT EXISTS
-        (SELECT 1
-         FROM Stores
-         WHERE Stores.sid=$1)
-        THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO avg_sal ROUND(AVG(E.pay),2)
-        FROM Employees E, Employment Emp
-        WHERE  E.eid=Emp.eid
-        AND Emp.sid=$1
-        AND E.hourly='True';
-
-        IF avg_sal IS NOT NULL
-            THEN RETURN avg_sal;
-            ELSE RETURN -1.0;
-        END IF;
-
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_hourly_store(sid INT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.hourly_sum) / NULLIF(SUM(R.hourly_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R
+    WHERE R.sid=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 -- Compile the average salary for a given zip code
-CREATE OR REPLACE FUNCTION avg_salary_zip (zip TEXT) RETURNS FLOAT AS $$
-DECLARE
-	sal_avg float := 0.0;
-BEGIN
-
-    IF NOT EXISTS--A
-        (SELECT 1
-        FROM Stores S
-        WHERE S.zip = $1)
-    THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO sal_avg ROUND(AVG(E.pay), 2)
-        FROM Employment emp, Employees E, Stores S
-        WHERE emp.sid=S.sid AND S.zip=$1 
-              AND E.eid=emp.eid AND E.hourly='False';
-
-        IF sal_avg IS NOT NULL--B
-            THEN RETURN sal_avg;
-            ELSE RETURN -1.0;
-        END IF;--B
-    END IF;--A
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_salary_zip(zip TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.salary_sum) / NULLIF(SUM(R.salary_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND S.zip=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 
 -- Compile the average hourly pay for a given zip code
-CREATE OR REPLACE FUNCTION avg_hourly_zip(zip TEXT) RETURNS FLOAT AS $$
-DECLARE
-	hourly_avg float := 0;
-BEGIN
-
-    IF NOT EXISTS
-        (SELECT 1
-        FROM Stores S
-        WHERE S.zip = $1)
-    THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO hourly_avg ROUND(AVG(E.pay),2)
-        FROM Employment emp, Stores S, Employees E
-        WHERE emp.sid = S.sid AND S.zip=$1 
-              AND emp.eid=E.eid AND E.hourly='TRUE';
-
-        IF hourly_avg IS NOT NULL
-            THEN RETURN hourly_avg;
-            ELSE RETURN -1.0;
-        END IF;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_hourly_zip(zip TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.hourly_sum) / NULLIF(SUM(R.hourly_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND S.zip=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 
 -- Get the average salary per store for all stores in a city
 -- Returns -1.0 if the city is invalid, the average rounded to 2 places
 -- otherwise
-CREATE OR REPLACE FUNCTION avg_salary_city(city TEXT) RETURNS FLOAT AS $$
-DECLARE
-	city_sal_avg float := 0;
-BEGIN
-
-    IF NOT EXISTS
-        (SELECT 1
-        FROM Stores S
-        WHERE LOWER(S.city)=LOWER($1))
-    THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO city_sal_avg ROUND(AVG(E.pay),2)
-        FROM Employment emp, Stores S, Employees E
-        WHERE emp.sid = S.sid AND LOWER(S.city)=LOWER($1) 
-              AND emp.eid=E.eid AND E.hourly = 'FALSE';
-
-        IF city_sal_avg IS NOT NULL
-            THEN RETURN city_sal_avg;
-            ELSE RETURN -1.0;
-        END IF;
-    END IF;
-END;
-$$LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_salary_city(city TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.salary_sum) / NULLIF(SUM(R.salary_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND LOWER(S.city)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get the average hourly pay per store for all stroes in a city
-CREATE OR REPLACE FUNCTION avg_hourly_city(city TEXT) RETURNS FLOAT AS $$
-DECLARE
-    city_hourly_avg float := -1.0;
-BEGIN
-
-    IF NOT EXISTS
-        (SELECT 1
-        FROM Stores S
-        WHERE LOWER(S.city)=LOWER($1))
-    THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO city_hourly_avg ROUND(AVG(E.pay),2)
-        FROM Employment Emp, Stores S, Employees E
-        WHERE Emp.sid = S.sid AND LOWER(S.city)=LOWER($1) 
-              AND Emp.eid=E.eid AND E.hourly='True';
-
-        IF city_hourly_avg IS NOT NULL
-            THEN RETURN city_hourly_avg;
-            ELSE RETURN -1.0;
-        END IF;
-    END IF;
-END;
-$$LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_hourly_city(city TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.hourly_sum) / NULLIF(SUM(R.hourly_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND LOWER(S.city)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 
 -- Get the average salary per store for all stores in a state
-CREATE OR REPLACE FUNCTION avg_salary_state(state TEXT) RETURNS FLOAT AS $$
-DECLARE
-    state_salary_avg float := -1.0;
-BEGIN
-
-    IF NOT EXISTS
-        (SELECT 1
-        FROM Stores S
-        WHERE LOWER(S.state)=LOWER($1))
-    THEN RETURN -1.0;
-    
-    ELSE 
-
-        SELECT INTO state_salary_avg ROUND(AVG(E.pay), 2)
-        FROM Stores S, Employees E, Employment Emp
-        WHERE Emp.sid=S.sid AND Emp.eid=E.eid AND LOWER(S.state)=LOWER($1)
-              AND E.Hourly='False';
-        
-        IF state_salary_avg IS NOT NULL
-            THEN RETURN state_salary_avg;
-            ELSE RETURN -1.0;
-        END IF;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_salary_state(state TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.salary_sum) / NULLIF(SUM(R.salary_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND LOWER(S.state)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 
 -- Get the average hourly pay per store for all stores in a state
 
-CREATE OR REPLACE FUNCTION avg_hourly_state(state TEXT) RETURNS FLOAT AS $$
-DECLARE
-    state_hourly_avg float := -1.0;
-BEGIN
-
-    IF NOT EXISTS
-        (SELECT 1
-         FROM Stores S
-         WHERE LOWER(S.state)=LOWER($1))
-    THEN RETURN -1.0;
-
-    ELSE
-
-        SELECT INTO state_hourly_avg ROUND(AVG(E.pay),2)
-        FROM Employment Emp, Employees E, Stores S
-        WHERE Emp.sid=S.sid AND Emp.eid=E.eid AND LOWER(S.state)=LOWER($1)
-              AND E.hourly='True';
-
-        IF state_hourly_avg IS NOT NULL
-            THEN RETURN state_hourly_avg;
-            ELSE RETURN -1.0;
-        END IF;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION avg_hourly_state(state TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(SUM(R.hourly_sum) / NULLIF(SUM(R.hourly_count), 0), 2), -1.0)::FLOAT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND LOWER(S.state)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 
@@ -371,95 +196,40 @@ $$ LANGUAGE 'sql' STABLE;
 
 -- NUMERICS
 -- Get number of employees overall:
-CREATE OR REPLACE FUNCTION getNumEmps() RETURNS INT AS $$
-DECLARE
-    num_emps int := 0;
-BEGIN
-    
-    SELECT INTO num_emps COUNT(DISTINCT E.eid)
+CREATE OR REPLACE FUNCTION getNumEmps() RETURNS SETOF INT AS $$
+    SELECT COUNT(*)::INT
     FROM Employees E;
-
-    IF num_emps IS NOT NULL
-        THEN RETURN num_emps;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get number of employees for store
-CREATE OR REPLACE FUNCTION getNumEmpsStore(sid INT) RETURNS INT AS $$
-DECLARE
-    num_emps int := 0;
-BEGIN
-    
-    SELECT INTO num_emps COUNT(DISTINCT E.eid)
-    FROM Employees E, Employment Emp
-    WHERE E.eid=Emp.eid 
-    AND Emp.sid=$1;
-
-    IF num_emps IS NOT NULL
-        THEN RETURN num_emps;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION getNumEmpsStore(sid INT) RETURNS SETOF INT AS $$
+    SELECT COALESCE(SUM(R.headcount), 0)::INT
+    FROM store_stats R
+    WHERE R.sid=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get number of employees for zip
-CREATE OR REPLACE FUNCTION getNumEmpsZip(zip TEXT) RETURNS INT AS $$
-DECLARE
-    num_emps int := 0;
-BEGIN
-    
-    SELECT INTO num_emps COUNT(DISTINCT E.eid)
-    FROM Employees E, Employment Emp, Stores S
-    WHERE E.eid=Emp.eid 
-    AND Emp.sid=S.sid
-    AND S.zip=$1;
-
-    IF num_emps IS NOT NULL
-        THEN RETURN num_emps;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+-- Someone working at two stores of a zip (city, state) is one employee, so
+-- these add up the headcounts counting each employee at its first store there
+CREATE OR REPLACE FUNCTION getNumEmpsZip(zip TEXT) RETURNS SETOF INT AS $$
+    SELECT COALESCE(SUM(R.zip_headcount), 0)::INT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND S.zip=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get number of employees for city
-CREATE OR REPLACE FUNCTION getNumEmpsCity(city TEXT) RETURNS INT AS $$
-DECLARE
-    num_emps int := 0;
-BEGIN
-    
-    SELECT INTO num_emps COUNT(DISTINCT E.eid)
-    FROM Employees E, Employment Emp, Stores S
-    WHERE E.eid=Emp.eid 
-    AND Emp.sid=S.sid
-    AND LOWER(S.city)=LOWER($1);
-
-    IF num_emps IS NOT NULL
-        THEN RETURN num_emps;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION getNumEmpsCity(city TEXT) RETURNS SETOF INT AS $$
+    SELECT COALESCE(SUM(R.city_headcount), 0)::INT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND LOWER(S.city)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get number of employees for state
-CREATE OR REPLACE FUNCTION getNumEmpsState(state TEXT) RETURNS INT AS $$
-DECLARE
-    num_emps int := 0;
-BEGIN
-    
-    SELECT INTO num_emps COUNT(DISTINCT E.eid)
-    FROM Employees E, Employment Emp, Stores S
-    WHERE E.eid=Emp.eid 
-    AND Emp.sid=S.sid
-    AND LOWER(S.state)=LOWER($1);
-
-    IF num_emps IS NOT NULL
-        THEN RETURN num_emps;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION getNumEmpsState(state TEXT) RETURNS SETOF INT AS $$
+    SELECT COALESCE(SUM(R.state_headcount), 0)::INT
+    FROM store_stats R, Stores S
+    WHERE R.sid=S.sid AND LOWER(S.state)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 
 
@@ -542,7 +312,7 @@ SETOF ProdRow as $$
     WHERE P.pid in (SELECT I.pid 
                     FROM inventory I, Stores S
                     WHERE S.sid=I.sid
-                    AND LOWER(S.zip)=LOWER($1))
+                    AND S.zip=$1)
     ORDER BY P.pid;
 $$ LANGUAGE 'sql' STABLE;
 
@@ -581,357 +351,490 @@ SETOF ProdRow AS $$
 $$ LANGUAGE 'sql' STABLE;
 
 -- Get overall average price
-CREATE OR REPLACE FUNCTION getAvgPrice() RETURNS
-FLOAT AS $$
-DECLARE
-    avg_price float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_price ROUND(AVG(I.price),2)
+CREATE OR REPLACE FUNCTION getAvgPrice() RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(I.price),2), 0.0)::FLOAT
     FROM Inventory I;
-
-    IF avg_price IS NOT NULL
-        THEN RETURN avg_price;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get average price by store
-CREATE OR REPLACE FUNCTION getAvgPriceStore(sid int) RETURNS
-FLOAT AS $$
-DECLARE
-    avg_price float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_price ROUND(AVG(I.price),2)
+CREATE OR REPLACE FUNCTION getAvgPriceStore(sid int) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(I.price),2), 0.0)::FLOAT
     FROM Inventory I
     WHERE I.sid = $1;
-
-    IF avg_price IS NOT NULL
-        THEN RETURN avg_price;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get average price by zip
-CREATE OR REPLACE FUNCTION getAvgPriceZip(zip TEXT) RETURNS
-FLOAT AS $$
-DECLARE
-    avg_price float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_price ROUND(AVG(I.price),2)
+CREATE OR REPLACE FUNCTION getAvgPriceZip(zip TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(I.price),2), 0.0)::FLOAT
     FROM Inventory I, Stores S
     WHERE I.sid=S.sid
     AND S.zip=$1;
-
-    IF avg_price IS NOT NULL
-        THEN RETURN avg_price;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get average price by city
-CREATE OR REPLACE FUNCTION getAvgPriceCity(city TEXT) RETURNS
-FLOAT AS $$
-DECLARE
-    avg_price float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_price ROUND(AVG(I.price),2)
+CREATE OR REPLACE FUNCTION getAvgPriceCity(city TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(I.price),2), 0.0)::FLOAT
     FROM Inventory I, Stores S
     WHERE I.sid=S.sid
     AND LOWER(S.city)=LOWER($1);
-
-    IF avg_price IS NOT NULL
-        THEN RETURN avg_price;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get average price by state
-CREATE OR REPLACE FUNCTION getAvgPriceState(state TEXT) RETURNS
-FLOAT AS $$
-DECLARE
-    avg_price float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_price ROUND(AVG(I.price),2)
+CREATE OR REPLACE FUNCTION getAvgPriceState(state TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(I.price),2), 0.0)::FLOAT
     FROM Inventory I, Stores S
     WHERE I.sid=S.sid
     AND LOWER(S.state)=LOWER($1);
-
-    IF avg_price IS NOT NULL
-        THEN RETURN avg_price;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Get average price by color
-CREATE OR REPLACE FUNCTION getAvgPriceColor(color TEXT) RETURNS
-FLOAT AS $$
-DECLARE
-    avg_price float := 0.0;
-BEGIN
-    
-    SELECT INTO avg_price ROUND(AVG(I.price),2)
+CREATE OR REPLACE FUNCTION getAvgPriceColor(color TEXT) RETURNS SETOF FLOAT AS $$
+    SELECT COALESCE(ROUND(AVG(I.price),2), 0.0)::FLOAT
     FROM Inventory I, Products P
     WHERE I.pid = P.pid
     AND LOWER(P.color)=LOWER($1);
-
-    IF avg_price IS NOT NULL
-        THEN RETURN avg_price;
-        ELSE RETURN 0.0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 ----- NUMBER OF Products
 -- All stores
-CREATE OR REPLACE FUNCTION getNumProds() RETURNS INT AS $$
-DECLARE
-    numProds INT := 0;
-BEGIN
-    
-    SELECT INTO numProds COUNT(DISTINCT P.pid)
+CREATE OR REPLACE FUNCTION getNumProds() RETURNS SETOF INT AS $$
+    SELECT COUNT(*)::INT
     FROM Products P;
-
-    IF numProds IS NOT NULL
-        THEN RETURN numProds;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- By zip
-CREATE OR REPLACE FUNCTION getNumProdsZip(zip TEXT) RETURNS INT AS $$
-DECLARE
-    numProds INT := 0;
-BEGIN
-    
-    SELECT INTO numProds COUNT(DISTINCT P.pid)
-    FROM Products P, Inventory I, Stores S
-    WHERE P.pid=I.pid
-    AND S.sid=I.sid
+CREATE OR REPLACE FUNCTION getNumProdsZip(zip TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
+    FROM Inventory I, Stores S
+    WHERE I.sid=S.sid
     AND S.zip=$1;
-
-    IF numProds IS NOT NULL
-        THEN RETURN numProds;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- By City
-CREATE OR REPLACE FUNCTION getNumProdsCity(city TEXT) RETURNS INT AS $$
-DECLARE
-    numProds INT := 0;
-BEGIN
-    
-    SELECT INTO numProds COUNT(DISTINCT P.pid)
-    FROM Products P, Inventory I, Stores S
-    WHERE P.pid=I.pid
-    AND I.sid=S.sid
+CREATE OR REPLACE FUNCTION getNumProdsCity(city TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
+    FROM Inventory I, Stores S
+    WHERE I.sid=S.sid
     AND LOWER(S.city)=LOWER($1);
-
-    IF numProds IS NOT NULL
-        THEN RETURN numProds;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- By State
-CREATE OR REPLACE FUNCTION getNumProdsState(state TEXT) RETURNS INT AS $$
-DECLARE
-    numProds INT := 0;
-BEGIN
-    
-    SELECT INTO numProds COUNT(DISTINCT P.pid)
-    FROM Products P, Inventory I, Stores S
-    WHERE P.pid=I.pid
-    AND I.sid=S.sid
+CREATE OR REPLACE FUNCTION getNumProdsState(state TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
+    FROM Inventory I, Stores S
+    WHERE I.sid=S.sid
     AND LOWER(S.state)=LOWER($1);
-
-    IF numProds IS NOT NULL
-        THEN RETURN numProds;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- By Color
-CREATE OR REPLACE FUNCTION getNumProdsColor(color TEXT) RETURNS INT AS $$
-DECLARE
-    numProds INT := 0;
-BEGIN
-    
-    SELECT INTO numProds COUNT(DISTINCT P.pid)
+CREATE OR REPLACE FUNCTION getNumProdsColor(color TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT P.pid)::INT
     FROM Products P, Inventory I
     WHERE P.pid=I.pid
     AND LOWER(P.color)=LOWER($1);
-
-    IF numProds IS NOT NULL
-        THEN RETURN numProds;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- By store
-CREATE OR REPLACE FUNCTION getNumProdsStore(sid INT) RETURNS INT AS $$
-DECLARE
-    numProds INT := 0;
-BEGIN
-    
-    SELECT INTO numProds COUNT(DISTINCT P.pid)
-    FROM Products P, Inventory I
-    WHERE P.pid=I.pid
-    AND I.sid=$1;
-
-    IF numProds IS NOT NULL
-        THEN RETURN numProds;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION getNumProdsStore(sid INT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
+    FROM Inventory I
+    WHERE I.sid=$1;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- GET NUMBER OF ITEMS ON SPECIAL
 -- All
-CREATE OR REPLACE FUNCTION getNumSale() RETURNS INT AS $$
-DECLARE
-    numSale int := 0;
-BEGIN
-    
-    SELECT INTO numSale COUNT(DISTINCT I.pid)
+CREATE OR REPLACE FUNCTION getNumSale() RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
     FROM Inventory I
     WHERE I.special='True';
-
-    IF numSale IS NOT NULL
-        THEN RETURN numSale;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Store
-CREATE OR REPLACE FUNCTION getNumSaleStore(sid INT) RETURNS INT AS $$
-DECLARE
-    numSale int := 0;
-BEGIN
-    
-    SELECT INTO numSale COUNT(DISTINCT I.pid)
+CREATE OR REPLACE FUNCTION getNumSaleStore(sid INT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
     FROM Inventory I
     WHERE I.special='True'
     AND I.sid=$1;
-
-    IF numSale IS NOT NULL
-        THEN RETURN numSale;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Zip
-CREATE OR REPLACE FUNCTION getNumSaleZip(zip TEXT) RETURNS INT AS $$
-DECLARE
-    numSale int := 0;
-BEGIN
-    
-    SELECT INTO numSale COUNT(DISTINCT I.pid)
+CREATE OR REPLACE FUNCTION getNumSaleZip(zip TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
     FROM Inventory I, Stores S
     WHERE I.special='True'
     AND I.sid=S.sid
     AND S.zip=$1;
-
-    IF numSale IS NOT NULL
-        THEN RETURN numSale;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- City
-CREATE OR REPLACE FUNCTION getNumSaleCity(city TEXT) RETURNS INT AS $$
-DECLARE
-    numSale int := 0;
-BEGIN
-    
-    SELECT INTO numSale COUNT(DISTINCT I.pid)
+CREATE OR REPLACE FUNCTION getNumSaleCity(city TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
     FROM Inventory I, Stores S
     WHERE I.special='True'
     AND I.sid=S.sid
     AND LOWER(S.city)=LOWER($1);
-
-    IF numSale IS NOT NULL
-        THEN RETURN numSale;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- State
-CREATE OR REPLACE FUNCTION getNumSaleState(state TEXT) RETURNS INT AS $$
-DECLARE
-    numSale int := 0;
-BEGIN
-    
-    SELECT INTO numSale COUNT(DISTINCT I.pid)
+CREATE OR REPLACE FUNCTION getNumSaleState(state TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
     FROM Inventory I, Stores S
     WHERE I.special='True'
     AND I.sid=S.sid
     AND LOWER(S.state)=LOWER($1);
-
-    IF numSale IS NOT NULL
-        THEN RETURN numSale;
-        ELSE RETURN 0;
-    END IF;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
 
 -- Color
-CREATE OR REPLACE FUNCTION getNumSaleColor(color TEXT) RETURNS INT AS $$
-DECLARE
-    numSale int := 0;
-BEGIN
-    
-    SELECT INTO numSale COUNT(DISTINCT I.pid)
+CREATE OR REPLACE FUNCTION getNumSaleColor(color TEXT) RETURNS SETOF INT AS $$
+    SELECT COUNT(DISTINCT I.pid)::INT
     FROM Inventory I, Products P
     WHERE I.special='True'
     AND I.pid=P.pid
     AND LOWER(P.color)=LOWER($1);
+$$ LANGUAGE sql STABLE PARALLEL SAFE ROWS 1;
+
+
+
+--------------------------------------------------------------------------------
+-- PAGE DATA
+-- One call per page: the filtered table rows with the page's summary metrics
+-- repeated on every row. When nothing matches a single row of NULLs carries
+-- the metrics. filter_type is NULL for everything, or one of 'store', 'zip',
+-- 'city', 'state' (and 'color' for products).
+--
+-- The rows are paged by key: sid for stores, eid and sid for employees, pid
+-- and sid for products (an employee works at, a product is stocked by, more
+-- than one store). after_key gives the page_limit rows following a key in
+-- key order, before_key the page_limit rows preceding one, in descending key
+-- order. Without a page_limit every row comes back, without either key the
+-- first rows do. The key bounds are index conditions, so a page costs the
+-- same wherever it is in the table. Ids start at 1, a missing key becomes a
+-- bound past the end.
+
+-- Ids of the stores matching a filter, NULL when there is no filter.
+-- A store filter that isn't a number matches nothing.
+CREATE OR REPLACE FUNCTION filtered_stores(filter_type TEXT, filter_value TEXT)
+RETURNS INT[] AS $$
+BEGIN
+    IF filter_type IS NULL THEN
+        RETURN NULL;
+    ELSIF filter_type = 'store' THEN
+        RETURN ARRAY(SELECT S.sid
+                     FROM Stores S
+                     WHERE filter_value ~ '^[0-9]{1,9}$'
+                     AND S.sid=filter_value::INT);
+    ELSIF filter_type = 'zip' THEN
+        RETURN ARRAY(SELECT S.sid FROM Stores S WHERE S.zip=filter_value);
+    ELSIF filter_type = 'city' THEN
+        RETURN ARRAY(SELECT S.sid FROM Stores S WHERE LOWER(S.city)=LOWER(filter_value));
+    ELSIF filter_type = 'state' THEN
+        RETURN ARRAY(SELECT S.sid FROM Stores S WHERE LOWER(S.state)=LOWER(filter_value));
+    END IF;
+
+    RAISE EXCEPTION 'Unknown store filter %', filter_type;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Stores page: stores, average salary and hourly pay, number of employees
+CREATE OR REPLACE FUNCTION stores_page_data(filter_type TEXT, filter_value TEXT,
+                                            after_key INT[] DEFAULT NULL,
+                                            before_key INT[] DEFAULT NULL,
+                                            page_limit INT DEFAULT NULL)
+RETURNS TABLE (sid INT, address TEXT, city TEXT, state TEXT, zip TEXT, telno TEXT,
+               avg_sal FLOAT, avg_hrly FLOAT, num_emps INT) AS $$
+DECLARE
+    sids INT[] := filtered_stores(filter_type, filter_value);
+    low INT := COALESCE(after_key[1], 0);
+    high INT := COALESCE(before_key[1], 2147483647);
+BEGIN
+
+    IF sids IS NULL THEN
+        SELECT INTO avg_sal, avg_hrly, num_emps A, H, N
+        FROM getAvgSalAll() A, getAvgHrlyAll() H, getNumEmps() N;
 
-    IF numSale IS NOT NULL
-        THEN RETURN numSale;
-        ELSE RETURN 0;
+    ELSE
+        SELECT INTO avg_sal, avg_hrly
+               ROUND(SUM(R.salary_sum) / NULLIF(SUM(R.salary_count), 0), 2),
+               ROUND(SUM(R.hourly_sum) / NULLIF(SUM(R.hourly_count), 0), 2)
+        FROM store_stats R
+        WHERE R.sid=ANY(sids);
+
+        -- Same as avg_*_store and friends, -1.0 when there is nothing to average
+        avg_sal := COALESCE(avg_sal, -1.0);
+        avg_hrly := COALESCE(avg_hrly, -1.0);
+
+        -- Distinct employees, see getNumEmpsStore and friends
+        SELECT INTO num_emps
+               COALESCE(SUM(CASE filter_type
+                            WHEN 'zip' THEN R.zip_headcount
+                            WHEN 'city' THEN R.city_headcount
+                            WHEN 'state' THEN R.state_headcount
+                            ELSE R.headcount
+                            END), 0)
+        FROM store_stats R
+        WHERE R.sid=ANY(sids);
+    END IF;
+
+    IF sids IS NULL AND before_key IS NULL THEN
+        RETURN QUERY
+        SELECT S.sid, S.address, S.city, S.state, S.zip, S.telno, avg_sal, avg_hrly, num_emps
+        FROM Stores S
+        WHERE S.sid > low AND S.sid < high
+        ORDER BY S.sid
+        LIMIT page_limit;
+
+    ELSIF sids IS NULL THEN
+        RETURN QUERY
+        SELECT S.sid, S.address, S.city, S.state, S.zip, S.telno, avg_sal, avg_hrly, num_emps
+        FROM Stores S
+        WHERE S.sid > low AND S.sid < high
+        ORDER BY S.sid DESC
+        LIMIT page_limit;
+
+    ELSIF before_key IS NULL THEN
+        RETURN QUERY
+        SELECT S.sid, S.address, S.city, S.state, S.zip, S.telno, avg_sal, avg_hrly, num_emps
+        FROM Stores S
+        WHERE S.sid=ANY(sids)
+        AND S.sid > low AND S.sid < high
+        ORDER BY S.sid
+        LIMIT page_limit;
+
+    ELSE
+        RETURN QUERY
+        SELECT S.sid, S.address, S.city, S.state, S.zip, S.telno, avg_sal, avg_hrly, num_emps
+        FROM Stores S
+        WHERE S.sid=ANY(sids)
+        AND S.sid > low AND S.sid < high
+        ORDER BY S.sid DESC
+        LIMIT page_limit;
+    END IF;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT NULL::INT, NULL::TEXT, NULL::TEXT, NULL::TEXT, NULL::TEXT, NULL::TEXT,
+                            avg_sal, avg_hrly, num_emps;
     END IF;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Employees page: employees with the store they work at, average salary and
+-- hourly pay
+CREATE OR REPLACE FUNCTION employees_page_data(filter_type TEXT, filter_value TEXT,
+                                               after_key INT[] DEFAULT NULL,
+                                               before_key INT[] DEFAULT NULL,
+                                               page_limit INT DEFAULT NULL)
+RETURNS TABLE (eid INT, firstname TEXT, lastname TEXT, hourly BOOL, pay NUMERIC,
+               roleid INT, sid INT, avg_sal FLOAT, avg_hrly FLOAT) AS $$
+DECLARE
+    sids INT[] := filtered_stores(filter_type, filter_value);
+    low INT[] := COALESCE(after_key, '{0, 0}');
+    high INT[] := COALESCE(before_key, '{2147483647, 2147483647}');
+BEGIN
+
+    IF sids IS NULL THEN
+        SELECT INTO avg_sal, avg_hrly A, H
+        FROM getAvgSalAll() A, getAvgHrlyAll() H;
+
+    ELSE
+        SELECT INTO avg_sal, avg_hrly
+               ROUND(SUM(R.salary_sum) / NULLIF(SUM(R.salary_count), 0), 2),
+               ROUND(SUM(R.hourly_sum) / NULLIF(SUM(R.hourly_count), 0), 2)
+        FROM store_stats R
+        WHERE R.sid=ANY(sids);
+
+        avg_sal := COALESCE(avg_sal, -1.0);
+        avg_hrly := COALESCE(avg_hrly, -1.0);
+    END IF;
+
+    IF sids IS NULL AND before_key IS NULL THEN
+        RETURN QUERY
+        SELECT E.eid, E.firstname, E.lastname, E.hourly, E.pay, E.roleid, Emp.sid, avg_sal, avg_hrly
+        FROM Employees E, Employment Emp
+        WHERE E.eid=Emp.eid
+        AND (Emp.eid, Emp.sid) > (low[1], low[2])
+        AND (Emp.eid, Emp.sid) < (high[1], high[2])
+        ORDER BY Emp.eid, Emp.sid
+        LIMIT page_limit;
+
+    ELSIF sids IS NULL THEN
+        RETURN QUERY
+        SELECT E.eid, E.firstname, E.lastname, E.hourly, E.pay, E.roleid, Emp.sid, avg_sal, avg_hrly
+        FROM Employees E, Employment Emp
+        WHERE E.eid=Emp.eid
+        AND (Emp.eid, Emp.sid) > (low[1], low[2])
+        AND (Emp.eid, Emp.sid) < (high[1], high[2])
+        ORDER BY Emp.eid DESC, Emp.sid DESC
+        LIMIT page_limit;
+
+    ELSIF before_key IS NULL THEN
+        RETURN QUERY
+        SELECT E.eid, E.firstname, E.lastname, E.hourly, E.pay, E.roleid, Emp.sid, avg_sal, avg_hrly
+        FROM Employees E, Employment Emp
+        WHERE E.eid=Emp.eid
+        AND Emp.sid=ANY(sids)
+        AND (Emp.eid, Emp.sid) > (low[1], low[2])
+        AND (Emp.eid, Emp.sid) < (high[1], high[2])
+        ORDER BY Emp.eid, Emp.sid
+        LIMIT page_limit;
+
+    ELSE
+        RETURN QUERY
+        SELECT E.eid, E.firstname, E.lastname, E.hourly, E.pay, E.roleid, Emp.sid, avg_sal, avg_hrly
+        FROM Employees E, Employment Emp
+        WHERE E.eid=Emp.eid
+        AND Emp.sid=ANY(sids)
+        AND (Emp.eid, Emp.sid) > (low[1], low[2])
+        AND (Emp.eid, Emp.sid) < (high[1], high[2])
+        ORDER BY Emp.eid DESC, Emp.sid DESC
+        LIMIT page_limit;
+    END IF;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT NULL::INT, NULL::TEXT, NULL::TEXT, NULL::BOOL, NULL::NUMERIC,
+                            NULL::INT, NULL::INT, avg_sal, avg_hrly;
+    END IF;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Products page: every store stocking the products found, average price,
+-- number of distinct products and of products on special
+CREATE OR REPLACE FUNCTION products_page_data(filter_type TEXT, filter_value TEXT,
+                                              after_key INT[] DEFAULT NULL,
+                                              before_key INT[] DEFAULT NULL,
+                                              page_limit INT DEFAULT NULL)
+RETURNS TABLE (pid INT, name TEXT, color TEXT, sid INT,
+               avg_price FLOAT, num_products INT, num_sale INT) AS $$
+DECLARE
+    sids INT[];
+    low INT[] := COALESCE(after_key, '{0, 0}');
+    high INT[] := COALESCE(before_key, '{2147483647, 2147483647}');
+BEGIN
+
+    IF filter_type IS NULL THEN
+        SELECT INTO avg_price, num_products, num_sale A, N, Sale
+        FROM getAvgPrice() A, getNumProds() N, getNumSale() Sale;
+
+        IF before_key IS NULL THEN
+            RETURN QUERY
+            SELECT P.pid, P.name, P.color, I.sid, avg_price, num_products, num_sale
+            FROM Products P, Inventory I
+            WHERE P.pid=I.pid
+            AND (I.pid, I.sid) > (low[1], low[2])
+            AND (I.pid, I.sid) < (high[1], high[2])
+            ORDER BY I.pid, I.sid
+            LIMIT page_limit;
+        ELSE
+            RETURN QUERY
+            SELECT P.pid, P.name, P.color, I.sid, avg_price, num_products, num_sale
+            FROM Products P, Inventory I
+            WHERE P.pid=I.pid
+            AND (I.pid, I.sid) > (low[1], low[2])
+            AND (I.pid, I.sid) < (high[1], high[2])
+            ORDER BY I.pid DESC, I.sid DESC
+            LIMIT page_limit;
+        END IF;
 
+    ELSIF filter_type = 'color' THEN
+        SELECT INTO avg_price, num_products, num_sale
+               ROUND(AVG(I.price), 2),
+               COUNT(DISTINCT I.pid),
+               COUNT(DISTINCT I.pid) FILTER (WHERE I.special)
+        FROM Products P, Inventory I
+        WHERE P.pid=I.pid
+        AND LOWER(P.color)=LOWER(filter_value);
+
+        avg_price := COALESCE(avg_price, 0.0);
+
+        IF before_key IS NULL THEN
+            RETURN QUERY
+            SELECT P.pid, P.name, P.color, I.sid, avg_price, num_products, num_sale
+            FROM Products P, Inventory I
+            WHERE P.pid=I.pid
+            AND LOWER(P.color)=LOWER(filter_value)
+            AND (I.pid, I.sid) > (low[1], low[2])
+            AND (I.pid, I.sid) < (high[1], high[2])
+            ORDER BY I.pid, I.sid
+            LIMIT page_limit;
+        ELSE
+            RETURN QUERY
+            SELECT P.pid, P.name, P.color, I.sid, avg_price, num_products, num_sale
+            FROM Products P, Inventory I
+            WHERE P.pid=I.pid
+            AND LOWER(P.color)=LOWER(filter_value)
+            AND (I.pid, I.sid) > (low[1], low[2])
+            AND (I.pid, I.sid) < (high[1], high[2])
+            ORDER BY I.pid DESC, I.sid DESC
+            LIMIT page_limit;
+        END IF;
+
+    ELSE
+        sids := filtered_stores(filter_type, filter_value);
+
+        SELECT INTO avg_price, num_products, num_sale
+               ROUND(AVG(I.price), 2),
+               COUNT(DISTINCT I.pid),
+               COUNT(DISTINCT I.pid) FILTER (WHERE I.special)
+        FROM Inventory I
+        WHERE I.sid=ANY(sids);
+
+        avg_price := COALESCE(avg_price, 0.0);
+
+        -- Products stocked by the stores found, with every store that has them
+        IF before_key IS NULL THEN
+            RETURN QUERY
+            SELECT P.pid, P.name, P.color, I.sid, avg_price, num_products, num_sale
+            FROM Products P, Inventory I
+            WHERE P.pid=I.pid
+            AND I.pid IN (SELECT Found.pid
+                          FROM Inventory Found
+                          WHERE Found.sid=ANY(sids)
+                          AND Found.pid BETWEEN low[1] AND high[1])
+            AND (I.pid, I.sid) > (low[1], low[2])
+            AND (I.pid, I.sid) < (high[1], high[2])
+            ORDER BY I.pid, I.sid
+            LIMIT page_limit;
+        ELSE
+            RETURN QUERY
+            SELECT P.pid, P.name, P.color, I.sid, avg_price, num_products, num_sale
+            FROM Products P, Inventory I
+            WHERE P.pid=I.pid
+            AND I.pid IN (SELECT Found.pid
+                          FROM Inventory Found
+                          WHERE Found.sid=ANY(sids)
+                          AND Found.pid BETWEEN low[1] AND high[1])
+            AND (I.pid, I.sid) > (low[1], low[2])
+            AND (I.pid, I.sid) < (high[1], high[2])
+            ORDER BY I.pid DESC, I.sid DESC
+            LIMIT page_limit;
+        END IF;
+    END IF;
 
--- Add employee:
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT NULL::INT, NULL::TEXT, NULL::TEXT, NULL::INT,
+                            avg_price, num_products, num_sale;
+    END IF;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+-- Add employee: returns the new eid, handed out by the Employees sequence
 CREATE OR REPLACE FUNCTION createEmp(fname TEXT, lname TEXT, 
-hourly BOOL, pay NUMERIC, roleid INT, sid Int ) RETURNS VOID AS $$
+hourly BOOL, pay NUMERIC, roleid INT, sid Int ) RETURNS INT AS $$
 DECLARE
     id int;
 BEGIN
-    
-    -- Get a unique id for the newly created employee
-    SELECT INTO id MAX(E.eid)+1 FROM Employees E;
 
-    -- Insert into the employee table
-    INSERT INTO Employees (eid, firstname, lastname, hourly, pay, roleid)
-    VALUES (id,$1,$2,$3,$4,$5);
+    -- Insert into the employee table, the sequence gives a unique id even
+    -- to concurrent inserts
+    INSERT INTO Employees (firstname, lastname, hourly, pay, roleid)
+    VALUES ($1,$2,$3,$4,$5)
+    RETURNING Employees.eid INTO id;
 
     -- Insert into the assigned store
     INSERT INTO Employment (eid, sid)
     VALUES (id, $6);
 
+    RETURN id;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -945,22 +848,22 @@ $$ LANGUAGE plpgsql;
 
 
 --- Products
--- Create new product
+-- Create new product, returns its pid
 CREATE OR REPLACE FUNCTION createNewProd(name TEXT, color TEXT, sid INT, price NUMERIC, qty INT, sale BOOL)
-RETURNS VOID AS $$
+RETURNS INT AS $$
 DECLARE
-    pid INT := 0;
+    pid INT;
 BEGIN
 
-    -- Select a new pid
-    SELECT INTO pid MAX(P.pid)+1 FROM Products P;
-
-    INSERT INTO Products (pid, name, color)
-    VALUES (pid, $1, $2);
+    -- The Products sequence gives the new pid
+    INSERT INTO Products (name, color)
+    VALUES ($1, $2)
+    RETURNING Products.pid INTO pid;
 
     INSERT INTO Inventory (pid, sid, price, stock, special)
     VALUES (pid, $3, $4, $5, $6);
 
+    RETURN pid;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -968,41 +871,72 @@ $$ LANGUAGE plpgsql;
 CREATE OR REPLACE FUNCTION addExistingProd(pid INT, sid INT, price NUMERIC, qty INT, sale BOOL)
 RETURNS VOID AS $$
 BEGIN
-    -- If the product already exists for the store, alter its other values
-    IF EXISTS (SELECT 1 
-               FROM Inventory I
-               WHERE I.pid=$1
-               AND I.sid=$2)
-        THEN UPDATE Inventory I
-             SET price=$3,
-                 stock=$4,
-                 sale =$5
-             WHERE I.pid=$1
-             AND I.sid=$2;
-        ELSE
-            INSERT INTO Inventory (pid, sid, price, stock, sale)
-            VALUES ($1, $2, $3, $4, $5);
+    -- If the product already exists for the store, alter its other values.
+    -- One statement on the Inventory key (see indexes.sql), so two writers
+    -- can't both insert
+    INSERT INTO Inventory (pid, sid, price, stock, special)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT ON CONSTRAINT inventory_pkey DO UPDATE
+    SET price=EXCLUDED.price,
+        stock=EXCLUDED.stock,
+        special=EXCLUDED.special;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Reprice the inventory rows matching a filter, returns how many changed.
+-- filter_type and filter_value are those of the PAGE DATA procedures, pids
+-- (NULL for any) narrows the rows down to some products. Prices are
+-- multiplied by 1 + percent/100, then moved by amount, rounded to cents and
+-- never below 0; special is set unless on_special is NULL. One UPDATE for
+-- every row, the rows already as asked are left alone.
+CREATE OR REPLACE FUNCTION reprice_inventory(filter_type TEXT, filter_value TEXT, pids INT[],
+                                             percent NUMERIC, amount NUMERIC, on_special BOOL)
+RETURNS INT AS $$
+DECLARE
+    sids INT[];
+    reprice BOOL := percent IS NOT NULL OR amount IS NOT NULL;
+    factor NUMERIC := 1 + COALESCE(percent, 0) / 100;
+    shift NUMERIC := COALESCE(amount, 0);
+    changed INT;
+BEGIN
+    IF filter_type = 'color' THEN
+        pids := ARRAY(SELECT P.pid
+                      FROM Products P
+                      WHERE LOWER(P.color)=LOWER(filter_value)
+                      AND (pids IS NULL OR P.pid = ANY(pids)));
+    ELSE
+        sids := filtered_stores(filter_type, filter_value);
     END IF;
+
+    UPDATE Inventory I
+    SET price = CASE WHEN reprice THEN GREATEST(ROUND(I.price * factor + shift, 2), 0) ELSE I.price END,
+        special = COALESCE(on_special, I.special)
+    WHERE (sids IS NULL OR I.sid = ANY(sids))
+    AND (pids IS NULL OR I.pid = ANY(pids))
+    AND (CASE WHEN reprice THEN GREATEST(ROUND(I.price * factor + shift, 2), 0) ELSE I.price END,
+         COALESCE(on_special, I.special)) IS DISTINCT FROM (I.price, I.special);
+
+    GET DIAGNOSTICS changed = ROW_COUNT;
+    RETURN changed;
 END;
 $$ LANGUAGE plpgsql;
 
--- Create a new store
+-- Create a new store, returns its sid
 CREATE OR REPLACE FUNCTION addStore(address TEXT, city TEXT, state TEXT,
-zip TEXT, telno TEXT, managerID INT) RETURNS VOID AS $$
+zip TEXT, telno TEXT, managerID INT) RETURNS INT AS $$
 DECLARE
-    sid int := 0;
+    sid int;
 BEGIN
-    
-    -- Get unique valid SID
-    SELECT INTO sid MAX(S.sid)+1 FROM Stores S;
 
-    -- Do the store table insertion
-    INSERT INTO Stores (sid, address, city, state, zip, telno)
-    VALUES (sid, $1, $2, $3, $4, $5);
+    -- Do the store table insertion, the Stores sequence gives the sid
+    INSERT INTO Stores (address, city, state, zip, telno)
+    VALUES ($1, $2, $3, $4, $5)
+    RETURNING Stores.sid INTO sid;
 
     -- Do the Employment Entry adding the manager to this store
     INSERT INTO Employment (sid, eid)
     VALUES (sid, $6);
 
+    RETURN sid;
 END;
 $$ LANGUAGE plpgsql;
@@ -1,7 +1,92 @@
-from flask_table import Table, Col
+import re
 
-from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
+from flask_table import Table, Col
+from flask_table.html import element
+from markupsafe import Markup
+
+# Every query goes through the prepared statements in queries.py, on the
+# request's connection, the pages through the cache as well
+import cache
+import queries
+
+# Seconds the query of a page gets, set by the app from PAGE_TIMEOUT
+PAGE_TIMEOUT = None
+
+def page_data(table, filter_type, filter_value, after=None, before=None, page_size=None):
+    '''Run the *_page_data procedure of table, through the cache
+    Returns the table rows, the summary row, which has the page metrics, and
+    the cursors of the neighbouring pages. The procedure always returns at
+    least one row, when nothing matched it is all NULL apart from the metrics.
+    queries.QueryTimeout is raised when it takes longer than PAGE_TIMEOUT.
+
+    The procedure pages by the columns in table.page_key. Rows follow the key
+    after or precede the key before (tuples of key values), page_size of
+    them, or all of them when page_size is None. The cursors are a dict with
+    the key of the last row as 'next' when more rows follow and the key of
+    the first as 'previous' when some precede, None otherwise.
+    '''
+    # One row more than the page tells whether another page follows it
+    limit = page_size + 1 if page_size else None
+    result = cache.cached(
+        (table.page_query, filter_type, filter_value, after, before, limit),
+        table.cache_families,
+        lambda: queries.fetch_with_timeout(table.page_query, filter_type, filter_value,
+                                           list(after) if after else None,
+                                           list(before) if before else None,
+                                           limit, timeout=PAGE_TIMEOUT))
+    rows = [row for row in result if row[0] is not None]
+    more = limit is not None and len(rows) == limit
+
+    if before:
+        # Paging backwards the rows come last first
+        rows = rows[:page_size][::-1]
+        has_previous, has_next = more, True
+    else:
+        rows = rows[:page_size]
+        has_previous, has_next = bool(after), more
+
+    def row_key(row):
+        return tuple(getattr(row, column) for column in table.page_key)
+
+    pages = {
+        'previous': row_key(rows[0]) if rows and has_previous else None,
+        'next': row_key(rows[-1]) if rows and has_next else None,
+    }
+    return rows, result[0], pages
+
+# Values a store filter can match, as in filtered_stores of stored_procedures.sql
+STORE_ID = re.compile(r'^[0-9]{1,9}$')
+
+def stream_table(table, filter_type=None, filter_value=None, batch_size=1000):
+    '''Yield the HTML of a whole filtered table, a batch of rows at a time
+    table is StoresTable, EmpTable or ProductsTable, filter_type one of its
+    stream_queries. The rows come from a server side cursor (queries.stream)
+    and every batch is written out before the next is fetched, so neither the
+    memory used nor the time to the first row grow with the table. The markup
+    is the same the table renders itself with.
+    '''
+    if filter_type is None:
+        batches = queries.stream(table.stream_queries[None], batch_size=batch_size)
+    elif filter_type == 'store' and not STORE_ID.match(filter_value):
+        batches = iter(())
+    else:
+        batches = queries.stream(table.stream_queries[filter_type], filter_value,
+                                 batch_size=batch_size)
+
+    # An empty table only for the markup
+    html = table([])
+    first = next(batches, None)
+    if first is None:
+        yield element('p', content=html.no_items)
+        return
+
+    start, end = element('table', attrs=html.get_html_attrs(), content='\0',
+                         escape_content=False).split('\0')
+    yield Markup('{}\n{}\n<tbody>\n'.format(start, html.thead()))
+    yield Markup('\n'.join(html.tr(row) for row in first))
+    for rows in batches:
+        yield Markup('\n' + '\n'.join(html.tr(row) for row in rows))
+    yield Markup('\n</tbody>\n' + end)
 
 class UsersTable(Table):
 
@@ -15,10 +100,7 @@ class UsersTable(Table):
     active=Col('active')
 
     def getUsers():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM flask_security_user;')
-        conn.close()
-        return result
+        return queries.fetch_all('getUsers')
 
 class StoresTable(Table):
     '''Declare the Stores Table
@@ -39,140 +121,96 @@ class StoresTable(Table):
     zip = Col('zip')
     telno = Col('telno')
 
+    # Page procedure, the key it orders and pages the rows by and the entity
+    # families it reads (see cache.py)
+    page_query = 'stores_page_data'
+    page_key = ('sid',)
+    cache_families = ('stores', 'employees')
+
+    # Queries streaming the whole table, by filter type (see stream_table)
+    stream_queries = {None: 'getStores', 'store': 'getStoresID', 'zip': 'getStoresZip',
+                      'city': 'getStoresCity', 'state': 'getStoresState'}
+
+    # Rows and metrics of the stores page in one query
+    def getPageData(filter_type=None, filter_value=None, after=None, before=None, page_size=None):
+        '''Returns (rows, avg_sal, avg_hrly, numEmps, pages), see page_data for the paging'''
+        rows, summary, pages = page_data(StoresTable, filter_type, filter_value, after, before, page_size)
+        return rows, summary.avg_sal, summary.avg_hrly, summary.num_emps, pages
+
     # Get stores tables based on criteria
     def getStores():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM stores;')
-        conn.close()
-        return result
+        return queries.fetch_all('getStores')
 
     def getStoresZip(zip):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getStoresZip(\'{0}\');'.format(zip))
-        conn.close()
-        return result;
+        return queries.fetch_all('getStoresZip', zip)
 
     def getStoresCity(city):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getStoresCity(\'{0}\');'.format(city))
-        conn.close()
-        return result;
+        return queries.fetch_all('getStoresCity', city)
 
     def getStoresState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getStoresState(\'{0}\');'.format(state))
-        conn.close()
-        return result;
+        return queries.fetch_all('getStoresState', state)
 
     def getStoresID(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getStoresID({0});'.format(sid))
-        conn.close()
-        return result;
+        return queries.fetch_all('getStoresID', sid)
 
 
     # Averages
     def getAvgSalAll():
         '''Get the overall average salary'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgSalAll();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgSalAll')
 
     def getAvgHrlyAll():
         '''Get the overall average hourly pay'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgHrlyAll();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgHrlyAll')
 
     def getAvgSalStore(sid):
         '''Get average salary by store'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_store({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_store', sid)
 
     def getAvgHrlyStore(sid):
         '''Gets the average salary by store'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_store({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_store', sid)
 
 
     def getAvgSalZip(zip):
         '''Get the average salary based on zip'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_zip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_zip', zip)
 
     def getAvgHrlyZip(zip):
         '''Get the average hourly pay based on zip'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_zip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_zip', zip)
 
     def getAvgSalCity(city):
         '''Get the average salary based on city'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_city(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_city', city)
 
     def getAvgHrlyCity(city):
         '''Get the average hourly pay based on city'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_city(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_city', city)
 
     def getAvgSalState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_state(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_state', state)
 
     def getAvgHrlyState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_state(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_state', state)
 
 
     # Number of employees
     #----------------------
     def getNumEmps():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumEmps();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumEmps')
 
     def getNumEmpsStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumEmpsStore({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumEmpsStore', sid)
 
     def getNumEmpsZip(zip):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumEmpsZip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumEmpsZip', zip)
 
     def getNumEmpsCity(city):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumEmpsCity(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumEmpsCity', city)
 
     def getNumEmpsState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumEmpsState(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumEmpsState', state)
 
 
 
@@ -191,108 +229,76 @@ class EmpTable(Table):
     roleid=Col('roleid')
     sid=Col('sid')
 
+    # An employee has a row for every store they work at
+    page_query = 'employees_page_data'
+    page_key = ('eid', 'sid')
+    cache_families = ('employees', 'stores')
+
+    stream_queries = {None: 'getEmployees', 'store': 'getEmpStore', 'zip': 'getEmpZip',
+                      'city': 'getEmpCity', 'state': 'getEmpState'}
+
+    # Rows and metrics of the employees page in one query
+    def getPageData(filter_type=None, filter_value=None, after=None, before=None, page_size=None):
+        '''Returns (rows, avg_sal, avg_hrly, pages), see page_data for the paging'''
+        rows, summary, pages = page_data(EmpTable, filter_type, filter_value, after, before, page_size)
+        return rows, summary.avg_sal, summary.avg_hrly, pages
+
     # Whole tables
     def getEmployees():
         '''Get the list of all employees'''
-        conn = db.engine.connect()
-        getEmps  = 'SELECT * FROM employees NATURAL JOIN employment order by eid;'
-        result = conn.execute(getEmps)
-        conn.close()
-        return result
+        return queries.fetch_all('getEmployees')
 
     def getEmployeesZip(zip):
         '''Get employee table filtered by zip'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getEmpZip(\'{0}\');'.format(zip))
-        conn.close()
-        return result
+        return queries.fetch_all('getEmpZip', zip)
 
     def getEmployeesCity(city):
         '''Get employee table filtered by city'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getEmpCity(\'{0}\');'.format(city))
-        conn.close()
-        return result
+        return queries.fetch_all('getEmpCity', city)
 
     def getEmployeesState(state):
         '''Get employee table based on state'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getEmpState(\'{0}\');'.format(state))
-        conn.close()
-        return result
+        return queries.fetch_all('getEmpState', state)
 
     def getEmployeesStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getEmpStore({0});'.format(sid))
-        conn.close()
-        return result
+        return queries.fetch_all('getEmpStore', sid)
 
     # Averages
     def getAvgSalAll():
         '''Get the overall average salary'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgSalAll();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgSalAll')
 
     def getAvgHrlyAll():
         '''Get the overall average hourly pay'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgHrlyAll();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgHrlyAll')
 
     def getAvgSalZip(zip):
         '''Get the average salary based on zip'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_zip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_zip', zip)
 
     def getAvgHrlyZip(zip):
         '''Get the average hourly pay based on zip'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_zip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_zip', zip)
 
     def getAvgSalCity(city):
         '''Get the average salary based on city'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_city(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_city', city)
 
     def getAvgHrlyCity(city):
         '''Get the average hourly pay based on city'''
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_city(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_city', city)
 
     def getAvgSalState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_state(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_state', state)
 
     def getAvgHrlyState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_state(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_state', state)
 
     def getAvgSalStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_salary_store({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_salary_store', sid)
 
     def getAvgHrlyStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM avg_hourly_store({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('avg_hourly_store', sid)
 
 class ProductsTable(Table):
 
@@ -304,151 +310,93 @@ class ProductsTable(Table):
     color=Col('color')
     sid=Col('sid')
 
+    # A product has a row for every store stocking it
+    page_query = 'products_page_data'
+    page_key = ('pid', 'sid')
+    cache_families = ('products', 'stores')
+
+    stream_queries = {None: 'getProds', 'store': 'getProdStore', 'zip': 'getProdZip',
+                      'city': 'getProdCity', 'state': 'getProdState', 'color': 'getProdColor'}
+
+    # Rows and metrics of the products page in one query
+    def getPageData(filter_type=None, filter_value=None, after=None, before=None, page_size=None):
+        '''Returns (rows, avgPrice, numProducts, numSale, pages), see page_data for the paging'''
+        rows, summary, pages = page_data(ProductsTable, filter_type, filter_value, after, before, page_size)
+        return rows, summary.avg_price, summary.num_products, summary.num_sale, pages
+
     def getProducts():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getProds();')
-        conn.close()
-        return result
+        return queries.fetch_all('getProds')
 
     def getProductsStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getProdStore({0});'.format(sid))
-        conn.close()
-        return result
+        return queries.fetch_all('getProdStore', sid)
 
     def getProductsZip(zip):
-        conn=db.engine.connect()
-        result = conn.execute('Select * FROM getProdZip(\'{0}\');'.format(zip))
-        conn.close()
-        return result
+        return queries.fetch_all('getProdZip', zip)
 
     def getProductsCity(city):
-        conn=db.engine.connect()
-        result = conn.execute('Select * FROM getProdCity(\'{0}\');'.format(city))
-        conn.close()
-        return result
+        return queries.fetch_all('getProdCity', city)
 
     def getProductsState(state):
-        conn=db.engine.connect()
-        result = conn.execute('Select * FROM getProdState(\'{0}\');'.format(state))
-        conn.close()
-        return result
+        return queries.fetch_all('getProdState', state)
 
     def getProductsColor(color):
-        conn=db.engine.connect()
-        result = conn.execute('Select * FROM getProdColor(\'{0}\');'.format(color))
-        conn.close()
-        return result
+        return queries.fetch_all('getProdColor', color)
 
     # Averages
     # These return single value so use .first()[0]
     def getAvgPrice():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgPrice();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgPrice')
 
     def getAvgPriceZip(zip):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgPriceZip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgPriceZip', zip)
 
     def getAvgPriceCity(city):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgPriceCity(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgPriceCity', city)
 
     def getAvgPriceState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgPriceState(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgPriceState', state)
 
     def getAvgPriceStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgPriceStore({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgPriceStore', sid)
 
     def getAvgPriceColor(color):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getAvgPriceColor(\'{0}\');'.format(color)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getAvgPriceColor', color)
 
 
     # Product count
     def getNumProducts():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumProds();').first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumProds')
 
     def getNumProductsStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumProdsStore({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumProdsStore', sid)
 
     def getNumProductsZip(zip):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumProdsZip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumProdsZip', zip)
 
     def getNumProductsCity(city):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumProdsCity(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumProdsCity', city)
 
     def getNumProductsState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumProdsState(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumProdsState', state)
 
     def getNumProductsColor(color):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumProdsColor(\'{0}\');'.format(color)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumProdsColor', color)
 
     # Num products on Sale
     def getNumSale():
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumSale();').first()[0]
-        conn.close()
-        return result;
+        return queries.fetch_value('getNumSale')
 
     def getNumSaleStore(sid):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumSaleStore({0});'.format(sid)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumSaleStore', sid)
 
     def getNumSaleZip(zip):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumSaleZip(\'{0}\');'.format(zip)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumSaleZip', zip)
 
     def getNumSaleCity(city):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumSaleCity(\'{0}\');'.format(city)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumSaleCity', city)
 
     def getNumSaleState(state):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumSaleState(\'{0}\');'.format(state)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumSaleState', state)
 
     def getNumSaleColor(color):
-        conn = db.engine.connect()
-        result = conn.execute('SELECT * FROM getNumSaleColor(\'{0}\');'.format(color)).first()[0]
-        conn.close()
-        return result
+        return queries.fetch_value('getNumSaleColor', color)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+'''
+Existence checks of the ids a form refers to
+
+A form that adds a product to a store, or deletes one, has to know the
+store and product are there; one that creates a store that its manager is.
+missing asks for all the ids a form names at once, in one round trip: a
+primary key lookup (= ANY of the ids) per kind, never the whole key space.
+
+Ids found are remembered for VALIDATION_CACHE_TTL seconds (0, the default,
+turns that off). An id is only cached as existing, an unknown one is asked
+about every time, and a write to its entity family (see cache.py) forgets
+it. The foreign keys of the tables still have the last word: a positive
+answer gone stale can only make the write fail, never let a dangling id in.
+A delete it lets through finds nothing to delete, which the form reports.
+'''
+import threading
+import time
+
+import cache
+import queries
+
+# The kinds of ids that can be checked, the index of their array in the
+# checkKeys query and the entity family their rows belong to
+KINDS = {
+    'stores': (0, 'stores'),
+    'products': (1, 'products'),
+    'managers': (2, 'employees'),
+}
+
+# (kind, id) -> (expiry time, generation of the kind's family when found)
+FOUND = {}
+FOUND_LOCK = threading.Lock()
+
+# Set by init_app from VALIDATION_CACHE_TTL, nothing is cached while it is 0
+TTL = 0
+
+# Ids remembered at most, all are forgotten when there would be more
+MAX_FOUND = 100000
+
+def init_app(app):
+    '''Set the cache lifetime configured for app'''
+    global TTL
+    TTL = app.config.get('VALIDATION_CACHE_TTL', TTL)
+
+def known(kind, id):
+    '''Whether id was found lately and its family hasn't changed since'''
+    with FOUND_LOCK:
+        entry = FOUND.get((kind, id))
+        if entry is None:
+            return False
+        if entry[0] > time.time() and entry[1] == cache.GENERATIONS[KINDS[kind][1]]:
+            return True
+        del FOUND[(kind, id)]
+        return False
+
+def missing(**ids):
+    '''The ids that don't exist, by kind
+
+    Takes lists of ids by kind (stores=[...], products=[...],
+    managers=[...]) and returns a set for each kind given. Runs on the
+    request's connection, in its unit of work if there is one.
+    '''
+    result = {kind: set() for kind in ids}
+    unknown = {kind: sorted(set(id for id in kind_ids if not (TTL and known(kind, id))))
+               for kind, kind_ids in ids.items()}
+    if not any(unknown.values()):
+        return result
+
+    # Read the generations first, a write while the query runs isn't cached
+    generations = dict(cache.GENERATIONS)
+    row = queries.fetch_all('checkKeys', *[unknown.get(kind, []) for kind in sorted(KINDS, key=lambda kind: KINDS[kind][0])])[0]
+    now = time.time()
+    for kind, kind_ids in unknown.items():
+        found = set(row[KINDS[kind][0]])
+        result[kind] = set(kind_ids) - found
+        if TTL:
+            generation = generations[KINDS[kind][1]]
+            with FOUND_LOCK:
+                if len(FOUND) + len(found) > MAX_FOUND:
+                    FOUND.clear()
+                FOUND.update(((kind, id), (now + TTL, generation)) for id in found)
+    return result